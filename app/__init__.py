@@ -3,3 +3,7 @@
 # This file marks the directory as a Python package, allowing the import of modules within this package.
 # Even though this file is empty, it is essential for Python's package system to recognize the directory as a package.
 # Additional initialization code or imports can be placed here if needed in the future.
+import time
+
+# Start of the worker's cold start, used to measure import and startup time (see app.main)
+IMPORT_STARTED = time.perf_counter()
@@ -0,0 +1,197 @@
+# Admission control: per-caller and per-route token buckets, and load shedding when the database pools fill up
+import logging
+import math
+import os
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from fastapi.responses import JSONResponse
+from redis.exceptions import RedisError
+from starlette.routing import Match
+from app import database
+from app.metrics import ADMISSION_REJECTED
+from app.redis_client import redis_client
+
+logger = logging.getLogger(__name__)
+
+# Opt-in: every admitted request costs one Redis round trip
+ADMISSION_CONTROL = os.getenv("ADMISSION_CONTROL", "0") == "1"
+
+# Requests per second a caller may make across all routes, and the burst it may make at once
+ADMISSION_CALLER_RATE = float(os.getenv("ADMISSION_CALLER_RATE", "50"))
+ADMISSION_CALLER_BURST = float(os.getenv("ADMISSION_CALLER_BURST", "100"))
+
+# Optional limits of a route summed over all callers, as "METHOD /path=rate/burst" separated by commas,
+# e.g. "POST /register=500/1000,POST /show=1000/2000"; the path is the route template, like "/package/{package_id}"
+ADMISSION_ROUTE_LIMITS = os.getenv("ADMISSION_ROUTE_LIMITS", "")
+
+# Header naming the caller. There is no authentication in this service, so it must be set by a trusted
+# proxy; without it, callers are told apart by their address
+ADMISSION_CALLER_HEADER = os.getenv("ADMISSION_CALLER_HEADER", "X-User-Id").lower()
+
+# Paths never limited nor shed
+ADMISSION_EXEMPT_PATHS = os.getenv("ADMISSION_EXEMPT_PATHS", "/metrics,/documentation,/redoc,/openapi.json")
+
+# Requests are shed while a database pool has callers waiting with this share of its connections checked out,
+# or for ADMISSION_SHED_WINDOW_S after a caller waited ADMISSION_MAX_POOL_WAIT_MS or more for a connection
+ADMISSION_POOL_BUSY_RATIO = float(os.getenv("ADMISSION_POOL_BUSY_RATIO", "0.9"))
+ADMISSION_MAX_POOL_WAIT_MS = float(os.getenv("ADMISSION_MAX_POOL_WAIT_MS", "200"))
+ADMISSION_SHED_WINDOW_S = float(os.getenv("ADMISSION_SHED_WINDOW_S", "1"))
+
+# Take one token from every bucket, or none if one of them is empty.
+# KEYS: the buckets; ARGV: rate (tokens/s) and burst of every bucket.
+# Returns 0 when admitted, otherwise the milliseconds until every bucket holds a token again.
+# The time is the Redis server's, so the workers share one clock and one running ahead cannot stop the
+# buckets from refilling for the others (reading TIME before writing needs Redis 5 or later, which
+# replicates the effects of a script rather than the script itself)
+TOKEN_BUCKET_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local tokens = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local rate, burst = tonumber(ARGV[2 * i - 1]), tonumber(ARGV[2 * i])
+    local bucket = redis.call('hmget', key, 'tokens', 'ts')
+    local level = tonumber(bucket[1]) or burst
+    local elapsed = math.max(0, now - (tonumber(bucket[2]) or now))
+    level = math.min(burst, level + elapsed * rate / 1000)
+    tokens[i] = level
+    if level < 1 then
+        wait = math.max(wait, math.ceil((1 - level) * 1000 / rate))
+    end
+end
+for i, key in ipairs(KEYS) do
+    local rate, burst = tonumber(ARGV[2 * i - 1]), tonumber(ARGV[2 * i])
+    local level = tokens[i]
+    if wait == 0 then
+        level = level - 1
+    end
+    redis.call('hset', key, 'tokens', tostring(level), 'ts', tostring(now))
+    -- An idle bucket is full again after burst / rate seconds, and then needs no state
+    redis.call('pexpire', key, math.ceil(burst * 1000 / rate) + 1000)
+end
+return wait
+"""
+
+
+def parse_route_limits(spec: str) -> Dict[str, Tuple[float, float]]:
+    """ Parses ADMISSION_ROUTE_LIMITS into {"METHOD /path": (rate, burst)}. """
+    limits = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        route, _, limit = item.rpartition("=")
+        rate, _, burst = limit.partition("/")
+        method, _, path = route.strip().partition(" ")
+        limits[f"{method.upper()} {path.strip()}"] = (float(rate), float(burst or rate))
+    return limits
+
+
+def database_pools() -> List[database.MonitoredPool]:
+    """ Returns the pools of the async engines of this worker that keep track of their waiting callers. """
+    pools = (async_engine.sync_engine.pool for async_engine in database.async_engines)
+    return [pool for pool in pools if isinstance(pool, database.MonitoredPool)]
+
+
+class AdmissionController:
+    """ Decides whether a request is served, rejected with 429 (over its limits) or shed with 503 (overload).
+
+    The token buckets live in Redis, so the limits hold across all workers; each decision is one
+    atomic script call. Shedding looks at the database pools of this worker only and costs no round trip.
+    """
+
+    def __init__(self, redis=redis_client, enabled: bool = ADMISSION_CONTROL,
+                 caller_rate: float = ADMISSION_CALLER_RATE, caller_burst: float = ADMISSION_CALLER_BURST,
+                 route_limits: Optional[Dict[str, Tuple[float, float]]] = None,
+                 caller_header: str = ADMISSION_CALLER_HEADER,
+                 exempt_paths: Iterable[str] = ADMISSION_EXEMPT_PATHS.split(","),
+                 pools: Callable[[], list] = database_pools, busy_ratio: float = ADMISSION_POOL_BUSY_RATIO,
+                 max_pool_wait_ms: float = ADMISSION_MAX_POOL_WAIT_MS, shed_window_s: float = ADMISSION_SHED_WINDOW_S,
+                 key_prefix: str = "admission"):
+        self.redis = redis
+        self.enabled = enabled
+        self.caller_rate = caller_rate
+        self.caller_burst = caller_burst
+        self.route_limits = route_limits if route_limits is not None else parse_route_limits(ADMISSION_ROUTE_LIMITS)
+        self.caller_header = caller_header.lower().encode("latin-1")
+        self.exempt_paths = {path.strip() for path in exempt_paths if path.strip()}
+        self.pools = pools
+        self.busy_ratio = busy_ratio
+        self.max_pool_wait = max_pool_wait_ms / 1000
+        self.shed_window = shed_window_s
+        self.key_prefix = key_prefix
+
+    def caller_of(self, scope) -> str:
+        for name, value in scope["headers"]:
+            if name == self.caller_header:
+                return "user:" + value.decode("latin-1")
+        client = scope.get("client")
+        return "addr:" + (client[0] if client else "unknown")
+
+    def overloaded(self) -> bool:
+        """ Tells whether a database pool is saturated: callers queue for a connection or just waited too long. """
+        now = time.monotonic()
+        for pool in self.pools():
+            if pool.waiting > 0 and pool.checkedout() >= self.busy_ratio * pool.capacity():
+                return True
+            if pool.last_wait >= self.max_pool_wait and now - pool.last_wait_at < self.shed_window:
+                return True
+        return False
+
+    async def wait_ms(self, caller: str, route: Optional[str]) -> int:
+        """ Takes a token for the request, returning 0, or the milliseconds to wait if a bucket is empty. """
+        keys = [f"{self.key_prefix}:caller:{caller}"]
+        args = [self.caller_rate, self.caller_burst]
+        if route in self.route_limits:
+            keys.append(f"{self.key_prefix}:route:{route}")
+            args.extend(self.route_limits[route])
+        return int(await self.redis.eval(TOKEN_BUCKET_SCRIPT, len(keys), *keys, *args))
+
+    async def admit(self, scope) -> Optional[JSONResponse]:
+        """ Returns the response rejecting the request, or None to serve it. """
+        if self.overloaded():
+            ADMISSION_REJECTED.inc(reason="overload")
+            return JSONResponse({"detail": "Server overloaded, retry later"}, status_code=503,
+                                headers={"Retry-After": str(max(1, math.ceil(self.shed_window)))})
+        if self.route_limits:
+            # Routing has not happened yet; find the route template the limits are keyed by
+            for route in scope["app"].router.routes:
+                if route.matches(scope)[0] == Match.FULL:
+                    # Also lets the metrics middleware label a rejected request with its route
+                    scope["route"] = route
+                    break
+        route = scope.get("route")
+        route_key = f"{scope['method']} {route.path}" if route is not None else None
+        try:
+            wait_ms = await self.wait_ms(self.caller_of(scope), route_key)
+        except RedisError as e:
+            # Better to serve everyone than no one while Redis is down
+            logger.warning("Admission check failed, admitting the request: %s", e)
+            return None
+        if wait_ms == 0:
+            return None
+        ADMISSION_REJECTED.inc(reason="rate_limit")
+        return JSONResponse({"detail": "Too many requests"}, status_code=429,
+                            headers={"Retry-After": str(max(1, math.ceil(wait_ms / 1000)))})
+
+
+class AdmissionMiddleware:
+    """ ASGI middleware answering requests over their limits or arriving during overload before they reach a route. """
+
+    def __init__(self, app, controller: Optional[AdmissionController] = None):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        controller = self.controller or admission_controller
+        if scope["type"] != "http" or not controller.enabled or scope["path"] in controller.exempt_paths:
+            await self.app(scope, receive, send)
+            return
+        rejection = await controller.admit(scope)
+        if rejection is not None:
+            await rejection(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
+
+
+# Admission controller of this worker
+admission_controller = AdmissionController()
@@ -0,0 +1,43 @@
+# Multi-row INSERT helpers for bulk package registration
+import os
+from typing import List
+from sqlalchemy import insert, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from app import models
+
+# Maximum number of packages written by a single multi-row INSERT statement
+BULK_INSERT_CHUNK_SIZE = int(os.getenv("BULK_INSERT_CHUNK_SIZE", "1000"))
+
+
+async def insert_packages(db: AsyncSession, rows: List[dict], chunk_size: int = BULK_INSERT_CHUNK_SIZE) -> List[int]:
+    """ Inserts packages with one multi-row INSERT per chunk and returns their ids in input order.
+
+    The caller is responsible for committing the session.
+    """
+    table = models.Package.__table__
+    dialect = db.get_bind().dialect
+    ids = []
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        if dialect.insert_returning:
+            result = await db.execute(insert(table).values(chunk).returning(table.c.id))
+            ids.extend(result.scalars().all())
+        else:
+            # MySQL has no RETURNING, but InnoDB gives the rows of a single multi-row INSERT (a "simple
+            # insert") auto-increment values without gaps, each auto_increment_increment after the
+            # previous one, and reports the first of them as LAST_INSERT_ID()
+            step = await auto_increment_increment(db)
+            result = await db.execute(insert(table).values(chunk))
+            ids.extend(range(result.lastrowid, result.lastrowid + len(chunk) * step, step))
+    return ids
+
+
+async def auto_increment_increment(db: AsyncSession) -> int:
+    """ Returns the auto_increment_increment of the session's MySQL connection, read once per connection. """
+    connection = await db.connection()
+    # The info dict lives as long as the pooled DBAPI connection; the setting is a session variable
+    # (e.g. raised by multi-primary replication), so it is read per connection
+    if "auto_increment_increment" not in connection.info:
+        connection.info["auto_increment_increment"] = (
+            await connection.execute(text("SELECT @@auto_increment_increment"))).scalar_one()
+    return connection.info["auto_increment_increment"]
@@ -0,0 +1,107 @@
+# Read-through Redis cache for package lookups
+import logging
+import os
+from typing import Iterable, Optional
+from redis.exceptions import RedisError
+from app import schemas
+from app.metrics import CACHE_REQUESTS
+from app.redis_client import redis_client
+
+logger = logging.getLogger(__name__)
+
+# Time to live (seconds) of cached entries; every entry expires, so with the volatile-lru
+# maxmemory policy configured in docker-compose.yml Redis evicts cache entries first under memory pressure
+PACKAGE_CACHE_TTL = int(os.getenv("PACKAGE_CACHE_TTL", "300"))
+# Time (milliseconds) after invalidating a package during which the cache is not filled with it: a
+# request that read the row before the invalidating write committed would otherwise store the old row
+# for PACKAGE_CACHE_TTL. It must outlast the time between reading a row and storing it
+PACKAGE_CACHE_INVALIDATION_MS = int(os.getenv("PACKAGE_CACHE_INVALIDATION_MS", "5000"))
+
+# Store a package unless it was invalidated lately (KEYS[2] is its invalidation marker)
+FILL_SCRIPT = """
+if redis.call('exists', KEYS[2]) == 1 then
+    return 0
+end
+redis.call('set', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return 1
+"""
+
+
+class PackageCache:
+    """ Caches serialized schemas.PackageRecord payloads in Redis.
+
+    Redis errors are logged and treated as cache misses, so an unavailable cache
+    only costs a database round-trip. An invalidation leaves a short-lived marker that
+    keeps rows read before it from being stored again (cache-aside race).
+    """
+
+    def __init__(self, client, package_ttl: int = PACKAGE_CACHE_TTL,
+                 invalidation_ms: int = PACKAGE_CACHE_INVALIDATION_MS):
+        self.client = client
+        self.package_ttl = package_ttl
+        self.invalidation_ms = invalidation_ms
+        self.hits = {"package": 0}
+        self.misses = {"package": 0}
+
+    @staticmethod
+    def package_key(package_id: int) -> str:
+        return f"cache:package:{package_id}"
+
+    @staticmethod
+    def invalidated_key(package_id: int) -> str:
+        return f"cache:package:{package_id}:invalidated"
+
+    async def _get(self, kind: str, key: str) -> Optional[bytes]:
+        try:
+            payload = await self.client.get(key)
+        except RedisError as e:
+            logger.warning("Cache lookup of %s failed: %s", key, e)
+            payload = None
+        if payload is None:
+            self.misses[kind] += 1
+            CACHE_REQUESTS.inc(kind=kind, result="miss")
+        else:
+            self.hits[kind] += 1
+            CACHE_REQUESTS.inc(kind=kind, result="hit")
+        return payload
+
+    async def get_package(self, package_id: int) -> Optional[schemas.PackageRecord]:
+        """ Returns the cached package or None on a miss. """
+        payload = await self._get("package", self.package_key(package_id))
+        return schemas.PackageRecord.model_validate_json(payload) if payload is not None else None
+
+    async def set_package(self, package: schemas.PackageRecord) -> bool:
+        """ Stores a package read from the database, unless it was invalidated lately; tells whether it was stored. """
+        key = self.package_key(package.id)
+        try:
+            return bool(await self.client.eval(FILL_SCRIPT, 2, key, self.invalidated_key(package.id),
+                                               package.model_dump_json(), self.package_ttl))
+        except RedisError as e:
+            logger.warning("Cache store of %s failed: %s", key, e)
+            return False
+
+    async def invalidate_packages(self, package_ids: Iterable[int]):
+        package_ids = list(package_ids)
+        if not package_ids:
+            return
+        try:
+            async with self.client.pipeline(transaction=False) as pipe:
+                for package_id in package_ids:
+                    # The marker goes first, so no fill can slip in between the two commands
+                    pipe.set(self.invalidated_key(package_id), 1, px=self.invalidation_ms)
+                    pipe.delete(self.package_key(package_id))
+                await pipe.execute()
+        except RedisError as e:
+            logger.warning("Cache invalidation of %d packages failed: %s", len(package_ids), e)
+
+    def stats(self) -> dict:
+        """ Returns the hit/miss counters of this process. """
+        return {kind: {"hits": self.hits[kind], "misses": self.misses[kind]} for kind in self.hits}
+
+
+# Cache shared by the endpoints of this process
+package_cache = PackageCache(redis_client)
+
+# Dependency that provides the package cache (overridden in tests with a local Redis stand-in)
+def get_package_cache() -> PackageCache:
+    return package_cache
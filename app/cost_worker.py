@@ -0,0 +1,142 @@
+# Event-driven delivery cost computation through a Redis stream
+import asyncio
+import logging
+import os
+import socket
+from typing import Iterable, List
+from redis.exceptions import RedisError, ResponseError
+from app import models
+from app.cache import package_cache
+from app.costs import price_packages
+from app.pricing import pricing_engine
+from app.rate_history import rate_history
+from app.rates import rate_provider
+from app.redis_client import redis_client
+from app.sharding import shard_router
+
+logger = logging.getLogger(__name__)
+
+# Stream of ids of registered packages that still need a delivery cost, and its consumer group
+COST_STREAM = os.getenv("COST_STREAM", "packages:cost_pending")
+COST_GROUP = "cost_workers"
+# Approximate number of entries kept in the stream
+COST_STREAM_MAXLEN = int(os.getenv("COST_STREAM_MAXLEN", "1000000"))
+# Largest micro-batch of packages updated by one UPDATE, and how long (ms) a worker waits for new entries
+COST_WORKER_BATCH_SIZE = int(os.getenv("COST_WORKER_BATCH_SIZE", "500"))
+COST_WORKER_BLOCK_MS = int(os.getenv("COST_WORKER_BLOCK_MS", "1000"))
+# Entries left unacknowledged this long (ms) by a dead consumer are taken over by another one
+COST_WORKER_CLAIM_IDLE_MS = int(os.getenv("COST_WORKER_CLAIM_IDLE_MS", "60000"))
+
+
+class CostQueue:
+    """ Producer side of the cost stream. """
+
+    def __init__(self, redis, stream: str = COST_STREAM, maxlen: int = COST_STREAM_MAXLEN):
+        self.redis = redis
+        self.stream = stream
+        self.maxlen = maxlen
+
+    async def enqueue(self, package_ids: Iterable[int]):
+        """ Queues packages for cost computation; on Redis errors the periodic job picks them up instead. """
+        package_ids = list(package_ids)
+        if not package_ids:
+            return
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for package_id in package_ids:
+                    pipe.xadd(self.stream, {"package_id": package_id}, maxlen=self.maxlen, approximate=True)
+                await pipe.execute()
+        except RedisError as e:
+            logger.warning("Queueing %d packages for cost computation failed: %s", len(package_ids), e)
+
+
+class CostStreamWorker:
+    """ Consumer group member that drains the cost stream in micro-batches.
+
+    Entries are acknowledged only after their UPDATE is committed, so a failed batch is
+    retried from this consumer's pending list, and entries of a dead consumer are claimed
+    after COST_WORKER_CLAIM_IDLE_MS.
+    """
+
+    def __init__(self, redis, provider, shards, cache=None, history=None, stream: str = COST_STREAM,
+                 group: str = COST_GROUP, consumer: str = None, batch_size: int = COST_WORKER_BATCH_SIZE,
+                 block_ms: int = COST_WORKER_BLOCK_MS, claim_idle_ms: int = COST_WORKER_CLAIM_IDLE_MS):
+        self.redis = redis
+        self.provider = provider
+        self.shards = shards
+        self.cache = cache
+        self.history = history
+        # Priced with the tariffs the rate history derives costs with, so both always agree
+        self.pricing = history.pricing if history is not None else pricing_engine
+        self.stream = stream
+        self.group = group
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        self.batch_size = batch_size
+        self.block_ms = block_ms
+        self.claim_idle_ms = claim_idle_ms
+
+    async def ensure_group(self):
+        try:
+            await self.redis.xgroup_create(self.stream, self.group, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def process_batch(self) -> int:
+        """ Processes one micro-batch and returns the number of updated packages. """
+        # Retry this consumer's unacknowledged entries first, then those abandoned by dead consumers
+        entries = await self._read("0", block=None)
+        if not entries:
+            _, entries, *_ = await self.redis.xautoclaim(self.stream, self.group, self.consumer,
+                                                         self.claim_idle_ms, start_id="0-0", count=self.batch_size)
+        if not entries:
+            entries = await self._read(">", block=self.block_ms)
+        if not entries:
+            return 0
+        entry_ids = [entry_id for entry_id, _ in entries]
+        package_ids = [int(fields[b"package_id"]) for _, fields in entries if fields]
+        updated = await self.update_costs(package_ids) if package_ids else 0
+        await self.redis.xack(self.stream, self.group, *entry_ids)
+        await self.redis.xdel(self.stream, *entry_ids)
+        return updated
+
+    async def _read(self, start: str, block):
+        response = await self.redis.xreadgroup(self.group, self.consumer, {self.stream: start},
+                                               count=self.batch_size, block=block)
+        return response[0][1] if response else []
+
+    async def update_costs(self, package_ids: List[int]) -> int:
+        usd_to_rub = await self.provider.get_rate()
+        updated = 0
+        # The ids tell which shard each package lives on; every shard is priced in its own transaction
+        for shard, shard_ids in self.shards.group_ids(package_ids).items():
+            async with shard.sessions() as db:
+                rate_version = await self.history.publish(db, usd_to_rub) if self.history is not None else None
+                updated += await price_packages(db, models.Package.id.in_(shard_ids), usd_to_rub, rate_version,
+                                                self.pricing)
+                await db.commit()
+        if self.cache is not None:
+            await self.cache.invalidate_packages(package_ids)
+        return updated
+
+    async def run_forever(self):
+        await self.ensure_group()
+        while True:
+            try:
+                await self.process_batch()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # The entries stay pending and are retried; the periodic job remains the safety net
+                logger.exception("Processing the cost stream failed")
+                await asyncio.sleep(self.block_ms / 1000)
+
+
+# Producer and consumer of this worker
+cost_queue = CostQueue(redis_client)
+cost_worker = CostStreamWorker(redis_client, rate_provider, shard_router, cache=package_cache,
+                               history=rate_history)
+
+# Dependency that provides the cost queue (overridden in tests with a local Redis stand-in)
+def get_cost_queue() -> CostQueue:
+    return cost_queue
@@ -0,0 +1,68 @@
+# Set-based delivery cost recomputation
+import os
+from typing import Optional
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from app import models
+from app.pricing import PricingEngine, pricing_engine
+from app.summaries import apply_deltas, pending_groups
+
+# Maximum number of packages updated by a single UPDATE statement (and held by a single transaction)
+DELIVERY_COST_BATCH_SIZE = int(os.getenv("DELIVERY_COST_BATCH_SIZE", "1000"))
+
+
+async def price_packages(db: AsyncSession, condition, usd_to_rub: float, rate_version: Optional[int] = None,
+                         pricing: PricingEngine = pricing_engine) -> int:
+    """ Writes the delivery cost of the packages matching condition that have none yet, and returns their number.
+
+    The per-user summaries are moved from pending to priced in the same transaction; the caller commits.
+    """
+    cost = pricing.cost_expression(usd_to_rub)
+    deltas = await pending_groups(db, condition, cost)
+    if not deltas:
+        return 0
+    result = await db.execute(update(models.Package)
+                              .where(condition, models.Package.delivery_cost.is_(None))
+                              .values(delivery_cost=cost, rate_version=rate_version,
+                                      version=models.Package.version + 1)
+                              .execution_options(synchronize_session=False))
+    await apply_deltas(db, deltas)
+    return result.rowcount
+
+
+async def recompute_delivery_costs(db: AsyncSession, usd_to_rub: float,
+                                   batch_size: int = DELIVERY_COST_BATCH_SIZE,
+                                   start_after: int = 0, end_at: Optional[int] = None, on_chunk=None,
+                                   rate_version: Optional[int] = None,
+                                   pricing: PricingEngine = pricing_engine) -> int:
+    """ Fills in missing delivery costs in id-ordered chunks and returns the number of updated packages.
+
+    Every chunk is one keyset SELECT of at most batch_size ids followed by one
+    UPDATE ... WHERE id BETWEEN, committed on its own, so memory use and lock time
+    do not grow with the backlog. Only ids in (start_after, end_at] are considered
+    (end_at=None means no upper bound). The optional on_chunk coroutine receives the ids
+    of every committed chunk; the last one can be stored and passed back as
+    start_after to resume an interrupted run. rate_version, if given, is recorded on the
+    updated packages as the version of usd_to_rub. The costs are computed in SQL with the tariffs of pricing.
+    """
+    updated = 0
+    last_id = start_after
+    while True:
+        # Find the next chunk of packages that still have no delivery cost
+        query = select(models.Package.id).where(models.Package.delivery_cost.is_(None), models.Package.id > last_id)
+        if end_at is not None:
+            query = query.where(models.Package.id <= end_at)
+        result = await db.execute(query.order_by(models.Package.id).limit(batch_size))
+        ids = result.scalars().all()
+        if not ids:
+            break
+        # Let the database compute and write the costs for the whole chunk at once
+        updated += await price_packages(db, models.Package.id.between(ids[0], ids[-1]), usd_to_rub, rate_version,
+                                        pricing)
+        await db.commit()
+        last_id = ids[-1]
+        if on_chunk is not None:
+            await on_chunk(ids)
+        if len(ids) < batch_size:
+            break
+    return updated
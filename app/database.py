@@ -1,16 +1,93 @@
 # Import necessary components from SQLAlchemy
 from sqlalchemy import create_engine
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+import itertools
+import logging
 import os
+import time
+from app.metrics import instrument_engine
+
+logger = logging.getLogger(__name__)
 
 # Retrieve the database URL from the environment variables
 # This URL specifies the database connection details (such as type, user, password, host, and database name)
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# Optional comma-separated URLs (sync driver, like DATABASE_URL) of read replicas of the primary database
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+
+# Connection pool settings, applied to every engine
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))  # Connections kept open per engine
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))  # Extra connections opened under load
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))  # Seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # Seconds before a connection is replaced
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"  # Test connections when they are checked out
+# Seconds a replica that failed to connect is skipped before it is tried again
+DB_REPLICA_RETRY_AFTER = float(os.getenv("DB_REPLICA_RETRY_AFTER", "30"))
+
+
+def to_async_url(url: str) -> str:
+    """ Returns the URL of the same database for its async driver (asyncmy for MySQL, aiosqlite for SQLite). """
+    return url.replace("pymysql", "asyncmy").replace("pysqlite", "aiosqlite")
+
+
+def pool_options(url: str) -> dict:
+    """ Returns the pool settings for an engine; in-memory SQLite has a single connection and takes none. """
+    if url.startswith("sqlite") and ":memory:" in url:
+        return {}
+    return {"pool_size": DB_POOL_SIZE, "max_overflow": DB_MAX_OVERFLOW, "pool_timeout": DB_POOL_TIMEOUT,
+            "pool_recycle": DB_POOL_RECYCLE, "pool_pre_ping": DB_POOL_PRE_PING}
+
+
+class MonitoredPool(AsyncAdaptedQueuePool):
+    """ Async queue pool that keeps track of the callers waiting for a connection, read by load shedding. """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.waiting = 0  # Callers currently waiting for a connection
+        self.last_wait = 0.0  # Seconds the latest caller waited
+        self.last_wait_at = 0.0  # When (time.monotonic) it got its connection
+
+    def capacity(self) -> int:
+        """ Returns the number of connections the pool opens at most. """
+        return self.size() + max(self._max_overflow, 0)
+
+    def _do_get(self):
+        started = time.monotonic()
+        self.waiting += 1
+        try:
+            return super()._do_get()
+        finally:
+            self.waiting -= 1
+            self.last_wait_at = time.monotonic()
+            self.last_wait = self.last_wait_at - started
+
+
+# Async engines of this worker, whose pools are watched by the admission control (app.admission)
+async_engines = []
+
+
+def create_pooled_async_engine(async_url: str) -> AsyncEngine:
+    """ Creates an async engine with the pool settings above and registers it in async_engines. """
+    options = pool_options(async_url)
+    if options:
+        options["poolclass"] = MonitoredPool
+    async_engine = create_async_engine(async_url, **options)
+    async_engines.append(async_engine)
+    return async_engine
+
+
+# The request path talks to the same database through an async driver (asyncmy for MySQL,
+# aiosqlite for the SQLite databases used by the benchmarks); it can also be set explicitly
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or to_async_url(DATABASE_URL)
+
 # Create an SQLAlchemy engine instance
 # The engine is responsible for managing connections to the database and executing SQL queries
-engine = create_engine(DATABASE_URL)
+engine = create_engine(DATABASE_URL, **pool_options(DATABASE_URL))
 
 # Create a configured "Session" class using the sessionmaker function
 # autocommit=False means the session does not automatically commit transactions (you need to call commit manually)
@@ -18,6 +95,78 @@ engine = create_engine(DATABASE_URL)
 # bind=engine associates this session with the engine we created
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Create an asynchronous engine and session class for the API endpoints
+# expire_on_commit=False keeps loaded attributes usable after commit, so a response can be built
+# from an ORM object without triggering a lazy (and, in async mode, forbidden) refresh
+async_engine = create_pooled_async_engine(ASYNC_DATABASE_URL)
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False, class_=AsyncSession)
+
+# Record query counts and durations of both engines for the /metrics endpoint
+instrument_engine(engine, "sync")
+instrument_engine(async_engine.sync_engine, "async")
+
+
+class SessionRouter:
+    """ Sends read-only work to the replicas in round-robin order and everything else to the primary.
+
+    A replica whose connection attempt fails is skipped for retry_after seconds; when no
+    replica is usable, reads go to the primary.
+    """
+
+    def __init__(self, primary: async_sessionmaker, replicas=(), retry_after: float = DB_REPLICA_RETRY_AFTER,
+                 clock=time.monotonic):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.retry_after = retry_after
+        self.clock = clock
+        self._next = itertools.count()
+        self._unhealthy_until = [0.0] * len(self.replicas)
+
+    def read_candidates(self):
+        """ Yields (index, session factory) of the healthy replicas, starting with the next one in turn. """
+        if not self.replicas:
+            return
+        start = next(self._next)
+        now = self.clock()
+        for offset in range(len(self.replicas)):
+            index = (start + offset) % len(self.replicas)
+            if self._unhealthy_until[index] <= now:
+                yield index, self.replicas[index]
+
+    def mark_unhealthy(self, index: int):
+        self._unhealthy_until[index] = self.clock() + self.retry_after
+
+    async def read_session(self) -> AsyncSession:
+        """ Returns a session on a healthy replica with a connection already checked out, or a primary session. """
+        for index, factory in self.read_candidates():
+            db = factory()
+            try:
+                await db.connection()
+            except (DBAPIError, OSError) as e:
+                await db.close()
+                logger.warning("Replica %d is unavailable, skipping it for %.0fs: %s", index, self.retry_after, e)
+                self.mark_unhealthy(index)
+                continue
+            db.info["replica"] = index
+            return db
+        return self.primary()
+
+
+def reads_replica(db: AsyncSession) -> bool:
+    """ Tells whether a session of SessionRouter.read_session reads from a replica, which may lag behind. """
+    return "replica" in db.info
+
+
+# Read replicas of this worker, each with its own async engine
+replica_engines = [create_pooled_async_engine(to_async_url(url)) for url in DATABASE_REPLICA_URLS]
+for replica_index, replica_engine in enumerate(replica_engines):
+    instrument_engine(replica_engine.sync_engine, f"replica{replica_index}")
+session_router = SessionRouter(
+    AsyncSessionLocal,
+    [async_sessionmaker(replica_engine, expire_on_commit=False, class_=AsyncSession)
+     for replica_engine in replica_engines],
+)
+
 # Create a base class for declarative class definitions
 # This Base class is used to define all the ORM models (i.e., the tables and their structure)
 Base = declarative_base()
@@ -30,3 +179,17 @@ def get_db():
         yield db
     finally:
         db.close()
+
+# Async counterpart of get_db used by the API endpoints
+# Each request gets its own AsyncSession on the primary, which is closed when the request is finished
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+# Dependency for read-only endpoints: a session on a replica when replicas are configured
+async def get_read_db():
+    db = await session_router.read_session()
+    try:
+        yield db
+    finally:
+        await db.close()
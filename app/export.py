@@ -0,0 +1,83 @@
+# Streaming export of packages as NDJSON or CSV
+import csv
+import io
+import os
+from typing import AsyncIterator, Optional, Sequence
+from sqlalchemy import false, not_, or_, select
+from app import models, schemas
+from app.database import SessionRouter
+from app.rate_history import PACKAGE_ROW_COLUMNS, RateHistory
+from app.responses import dumps
+
+# Rows fetched from the server-side cursor, priced and encoded at a time
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "5000"))
+
+# Fields of an exported package, in the order of schemas.Package
+EXPORT_FIELDS = tuple(schemas.Package.model_fields)
+
+MEDIA_TYPES = {
+    schemas.ExportFormat.ndjson: "application/x-ndjson",
+    schemas.ExportFormat.csv: "text/csv; charset=utf-8",
+}
+
+
+def filter_packages(query, user_id: Optional[int] = None, package_type: int = -1,
+                    calculated_value: schemas.PackageValueStatus = schemas.PackageValueStatus.any,
+                    derives_every_cost: bool = False):
+    """ Restricts a packages query to a user, a package type and a delivery cost status.
+
+    A cost is calculated when it is stored or can be derived from the rate version of the package,
+    as RateHistory.price_rows does; with derives_every_cost (lazy mode once a rate is published)
+    every package has one.
+    """
+    if user_id is not None:
+        query = query.filter(models.Package.user_id == user_id)
+    if package_type > -1:
+        query = query.filter(models.Package.type_id == package_type)
+    priced = or_(models.Package.delivery_cost.is_not(None), models.Package.rate_version.is_not(None))
+    if calculated_value == schemas.PackageValueStatus.calculated and not derives_every_cost:
+        query = query.filter(priced)
+    elif calculated_value == schemas.PackageValueStatus.pending:
+        query = query.filter(false() if derives_every_cost else not_(priced))
+    return query
+
+
+def encode_ndjson(packages) -> bytes:
+    return b"".join(dumps(package) + b"\n" for package in packages)
+
+
+def encode_csv(packages) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerows([package[field] for field in EXPORT_FIELDS] for package in packages)
+    return buffer.getvalue().encode("utf-8")
+
+
+async def export_packages(routers: Sequence[SessionRouter], history: RateHistory,
+                          export_format: schemas.ExportFormat, batch_size: int = EXPORT_BATCH_SIZE,
+                          **filters) -> AsyncIterator[bytes]:
+    """ Yields the matching packages of the shards read through routers, encoded, one batch of rows at a time.
+
+    Rows are read through a server-side cursor (stream_results), so memory use does not
+    depend on how many packages are exported. The generator opens its own sessions, as it
+    keeps running after the endpoint has returned its StreamingResponse. Shards are read one
+    after another in index order, which keeps the whole export in id order. Rates are looked up
+    through a second session: the first one cannot run queries while its cursor is open (MySQL
+    streams the rows over the connection unbuffered).
+    """
+    encode = encode_ndjson if export_format == schemas.ExportFormat.ndjson else encode_csv
+    if export_format == schemas.ExportFormat.csv:
+        yield (",".join(EXPORT_FIELDS) + "\n").encode("utf-8")
+    for router in routers:
+        db = await router.read_session()
+        rates_db = await router.read_session()
+        try:
+            query = filter_packages(select(*PACKAGE_ROW_COLUMNS), **filters,
+                                    derives_every_cost=await history.derives_every_cost(rates_db))
+            query = query.order_by(models.Package.id)
+            result = await db.stream(query.execution_options(yield_per=batch_size))
+            async for rows in result.partitions():
+                yield encode(await history.price_rows(rates_db, rows))
+        finally:
+            await db.close()
+            await rates_db.close()
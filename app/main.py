@@ -1,65 +1,195 @@
 # Import the FastAPI class from the fastapi module
 from fastapi import FastAPI
-from app.database import Base, engine
-from app.models import register_package_types
-from app.routers import package
-from fastapi_utils.tasks import repeat_every
-import redis
-import httpx
+from fastapi.responses import PlainTextResponse
+from app.routers import admin, package
+import asyncio
 import json
+import logging
+import os
+import time
+from typing import Optional
+from sqlalchemy import func, select
 from app import models, schemas, database, routers
-from app.database import SessionLocal
+from app.costs import recompute_delivery_costs
+from app.cache import package_cache
+from app.rate_history import rate_history
+from app.rates import rate_provider
+from app.redis_client import redis_client
+from app.scheduler import JobContext, JobScheduler, id_range_partition
+from app.cost_worker import cost_worker
+from app.package_types import package_type_registry
+from app.registration import group_committer
+from app.sharding import Shard, create_schema, id_base, shard_router
+from app.admission import AdmissionMiddleware
+from app.profiling import ProfilingMiddleware, live_profiler
+from app.metrics import MetricsMiddleware, WORKER_STARTUP_DURATION, registry
+from app.rates import RateUnavailableError
+import app as app_package
 
-models.Base.metadata.create_all(bind=database.engine)
+logger = logging.getLogger(__name__)
+
+# How the schema gets in place: "migrations" expects `python -m app.migrate` to have run before the
+# workers start; "create_all" makes every worker create missing tables and register the package types
+# at startup, which is convenient for a local run but repeats the work in every worker
+DB_SCHEMA_SETUP = os.getenv("DB_SCHEMA_SETUP", "migrations")
 
 app = FastAPI(docs_url="/documentation", redoc_url="/redoc")
 
-redis_client = redis.Redis(host='redis', port=6379, db=0)
+# Profile a sample of the requests, and those carrying the profile token (PROFILE_SAMPLE_RATE, PROFILE_TOKEN)
+app.add_middleware(ProfilingMiddleware)
+
+# Reject requests over their caller's or route's limits and shed load when the database pools fill up
+# (ADMISSION_CONTROL); added first so the metrics middleware wrapping it counts the rejections
+app.add_middleware(AdmissionMiddleware)
+
+# Record per-route latency, status codes and SQL activity of every request
+app.add_middleware(MetricsMiddleware)
+
+# Redis key holding the id of the last package processed by an unfinished delivery cost run
+DELIVERY_COSTS_CHECKPOINT_KEY = "delivery_costs_checkpoint"
+
+# Interval (seconds) of the delivery cost job and the number of id ranges its backlog is split into
+DELIVERY_COSTS_INTERVAL = float(os.getenv("DELIVERY_COSTS_INTERVAL", "300"))
+DELIVERY_COSTS_PARTITIONS = int(os.getenv("DELIVERY_COSTS_PARTITIONS", "1"))
+
+# Periodic jobs of this worker; Redis leases make sure each runs once per interval across all workers
+scheduler = JobScheduler(redis_client)
 
 # Fetch and cache the exchange rate
 async def fetch_exchange_rate():
     """ Fetches the current USD to RUB exchange rate and stores it in a Redis cache."""
-    async with httpx.AsyncClient() as client:
-        response = await client.get("https://www.cbr-xml-daily.ru/daily_json.js")
-        data = response.json()
-        usd_to_rub = data['Valute']['USD']['Value']
-        redis_client.set("usd_to_rub", usd_to_rub)
-        return usd_to_rub
+    return await rate_provider.refresh()
 
 @app.on_event("startup")
 def on_startup():
-    """Initializes the application on startup by creating all database tables and registering package types."""
-    # Create all tables in the database based on the above models
-    Base.metadata.create_all(bind=engine)
-    # Ensure all package types are registered in the database
-    register_package_types()
+    """Creates the database tables and registers the package types when the schema is not migrated separately."""
+    if DB_SCHEMA_SETUP == "create_all":
+        # Create all tables based on the above models, register all package types and set the id range,
+        # in every shard
+        for shard in shard_router:
+            create_schema(shard)
+
+@app.on_event("startup")
+async def load_package_types():
+    """Loads the package types before serving, so validating a request never queries the database."""
+    # Without Redis the copy is loaded unversioned; the listener reloads it once Redis is back
+    await package_type_registry.load()
 
 # Update delivery costs every 5 mins
+async def update_delivery_costs(context: Optional[JobContext] = None) -> int:
+    """Updates the delivery costs for packages (of one id range partition when run by the scheduler)."""
+    context = context or JobContext()
+    usd_to_rub = await rate_provider.get_rate()
+    async with shard_router.shards[0].sessions() as db:
+        # Publishing the rate is all a rate change costs; in lazy mode reads derive the costs from it
+        rate_version = await rate_history.publish(db, usd_to_rub)
+    if rate_history.lazy:
+        return 0
+    # Scatter the run over the shards, which work through their backlogs at the same time, and add up the rows
+    rows = await shard_router.gather(
+        lambda shard: update_shard_delivery_costs(shard, context, usd_to_rub, rate_version))
+    return sum(rows)
+
+async def update_shard_delivery_costs(shard: Shard, context: JobContext, usd_to_rub: float, rate_version: int) -> int:
+    """Updates the delivery costs for the packages of one shard (in the id range partition of the run)."""
+    checkpoint_key = DELIVERY_COSTS_CHECKPOINT_KEY
+    if context.partitions > 1:
+        checkpoint_key += f":{context.partition}"
+    if shard.index > 0:
+        checkpoint_key += f":shard{shard.index}"
+
+    async def save_checkpoint(ids):
+        # Fenced by the lease of the run: a worker that lost it cannot move a newer holder's checkpoint
+        await context.write(redis_client, checkpoint_key, ids[-1])
+        # Cached copies of these packages still have no delivery cost
+        await package_cache.invalidate_packages(ids)
+        # Stop between chunks if another worker has taken over this partition
+        await context.check()
+
+    async with shard.sessions() as db:
+        # The ids of a shard start right after its base
+        start_after, end_at = id_base(shard.index), None
+        if context.partitions > 1:
+            max_id = (await db.execute(select(func.max(models.Package.id)))).scalar() or start_after
+            start_after, end_at = id_range_partition(max_id, context.partition, context.partitions, start_after)
+        # Resume after the last committed chunk if a previous run was interrupted
+        checkpoint = await redis_client.get(checkpoint_key)
+        if checkpoint is not None and start_after < int(checkpoint) and (end_at is None or int(checkpoint) <= end_at):
+            start_after = int(checkpoint)
+        rows = await recompute_delivery_costs(db, usd_to_rub, start_after=start_after, end_at=end_at,
+                                              on_chunk=save_checkpoint, rate_version=rate_version,
+                                              pricing=rate_history.pricing)
+    # The backlog is drained, so the next run starts a full sweep again
+    await context.write(redis_client, checkpoint_key)
+    return rows
+
+# Runs can be profiled on demand through POST /admin/profiles/jobs/update_delivery_costs
+scheduler.add_job("update_delivery_costs", live_profiler.job("update_delivery_costs", update_delivery_costs),
+                  DELIVERY_COSTS_INTERVAL, partitions=DELIVERY_COSTS_PARTITIONS)
+
+# Background task draining the stream of packages registered without a delivery cost
+cost_worker_task: Optional[asyncio.Task] = None
+# Background task following the package type changes announced by other workers
+package_types_task: Optional[asyncio.Task] = None
+
 @app.on_event("startup")
-@repeat_every(seconds=300)  # 5 minutes
-async def update_delivery_costs():
-    """Periodically updates the delivery costs for packages."""
-    db = SessionLocal()
+async def start_background_tasks():
+    """Starts the periodic jobs, the cost stream worker and the package type listener of this worker."""
+    global cost_worker_task, package_types_task
+    scheduler.start()
+    cost_worker_task = asyncio.ensure_future(cost_worker.run_forever())
+    package_types_task = asyncio.ensure_future(package_type_registry.run_forever())
+
+# Background task fetching the first exchange rate of this worker
+warm_up_task: Optional[asyncio.Task] = None
+
+async def warm_up_exchange_rate():
+    """Loads the exchange rate once; until it arrives, registered packages are priced by the cost worker."""
     try:
-        usd_to_rub = redis_client.get("usd_to_rub")
-        if usd_to_rub is None:
-            usd_to_rub = await fetch_exchange_rate()
-        else:
-            usd_to_rub = float(usd_to_rub)
-
-        packages = db.query(models.Package).filter(models.Package.delivery_cost.is_(None)).all()
-        for package in packages:
-            delivery_cost = (package.weight * 0.5 + package.value * 0.01) * usd_to_rub
-            package.delivery_cost = delivery_cost
-        db.commit()
-    finally:
-        db.close()
-
-# Fetch exchange rate at startup
+        # Through the copy shared in Redis: starting N workers fetches from upstream once, not N times
+        await rate_provider.get_rate()
+    except RateUnavailableError as e:
+        logger.warning("Exchange rate warm-up failed, it will be fetched on first use: %s", e)
+
+# Warm the exchange rate in the background, so a slow or unreachable upstream does not delay startup
 @app.on_event("startup")
 async def startup_event():
-    await fetch_exchange_rate()
+    global warm_up_task
+    warm_up_task = asyncio.ensure_future(warm_up_exchange_rate())
+    # Registered last, so this is the time until the worker accepts requests
+    ready = time.perf_counter() - app_package.IMPORT_STARTED
+    WORKER_STARTUP_DURATION.observe(ready, phase="ready")
+    logger.info("Worker %d ready in %.3fs (import %.3fs)", os.getpid(), ready, IMPORT_DURATION)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stops the background tasks and closes the HTTP client, the database pools and the Redis connections."""
+    # Write the registrations still waiting for their group commit
+    await group_committer.close()
+    await scheduler.stop()
+    for task in (cost_worker_task, package_types_task, warm_up_task):
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+    await rate_provider.aclose()
+    # Close the connections of this worker rather than leave them to time out on the servers
+    for async_engine in database.async_engines:
+        await async_engine.dispose()
+    for shard in shard_router:
+        shard.engine.dispose()
+    await redis_client.aclose()
+
+# Metrics of this worker in the Prometheus text format
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
 
 # Include the router from the package module
 # This registers the API endpoints defined in package.router with the main FastAPI application
 app.include_router(package.router)
+# Operator endpoints (profiles)
+app.include_router(admin.router)
+
+# Time from the first import of the app package until the application is built
+IMPORT_DURATION = time.perf_counter() - app_package.IMPORT_STARTED
+WORKER_STARTUP_DURATION.observe(IMPORT_DURATION, phase="import")
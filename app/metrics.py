@@ -0,0 +1,201 @@
+# In-process metrics in the Prometheus text exposition format
+import bisect
+import contextvars
+import threading
+import time
+from typing import Dict, Optional, Sequence, Tuple
+from sqlalchemy import event
+
+# Default latency buckets (seconds), from sub-millisecond Redis calls to slow job runs
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values)
+    pairs = [f'{name}="{value}"' for name, value in zip(names, escaped)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """ Monotonic counter with labels. """
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(tuple(str(labels[name]) for name in self.labelnames), 0)
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return "\n".join(lines)
+
+
+class Histogram:
+    """ Cumulative histogram with labels. """
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: per-bucket counts (the last one is +Inf), sum of observations
+        self._values: Dict[Tuple[str, ...], Tuple[list, list]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, amount: float, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, amount)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[index] += 1
+            total[0] += amount
+
+    def count(self, **labels) -> int:
+        values = self._values.get(tuple(str(labels[name]) for name in self.labelnames))
+        return sum(values[0]) if values else 0
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total[0]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return "\n".join(lines)
+
+
+class Registry:
+    """ Collection of metrics rendered together by the /metrics endpoint. """
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+# Metrics of this worker process
+registry = Registry()
+
+HTTP_REQUESTS = registry.counter("http_requests_total", "HTTP requests by route and status",
+                                 ("method", "route", "status"))
+HTTP_REQUEST_DURATION = registry.histogram("http_request_duration_seconds", "HTTP request latency by route",
+                                           ("method", "route"))
+DB_QUERY_DURATION = registry.histogram("db_query_duration_seconds", "SQL statement execution time", ("engine",))
+DB_QUERIES_PER_REQUEST = registry.histogram("db_queries_per_request", "SQL statements executed per HTTP request",
+                                            ("route",), buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100))
+DB_TIME_PER_REQUEST = registry.histogram("db_time_per_request_seconds", "SQL time spent per HTTP request",
+                                         ("route",))
+REDIS_COMMAND_DURATION = registry.histogram("redis_command_duration_seconds", "Redis command latency",
+                                            ("command",))
+REDIS_COMMAND_ERRORS = registry.counter("redis_command_errors_total", "Failed Redis commands", ("command",))
+EXCHANGE_RATE_FETCH_DURATION = registry.histogram("exchange_rate_fetch_duration_seconds",
+                                                  "Upstream exchange rate fetch latency", ("outcome",))
+CACHE_REQUESTS = registry.counter("cache_requests_total", "Lookup cache requests", ("kind", "result"))
+JOB_RUNS = registry.counter("job_runs_total", "Periodic job runs", ("job", "status"))
+JOB_DURATION = registry.histogram("job_duration_seconds", "Periodic job run time", ("job",))
+JOB_ROWS = registry.counter("job_rows_processed_total", "Rows processed by periodic jobs", ("job",))
+ADMISSION_REJECTED = registry.counter("admission_rejected_total",
+                                     "Requests rejected by admission control (rate_limit: 429, overload: 503)",
+                                     ("reason",))
+WORKER_STARTUP_DURATION = registry.histogram("worker_startup_seconds",
+                                             "Time from the first import of the app until imported / ready",
+                                             ("phase",))
+
+
+class RequestStats:
+    """ SQL activity of the request being served. """
+    __slots__ = ("queries", "db_time")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+
+
+# Stats of the request handled by the current task; None outside of HTTP requests
+current_request: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar("current_request",
+                                                                                          default=None)
+
+
+def instrument_engine(engine, name: str = "primary"):
+    """ Records the duration of every statement run by a (sync) SQLAlchemy engine. """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_started"].pop()
+        DB_QUERY_DURATION.observe(elapsed, engine=name)
+        stats = current_request.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_time += elapsed
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        # A failed statement never reaches after_cursor_execute
+        if context.connection is not None and context.connection.info.get("query_started"):
+            context.connection.info["query_started"].pop()
+
+
+class MetricsMiddleware:
+    """ ASGI middleware recording latency, status and SQL activity of every HTTP request. """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        stats = RequestStats()
+        token = current_request.set(stats)
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            current_request.reset(token)
+            # The router stores the matched route in the scope; use its template to keep label cardinality bounded
+            route = getattr(scope.get("route"), "path", "unmatched")
+            HTTP_REQUESTS.inc(method=scope["method"], route=route, status=status["code"])
+            HTTP_REQUEST_DURATION.observe(elapsed, method=scope["method"], route=route)
+            DB_QUERIES_PER_REQUEST.observe(stats.queries, route=route)
+            DB_TIME_PER_REQUEST.observe(stats.db_time, route=route)
@@ -0,0 +1,50 @@
+# Schema migrations and seed data of every shard, applied once per deployment before the API workers start
+#
+# Usage: python -m app.migrate
+import logging
+import os
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import inspect
+from app.models import seed_package_types
+from app.sharding import Shard, prepare_shard, shard_router
+
+logger = logging.getLogger(__name__)
+
+# Revision matching the schema the service created with metadata.create_all before it had migrations
+# (the original packages and package_types tables); the later revisions bring such a database up to date
+BASELINE_REVISION = "0001"
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def alembic_config() -> Config:
+    config = Config(os.path.join(ROOT, "alembic.ini"))
+    config.set_main_option("script_location", os.path.join(ROOT, "migrations"))
+    return config
+
+
+def migrate_shard(shard: Shard):
+    """ Upgrades the database of a shard to the latest revision, registers the package types and sets its id range. """
+    config = alembic_config()
+    with shard.engine.begin() as connection:
+        config.attributes["connection"] = connection
+        tables = inspect(connection).get_table_names()
+        if "packages" in tables and "alembic_version" not in tables:
+            # Created by create_all before the service had migrations: adopt it as the baseline
+            logger.info("Stamping existing schema of shard %d as revision %s", shard.index, BASELINE_REVISION)
+            command.stamp(config, BASELINE_REVISION)
+        command.upgrade(config, "head")
+        seed_package_types(connection)
+        prepare_shard(connection, shard.index)
+
+
+def migrate():
+    """ Upgrades every shard, the primary database first, to the latest revision. """
+    for shard in shard_router:
+        migrate_shard(shard)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    migrate()
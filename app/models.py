@@ -1,8 +1,8 @@
 # DB schema
-from sqlalchemy import Column, Integer, String, Float, ForeignKey
+from sqlalchemy import BigInteger, Column, Integer, String, Float, ForeignKey, Index, DateTime, func
 from sqlalchemy.orm import relationship
 
-from app.database import Base, SessionLocal
+from app.database import Base, engine
 
 # Define the database model for package types
 class PackageType(Base):
@@ -13,22 +13,76 @@ class PackageType(Base):
     id = Column(Integer, primary_key=True, index=True)  # Primary key, unique identifier
     name = Column(String(50), unique=True, index=True)  # Name of the package type, must be unique
 
+# Define the database model for the exchange rate history
+# Rows are never updated: a rate change is a new version
+class ExchangeRate(Base):
+    # Specify the name of the table in the database
+    __tablename__ = "exchange_rates"
+
+    # Define the columns in the table
+    id = Column(Integer, primary_key=True, index=True)  # Version of the rate, grows with every change
+    usd_to_rub = Column(Float(precision=53))  # USD to RUB rate, stored in double precision
+    created_at = Column(DateTime, server_default=func.now())  # When this version was published
+
 # Define the database model for packages
 class Package(Base):
     # Specify the name of the table in the database
     __tablename__ = "packages"
 
     # Define the columns in the table
-    id = Column(Integer, primary_key=True, index=True)  # Primary key, unique identifier
+    # Primary key, unique across shards: the high bits hold the index of the shard (see app.sharding).
+    # SQLite keeps INTEGER, the only type that makes the column the auto-incremented rowid
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, index=True)
     name = Column(String(100), index=True)  # Name of the package !!!! unique=True???
     weight = Column(Float)  # Weight of the package in some unit
     type_id = Column(Integer, ForeignKey("package_types.id"))  # Foreign key referencing PackageType
     value = Column(Float)  # Value of the package, e.g., in dollars
-    delivery_cost = Column(Float, nullable=True)
+    delivery_cost = Column(Float, nullable=True)  # Materialized delivery cost, NULL until it is written
+    # Exchange rate version the package is priced at; NULL means not pinned to a version yet
+    rate_version = Column(Integer, ForeignKey("exchange_rates.id"), nullable=True)
     # Define the relationship with the PackageType model
     # This allows access to the related PackageType object via `package.type`
     type = relationship("PackageType")
     user_id = Column(Integer, index=True)
+    # Incremented by every update of the row; the ETag of /package/{id} is derived from it
+    version = Column(Integer, nullable=False, server_default="1")
+
+    # Composite index serving /show: a user's packages (optionally of one type) in keyset order
+    # Composite index serving the name searches of a user's packages on MySQL (/search)
+    # On SQLite, AUTOINCREMENT lets a shard start its ids at its own range (sqlite_sequence)
+    __table_args__ = (
+        Index("ix_packages_user_id_type_id_id", "user_id", "type_id", "id"),
+        Index("ix_packages_user_id_name", "user_id", "name"),
+        {"sqlite_autoincrement": True},
+    )
+
+# Define the database model for the per-user package aggregates behind /summary
+# Maintained incrementally on every write (see app.summaries) and rebuilt with `python -m app.summaries rebuild`
+class PackageSummary(Base):
+    # Specify the name of the table in the database
+    __tablename__ = "package_summaries"
+
+    # Define the columns in the table
+    user_id = Column(Integer, primary_key=True, autoincrement=False)  # Owner of the packages
+    type_id = Column(Integer, ForeignKey("package_types.id"), primary_key=True, autoincrement=False)
+    packages = Column(Integer, nullable=False, default=0)  # Number of packages
+    total_weight = Column(Float(precision=53), nullable=False, default=0)  # Sum of their weights
+    total_value = Column(Float(precision=53), nullable=False, default=0)  # Sum of their values
+    total_delivery_cost = Column(Float(precision=53), nullable=False, default=0)  # Sum of materialized costs
+    # Packages without a materialized delivery cost, and the sums their cost is derived from
+    pending_packages = Column(Integer, nullable=False, default=0)
+    pending_weight = Column(Float(precision=53), nullable=False, default=0)
+    pending_value = Column(Float(precision=53), nullable=False, default=0)
+
+# Define the database model for the per-user change counters behind the ETags of /show
+# Incremented in the transaction of every write to a user's packages (see app.summaries)
+class UserVersion(Base):
+    # Specify the name of the table in the database
+    __tablename__ = "user_versions"
+
+    # Define the columns in the table
+    user_id = Column(Integer, primary_key=True, autoincrement=False)  # Owner of the packages
+    version = Column(BigInteger, nullable=False, default=0)  # Number of writes to the user's packages
 
 # Dictionary to map human-readable package type names to their corresponding IDs
 PACKAGE_TYPES = {
@@ -37,17 +91,30 @@ PACKAGE_TYPES = {
     "miscellaneous": 3
 }
 
-def register_package_types():
-    db = SessionLocal()
-    try:
-        for type_name, type_id in PACKAGE_TYPES.items():
-            existing_type = db.query(PackageType).filter_by(id=type_id).first()
-            if not existing_type:
-                db.add(PackageType(id=type_id, name=type_name))
-        db.commit()
-    except Exception as e:
-        db.rollback()  # Ensure the session is rolled back in case of an error
-        print(f"Error registering package types: {e}")
-    finally:
-        db.close()
+def insert_ignore(table, dialect_name: str):
+    """ Returns an INSERT into table that leaves rows whose primary key already exists untouched. """
+    if dialect_name == "mysql":
+        from sqlalchemy.dialects.mysql import insert
+        # Assigning the key to itself turns a duplicate key into a no-op
+        return insert(table).on_duplicate_key_update({column.name: column for column in table.primary_key})
+    if dialect_name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+        return insert(table).on_conflict_do_nothing()
+    if dialect_name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+        return insert(table).on_conflict_do_nothing()
+    raise NotImplementedError(f"No insert-or-ignore for the {dialect_name} dialect")
+
+def package_types_upsert(dialect_name: str):
+    """ Returns a single INSERT of all PACKAGE_TYPES that leaves already registered types untouched. """
+    rows = [{"id": type_id, "name": type_name} for type_name, type_id in PACKAGE_TYPES.items()]
+    return insert_ignore(PackageType.__table__, dialect_name).values(rows)
+
+def seed_package_types(connection):
+    """ Registers the package types through the given connection; safe to run any number of times. """
+    connection.execute(package_types_upsert(connection.dialect.name))
 
+def register_package_types(bind=None):
+    """ Registers the package types in the database of the given engine (the primary by default). """
+    with (bind or engine).begin() as connection:
+        seed_package_types(connection)
@@ -0,0 +1,139 @@
+# Registry of package types backed by the package_types table
+#
+# Usage: python -m app.package_types add NAME [--id ID]
+import argparse
+import asyncio
+import logging
+import os
+from typing import Dict, Optional
+from redis.exceptions import RedisError
+from sqlalchemy import select
+from app import models
+from app.database import AsyncSessionLocal, SessionLocal
+from app.redis_client import redis_client
+from app.sharding import ShardRouter, copy_to_shards, shard_router
+
+logger = logging.getLogger(__name__)
+
+# Redis channel announcing a change of the package types, and the counter versioning them
+PACKAGE_TYPES_CHANNEL = "package_types:changed"
+PACKAGE_TYPES_VERSION_KEY = "package_types:version"
+# Seconds between version checks that catch up with changes whose message was missed
+PACKAGE_TYPES_CHECK_INTERVAL = float(os.getenv("PACKAGE_TYPES_CHECK_INTERVAL", "60"))
+
+
+class PackageTypeRegistry:
+    """ In-process copy of the package_types table, read by validators and /types without a database hit.
+
+    Every change of the table increments a version counter in Redis and is announced on a
+    pub/sub channel; workers reload their copy when they see a version newer than theirs.
+    Pub/sub messages can be lost, so the counter is also checked periodically.
+    """
+
+    def __init__(self, redis, session_factory=AsyncSessionLocal, channel: str = PACKAGE_TYPES_CHANNEL,
+                 version_key: str = PACKAGE_TYPES_VERSION_KEY, check_interval: float = PACKAGE_TYPES_CHECK_INTERVAL,
+                 shards: ShardRouter = shard_router):
+        self.redis = redis
+        self.session_factory = session_factory
+        self.shards = shards
+        self.channel = channel
+        self.version_key = version_key
+        self.check_interval = check_interval
+        self._types: Optional[Dict[int, str]] = None
+        # Version of the loaded copy; -1 when it was loaded without knowing the version
+        self.version = -1
+
+    @property
+    def types(self) -> Dict[int, str]:
+        """ Returns the package type names by id, loading them on first use outside a started worker. """
+        if self._types is None:
+            # Workers load the types at startup (app.main); only scripts and tests get here, and load
+            # once through the sync engine, which would block the event loop of a worker
+            with SessionLocal() as db:
+                self._types = dict(db.execute(select(models.PackageType.id, models.PackageType.name)).all())
+        return self._types
+
+    def is_valid(self, type_id: int) -> bool:
+        return type_id in self.types
+
+    async def remote_version(self) -> int:
+        return int(await self.redis.get(self.version_key) or 0)
+
+    async def load(self):
+        """ Reloads the package types from the database. """
+        # Read the version first: a change committed after this point bumps it again and triggers another reload
+        try:
+            version = await self.remote_version()
+        except RedisError as e:
+            logger.warning("Package types version unavailable: %s", e)
+            version = -1
+        async with self.session_factory() as db:
+            result = await db.execute(select(models.PackageType.id, models.PackageType.name))
+            self._types = dict(result.all())
+        self.version = version
+
+    async def notify_changed(self) -> int:
+        """ Announces a change of the package_types table to every worker; call after committing it. """
+        version = await self.redis.incr(self.version_key)
+        await self.redis.publish(self.channel, version)
+        return version
+
+    async def add(self, name: str, type_id: Optional[int] = None) -> int:
+        """ Registers a new package type and returns its id. """
+        async with self.session_factory() as db:
+            package_type = models.PackageType(id=type_id, name=name)
+            db.add(package_type)
+            await db.commit()
+        # Packages of every shard reference their type
+        await copy_to_shards(self.shards, models.PackageType.__table__, [{"id": package_type.id, "name": name}])
+        await self.notify_changed()
+        await self.load()
+        return package_type.id
+
+    async def sync(self):
+        """ Reloads the package types if another worker changed them since they were loaded. """
+        if await self.remote_version() != self.version:
+            await self.load()
+
+    async def run_forever(self):
+        """ Follows the change announcements of other workers. """
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.subscribe(self.channel)
+                # Changes made before the subscription took effect would otherwise be missed
+                await self.sync()
+                while True:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=self.check_interval)
+                    if message is None or int(message["data"]) > self.version:
+                        await self.sync()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Following package type changes failed")
+                await asyncio.sleep(self.check_interval)
+            finally:
+                await pubsub.aclose()
+
+
+# Package types known to this worker
+package_type_registry = PackageTypeRegistry(redis_client)
+
+# Dependency that provides the package type registry
+def get_package_type_registry() -> PackageTypeRegistry:
+    return package_type_registry
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage package types without a redeploy.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    add = commands.add_parser("add", help="register a new package type")
+    add.add_argument("name")
+    add.add_argument("--id", type=int, default=None, help="id of the type (default: next free id)")
+    args = parser.parse_args()
+    type_id = asyncio.run(package_type_registry.add(args.name, args.id))
+    print(f"Registered package type {args.name!r} with id {type_id}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+# Opaque keyset cursors for paginated endpoints
+import base64
+import json
+from typing import Tuple
+from sqlalchemy import and_, or_
+from app import models
+
+
+def encode_cursor(type_id: int, package_id: int) -> str:
+    """ Encodes the (type_id, id) position of the last returned package as an opaque string. """
+    raw = json.dumps([type_id, package_id], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[int, int]:
+    """ Decodes a cursor produced by encode_cursor, raising ValueError if it is malformed. """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        type_id, package_id = json.loads(raw)
+    except Exception:
+        raise ValueError('Invalid cursor')
+    if not isinstance(type_id, int) or not isinstance(package_id, int):
+        raise ValueError('Invalid cursor')
+    return type_id, package_id
+
+
+def after_position(position: Tuple[int, int]):
+    """ Condition selecting the packages that come after a (type_id, id) position in keyset order. """
+    last_type_id, last_id = position
+    return or_(models.Package.type_id > last_type_id,
+               and_(models.Package.type_id == last_type_id, models.Package.id > last_id))
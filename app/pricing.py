@@ -0,0 +1,98 @@
+# Delivery cost tariffs per package type, applied to single packages, to arrays of quotes and in SQL
+import os
+from typing import Dict, List, NamedTuple, Optional, Sequence
+import numpy
+from sqlalchemy import case
+from app import models
+
+# Tariff of the package types without one of their own, as "per_kg/value_share"
+DELIVERY_TARIFF_DEFAULT = os.getenv("DELIVERY_TARIFF_DEFAULT", "0.5/0.01")
+# Optional per-type tariffs as "type=per_kg/value_share" separated by commas, where type is a name of
+# models.PACKAGE_TYPES or a type id, e.g. "electronics=0.5/0.02,clothing=0.4/0.01"
+DELIVERY_TARIFFS = os.getenv("DELIVERY_TARIFFS", "")
+
+
+class Tariff(NamedTuple):
+    per_kg: float  # USD per unit of weight
+    value_share: float  # Share of the declared value (USD) charged
+
+
+def parse_tariff(spec: str) -> Tariff:
+    per_kg, _, value_share = spec.partition("/")
+    return Tariff(float(per_kg), float(value_share or 0))
+
+
+def parse_tariffs(spec: str) -> Dict[int, Tariff]:
+    """ Parses DELIVERY_TARIFFS into tariffs by type id. """
+    tariffs = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        package_type, _, tariff = item.partition("=")
+        package_type = package_type.strip()
+        if package_type.isdigit():
+            type_id = int(package_type)
+        elif package_type in models.PACKAGE_TYPES:
+            type_id = models.PACKAGE_TYPES[package_type]
+        else:
+            raise ValueError(f"Unknown package type in DELIVERY_TARIFFS: {package_type!r}")
+        tariffs[type_id] = parse_tariff(tariff)
+    return tariffs
+
+
+class PricingEngine:
+    """ Computes delivery costs as (weight * per_kg + value * value_share) * usd_to_rub, with the tariff of the type.
+
+    A single package, arrays of quoted packages and the SQL expression of the cost job all
+    perform the same float operations in the same order, so a quote equals the cost later
+    stored for the same package at the same rate.
+    """
+
+    def __init__(self, tariffs: Optional[Dict[int, Tariff]] = None, default: Optional[Tariff] = None):
+        self.tariffs = tariffs if tariffs is not None else parse_tariffs(DELIVERY_TARIFFS)
+        self.default = default or parse_tariff(DELIVERY_TARIFF_DEFAULT)
+        # Coefficients indexed by type id, looked up for a whole array of type ids at once
+        size = max(self.tariffs, default=0) + 1
+        self._per_kg = numpy.array([self.tariff(type_id).per_kg for type_id in range(size)], dtype=numpy.float64)
+        self._value_share = numpy.array([self.tariff(type_id).value_share for type_id in range(size)],
+                                        dtype=numpy.float64)
+
+    def tariff(self, type_id: int) -> Tariff:
+        return self.tariffs.get(type_id, self.default)
+
+    def cost(self, weight: float, value: float, type_id: int, usd_to_rub: float) -> float:
+        """ Computes the delivery cost of one package (or of the sums of packages of one type). """
+        tariff = self.tariff(type_id)
+        return (weight * tariff.per_kg + value * tariff.value_share) * usd_to_rub
+
+    def quote(self, weights: Sequence[float], values: Sequence[float], type_ids: Sequence[int],
+              usd_to_rub: float) -> List[float]:
+        """ Computes the delivery costs of packages given as equally long arrays, without touching the database. """
+        type_ids = numpy.asarray(type_ids, dtype=numpy.int64)
+        # Types past the end of the table have no tariff of their own
+        known = (type_ids >= 0) & (type_ids < len(self._per_kg))
+        index = numpy.where(known, type_ids, 0)
+        per_kg = numpy.where(known, self._per_kg[index], self.default.per_kg)
+        value_share = numpy.where(known, self._value_share[index], self.default.value_share)
+        costs = (numpy.asarray(weights, dtype=numpy.float64) * per_kg +
+                 numpy.asarray(values, dtype=numpy.float64) * value_share) * usd_to_rub
+        return costs.tolist()
+
+    def cost_expression(self, usd_to_rub: float):
+        """ Returns the SQL expression computing a package's delivery cost for the given exchange rate. """
+        package = models.Package
+        if not self.tariffs:
+            return (package.weight * self.default.per_kg + package.value * self.default.value_share) * usd_to_rub
+        per_kg = case({type_id: tariff.per_kg for type_id, tariff in self.tariffs.items()},
+                      value=package.type_id, else_=self.default.per_kg)
+        value_share = case({type_id: tariff.value_share for type_id, tariff in self.tariffs.items()},
+                           value=package.type_id, else_=self.default.value_share)
+        return (package.weight * per_kg + package.value * value_share) * usd_to_rub
+
+
+# Pricing engine of this worker, shared by registration, the cost job, the cost worker and /quote
+pricing_engine = PricingEngine()
+
+# Dependency that provides the pricing engine
+def get_pricing_engine() -> PricingEngine:
+    return pricing_engine
@@ -0,0 +1,269 @@
+# Opt-in profiling of sampled live requests and of periodic job runs
+import cProfile
+import hmac
+import json
+import logging
+import marshal
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Awaitable, Callable, List, Optional, Tuple
+from redis.exceptions import RedisError
+from app.redis_client import redis_client
+
+logger = logging.getLogger(__name__)
+
+# Share of requests profiled at random (0 disables sampling)
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+# Secret that profiles any request carrying it in the X-Profile-Token header and unlocks /admin/profiles;
+# both are disabled while it is empty
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_TOKEN_HEADER = "x-profile-token"
+# "sampling": a thread records the stack of the event loop every PROFILE_SAMPLE_INTERVAL_MS (low overhead,
+# downloadable as collapsed stacks); "cprofile": deterministic cProfile (exact call counts, downloadable as pstats)
+PROFILE_MODE = os.getenv("PROFILE_MODE", "sampling")
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "2"))
+# Profiles kept in Redis, shared by all workers; the oldest is dropped when a new one comes in
+PROFILE_BUFFER_SIZE = int(os.getenv("PROFILE_BUFFER_SIZE", "50"))
+
+# Push a profile onto the ring buffer, dropping the profiles that fall off its end.
+# KEYS[1]: list of profile ids, newest first; KEYS[2]: hash of the new profile
+# ARGV: id, meta, data, capacity, key prefix of the profile hashes
+PUSH_SCRIPT = """
+redis.call('hset', KEYS[2], 'meta', ARGV[2], 'data', ARGV[3])
+redis.call('lpush', KEYS[1], ARGV[1])
+local capacity = tonumber(ARGV[4])
+for _, dropped in ipairs(redis.call('lrange', KEYS[1], capacity, -1)) do
+    redis.call('del', ARGV[5] .. dropped)
+end
+redis.call('ltrim', KEYS[1], 0, capacity - 1)
+return 1
+"""
+
+# Take one of the runs of a job requested to be profiled, if any is left
+TAKE_RUN_SCRIPT = """
+local left = tonumber(redis.call('get', KEYS[1]) or '0')
+if left > 0 then
+    redis.call('decr', KEYS[1])
+    return 1
+end
+return 0
+"""
+
+
+def collapse(frame) -> str:
+    """ Returns a stack as "outermost;...;innermost" frames, the input format of flamegraph tools. """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        name = getattr(code, "co_qualname", code.co_name)
+        names.append(f"{name} ({code.co_filename}:{code.co_firstlineno})".replace(";", ":"))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class StackSampler:
+    """ Statistical profiler: a background thread counts the stacks another thread is seen running. """
+
+    def __init__(self, thread_id: int, interval_ms: float = PROFILE_SAMPLE_INTERVAL_MS):
+        self.thread_id = thread_id
+        self.interval = interval_ms / 1000
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[collapse(frame)] += 1
+            del frame
+
+    def stop(self) -> Counter:
+        self._stopped.set()
+        self._thread.join()
+        return self.stacks
+
+
+class ProfileSession:
+    """ A profile being taken of the calling thread. """
+
+    def __init__(self, profile_id: int, kind: str, name: str, mode: str, interval_ms: float):
+        self.id = profile_id
+        self.kind = kind
+        self.name = name
+        self.mode = mode
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        if mode == "cprofile":
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            self._sampler = StackSampler(threading.get_ident(), interval_ms)
+            self._sampler.start()
+
+    def stop(self) -> Tuple[dict, bytes]:
+        """ Stops profiling and returns the metadata and the data of the profile. """
+        duration = time.perf_counter() - self._started
+        if self.mode == "cprofile":
+            self._profile.disable()
+            # Same bytes as pstats.Stats.dump_stats writes, so the download loads with pstats.Stats(path)
+            data, profile_format = marshal.dumps(pstats.Stats(self._profile).stats), "pstats"
+        else:
+            stacks = self._sampler.stop()
+            data = "".join(f"{stack} {count}\n" for stack, count in stacks.most_common()).encode()
+            profile_format = "collapsed"
+        meta = {"id": self.id, "kind": self.kind, "name": self.name, "format": profile_format,
+                "started_at": self.started_at, "duration": duration}
+        return meta, data
+
+
+class Profiler:
+    """ Decides what gets profiled, takes the profiles and keeps the latest ones in a Redis ring buffer.
+
+    Profiles of the event loop thread include whatever other tasks ran while they were taken, so
+    at most one profile is taken at a time per worker; requests sampled meanwhile run unprofiled.
+    """
+
+    def __init__(self, redis, sample_rate: float = PROFILE_SAMPLE_RATE, token: str = PROFILE_TOKEN,
+                 mode: str = PROFILE_MODE, interval_ms: float = PROFILE_SAMPLE_INTERVAL_MS,
+                 capacity: int = PROFILE_BUFFER_SIZE, key_prefix: str = "profiles"):
+        self.redis = redis
+        self.sample_rate = sample_rate
+        self.token = token
+        self.mode = mode
+        self.interval_ms = interval_ms
+        self.capacity = capacity
+        self.key_prefix = key_prefix
+        # Names of the jobs wrapped by job(), which can be asked to profile their next runs
+        self.jobs = set()
+        self._active = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0 or bool(self.token)
+
+    def authorized(self, token: Optional[str]) -> bool:
+        return bool(self.token) and token is not None and hmac.compare_digest(token, self.token)
+
+    def sampled(self) -> bool:
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def _key(self, suffix) -> str:
+        return f"{self.key_prefix}:{suffix}"
+
+    async def start(self, kind: str, name: str) -> Optional[ProfileSession]:
+        """ Starts profiling the calling task, or returns None if a profile is already being taken. """
+        if self._active:
+            return None
+        self._active = True
+        try:
+            profile_id = await self.redis.incr(self._key("next_id"))
+            return ProfileSession(profile_id, kind, name, self.mode, self.interval_ms)
+        except (RedisError, ValueError) as e:  # ValueError: another profiler is active (Python 3.12+)
+            logger.warning("Profiling %s %s failed to start: %s", kind, name, e)
+            self._active = False
+            return None
+
+    async def finish(self, session: ProfileSession, **meta) -> Optional[int]:
+        """ Stops a profile and stores it in the ring buffer, returning its id. """
+        try:
+            profile_meta, data = session.stop()
+        finally:
+            self._active = False
+        try:
+            await self.redis.eval(PUSH_SCRIPT, 2, self._key("index"), self._key(session.id), session.id,
+                                  json.dumps({**profile_meta, **meta}), data, self.capacity, self._key(""))
+        except RedisError as e:
+            logger.warning("Storing profile %d failed: %s", session.id, e)
+            return None
+        return session.id
+
+    async def recent(self) -> List[dict]:
+        """ Returns the metadata of the stored profiles, newest first. """
+        ids = await self.redis.lrange(self._key("index"), 0, -1)
+        metas = [await self.redis.hget(self._key(int(profile_id)), "meta") for profile_id in ids]
+        return [json.loads(meta) for meta in metas if meta is not None]
+
+    async def get(self, profile_id: int) -> Optional[Tuple[dict, bytes]]:
+        meta, data = await self.redis.hmget(self._key(profile_id), "meta", "data")
+        return (json.loads(meta), data) if meta is not None else None
+
+    async def profile_job_runs(self, job: str, runs: int):
+        """ Asks for the next runs of a job to be profiled, on whichever worker runs them. """
+        await self.redis.set(self._key(f"job:{job}"), runs)
+
+    def job(self, name: str, func: Callable[..., Awaitable]) -> Callable[..., Awaitable]:
+        """ Wraps a job so that the runs requested with profile_job_runs are profiled. """
+        self.jobs.add(name)
+
+        async def run(*args, **kwargs):
+            session = None
+            try:
+                if not self._active and await self.redis.eval(TAKE_RUN_SCRIPT, 1, self._key(f"job:{name}")):
+                    session = await self.start("job", name)
+                    if session is None:
+                        # A request is being profiled; leave the run for the next one
+                        await self.redis.incr(self._key(f"job:{name}"))
+            except RedisError as e:
+                logger.warning("Checking whether to profile job %s failed: %s", name, e)
+            if session is None:
+                return await func(*args, **kwargs)
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                await self.finish(session)
+
+        return run
+
+
+class ProfilingMiddleware:
+    """ ASGI middleware profiling a random sample of requests and those carrying the profile token. """
+
+    def __init__(self, app, profiler: Optional[Profiler] = None):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        profiler = self.profiler or live_profiler
+        if scope["type"] != "http" or not profiler.enabled or scope["path"].startswith("/admin/profiles"):
+            await self.app(scope, receive, send)
+            return
+        token = next((value.decode("latin-1") for name, value in scope["headers"]
+                      if name == PROFILE_TOKEN_HEADER.encode()), None)
+        session = None
+        if profiler.authorized(token) or profiler.sampled():
+            session = await profiler.start("request", f"{scope['method']} {scope['path']}")
+        if session is None:
+            await self.app(scope, receive, send)
+            return
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                # Tells the caller where to download the profile of its request
+                message["headers"] = list(message.get("headers", [])) + [(b"x-profile-id", str(session.id).encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # The router stores the matched route in the scope; its template groups profiles of the same endpoint
+            route = getattr(scope.get("route"), "path", scope["path"])
+            await profiler.finish(session, name=f"{scope['method']} {route}", status=status["code"])
+
+
+# Profiler of this worker
+live_profiler = Profiler(redis_client)
+
+# Dependency that provides the profiler
+def get_profiler() -> Profiler:
+    return live_profiler
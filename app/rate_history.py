@@ -0,0 +1,134 @@
+# Versioned exchange rates and delivery costs derived from them on read
+import os
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app import models, schemas
+from app.pricing import PricingEngine, pricing_engine
+from app.sharding import ShardRouter, copy_to_shards, shard_router
+
+# "eager": the cost job and the cost worker write delivery_cost for every package (materialized)
+# "lazy": delivery_cost stays NULL and is derived on read from the latest rate version,
+#         so a rate change is a single INSERT into exchange_rates
+DELIVERY_COST_MODE = os.getenv("DELIVERY_COST_MODE", "eager")
+# How long (seconds) a worker trusts its copy of the latest rate version
+RATE_VERSION_TTL = float(os.getenv("RATE_VERSION_TTL", "30"))
+
+# Columns of the tuples accepted by RateHistory.price_rows, selected instead of whole ORM entities
+PACKAGE_ROW_COLUMNS = (models.Package.id, models.Package.name, models.Package.weight, models.Package.type_id,
+                       models.Package.value, models.Package.user_id, models.Package.delivery_cost,
+                       models.Package.rate_version)
+
+
+class RateHistory:
+    """ Publishes exchange rates as immutable versions and prices packages against them.
+
+    Rates of known versions never change, so they are memoized per version for the
+    lifetime of the process; only the pointer to the latest version expires. With several
+    shards, versions are numbered by the first one and copied to the others before use.
+    """
+
+    def __init__(self, lazy: bool = DELIVERY_COST_MODE == "lazy", latest_ttl: float = RATE_VERSION_TTL,
+                 clock=time.monotonic, shards: Optional[ShardRouter] = None,
+                 pricing: PricingEngine = pricing_engine):
+        self.lazy = lazy
+        self.pricing = pricing
+        self.shards = shards
+        self.latest_ttl = latest_ttl
+        self.clock = clock
+        self._rates: Dict[int, float] = {}
+        self._latest: Optional[Tuple[int, float]] = None
+        self._latest_at = 0.0
+
+    def _remember_latest(self, version: int, usd_to_rub: float):
+        self._rates[version] = usd_to_rub
+        self._latest = (version, usd_to_rub)
+        self._latest_at = self.clock()
+
+    async def latest(self, db: AsyncSession) -> Optional[Tuple[int, float]]:
+        """ Returns (version, usd_to_rub) of the latest published rate, or None if there is none. """
+        if self._latest is None or self.clock() - self._latest_at >= self.latest_ttl:
+            result = await db.execute(select(models.ExchangeRate.id, models.ExchangeRate.usd_to_rub)
+                                      .order_by(models.ExchangeRate.id.desc()).limit(1))
+            row = result.first()
+            if row is None:
+                return None
+            self._remember_latest(row.id, row.usd_to_rub)
+        return self._latest
+
+    async def derives_every_cost(self, db: AsyncSession) -> bool:
+        """ Tells whether packages without a stored cost or a rate version get one on read (lazy mode). """
+        return self.lazy and await self.latest(db) is not None
+
+    async def publish(self, db: AsyncSession, usd_to_rub: float) -> int:
+        """ Returns the version of the given rate, inserting a new version if the rate changed. """
+        if self._latest is not None and self._latest[1] == usd_to_rub:
+            return self._latest[0]
+        latest = await self.latest(db)
+        if latest is not None and latest[1] == usd_to_rub:
+            return latest[0]
+        rate = models.ExchangeRate(usd_to_rub=usd_to_rub)
+        if self.shards is None or len(self.shards) == 1:
+            db.add(rate)
+            await db.commit()
+        else:
+            # Every shard must know the version before a package priced with it is written there
+            async with self.shards.shards[0].sessions() as first:
+                first.add(rate)
+                await first.commit()
+            await copy_to_shards(self.shards, models.ExchangeRate.__table__,
+                                 [{"id": rate.id, "usd_to_rub": usd_to_rub}])
+        self._remember_latest(rate.id, usd_to_rub)
+        return rate.id
+
+    async def rate(self, db: AsyncSession, version: int) -> float:
+        """ Returns the rate of a version, memoized after the first lookup. """
+        if version not in self._rates:
+            self._rates[version] = (await db.execute(select(models.ExchangeRate.usd_to_rub)
+                                                     .where(models.ExchangeRate.id == version))).scalar_one()
+        return self._rates[version]
+
+    async def price(self, db: AsyncSession, packages: Iterable[schemas.PackageRecord]) -> List[schemas.Package]:
+        """ Fills in delivery costs that are not materialized but can be derived from a rate version. """
+        priced = []
+        latest = None
+        for package in packages:
+            cost = package.delivery_cost
+            if cost is None:
+                if package.rate_version is not None:
+                    cost = self.pricing.cost(package.weight, package.value, package.type_id,
+                                             await self.rate(db, package.rate_version))
+                elif self.lazy:
+                    latest = latest or await self.latest(db)
+                    if latest is not None:
+                        cost = self.pricing.cost(package.weight, package.value, package.type_id, latest[1])
+            priced.append(schemas.Package(**package.model_dump(exclude={"delivery_cost", "rate_version", "version"}),
+                                          delivery_cost=cost))
+        return priced
+
+    async def price_rows(self, db: AsyncSession, rows: Iterable[tuple]) -> List[dict]:
+        """ Same as price for PACKAGE_ROW_COLUMNS tuples, returning plain dicts shaped like schemas.Package. """
+        priced = []
+        latest = None
+        for package_id, name, weight, type_id, value, user_id, cost, rate_version in rows:
+            if cost is None:
+                if rate_version is not None:
+                    cost = self.pricing.cost(weight, value, type_id, await self.rate(db, rate_version))
+                elif self.lazy:
+                    latest = latest or await self.latest(db)
+                    if latest is not None:
+                        cost = self.pricing.cost(weight, value, type_id, latest[1])
+            # Same keys, order and number types as schemas.Package would serialize
+            priced.append({"name": name, "weight": float(weight), "type_id": type_id, "value": float(value),
+                           "user_id": user_id, "id": package_id,
+                           "delivery_cost": float(cost) if cost is not None else None})
+        return priced
+
+
+# Rate versions known to this worker
+rate_history = RateHistory(shards=shard_router)
+
+# Dependency that provides the rate history
+def get_rate_history() -> RateHistory:
+    return rate_history
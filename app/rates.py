@@ -0,0 +1,169 @@
+# USD to RUB exchange rate provider
+import asyncio
+import logging
+import os
+import time
+from typing import Optional, Tuple
+import httpx
+from redis.exceptions import RedisError
+from app.metrics import EXCHANGE_RATE_FETCH_DURATION
+from app.redis_client import redis_client
+
+logger = logging.getLogger(__name__)
+
+# How long (seconds) a fetched rate stays fresh: in the copy shared through Redis, which expires then,
+# and in the in-process copies of the workers, counted from the upstream fetch
+RATE_TTL = float(os.getenv("RATE_TTL", "300"))
+# Timeout (seconds) of a single request to the upstream rate source
+RATE_FETCH_TIMEOUT = float(os.getenv("RATE_FETCH_TIMEOUT", "5"))
+# Bounds (seconds) of the exponential backoff applied after upstream failures
+RATE_BACKOFF_BASE = float(os.getenv("RATE_BACKOFF_BASE", "1"))
+RATE_BACKOFF_MAX = float(os.getenv("RATE_BACKOFF_MAX", "300"))
+
+
+class RateUnavailableError(Exception):
+    """ Raised when no exchange rate is known and the upstream source cannot provide one. """
+
+
+class CBRRateSource:
+    """ Reads the USD to RUB rate from the daily JSON feed of the Central Bank of Russia.
+
+    The HTTP client is created once and reused, so its connection pool survives between fetches.
+    """
+
+    URL = "https://www.cbr-xml-daily.ru/daily_json.js"
+
+    def __init__(self, client: Optional[httpx.AsyncClient] = None, timeout: float = RATE_FETCH_TIMEOUT):
+        self._client = client
+        self._timeout = timeout
+
+    async def fetch(self) -> float:
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=self._timeout)
+        response = await self._client.get(self.URL)
+        response.raise_for_status()
+        return float(response.json()['Valute']['USD']['Value'])
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class ExchangeRateProvider:
+    """ Serves the USD to RUB rate from an in-process copy backed by Redis and an upstream source.
+
+    A fresh in-process copy is returned immediately. A stale one is still returned while a
+    single background refresh revalidates it. Without any copy, callers wait for the refresh,
+    and concurrent callers share it (single flight). Failed upstream fetches are retried with
+    exponential backoff. Any object with an async fetch() -> float method can act as the source.
+    """
+
+    REDIS_KEY = "usd_to_rub"
+
+    def __init__(self, source, redis, ttl: float = RATE_TTL, backoff_base: float = RATE_BACKOFF_BASE,
+                 backoff_max: float = RATE_BACKOFF_MAX, clock=time.monotonic):
+        self.source = source
+        self.redis = redis
+        self.ttl = ttl
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.clock = clock
+        self._rate: Optional[float] = None
+        self._fetched_at = 0.0
+        self._failures = 0
+        self._retry_at = 0.0
+        self._inflight: Optional[asyncio.Task] = None
+
+    def peek(self) -> Optional[float]:
+        """ Returns the in-process rate if it is still fresh, without any I/O. """
+        if self._rate is not None and self.clock() - self._fetched_at < self.ttl:
+            return self._rate
+        return None
+
+    async def get_rate(self) -> float:
+        """ Returns the current rate, serving a stale copy while it is being revalidated. """
+        if self._rate is not None:
+            if self.clock() - self._fetched_at >= self.ttl and self.clock() >= self._retry_at:
+                self._start_refresh(use_shared=True)
+            return self._rate
+        return await asyncio.shield(self._start_refresh(use_shared=True))
+
+    async def refresh(self) -> float:
+        """ Fetches the rate from the upstream source, bypassing both caches. """
+        return await asyncio.shield(self._start_refresh(use_shared=False))
+
+    def _start_refresh(self, use_shared: bool) -> asyncio.Task:
+        # Coalesce concurrent refreshes into the one already running
+        if self._inflight is None or self._inflight.done():
+            self._inflight = asyncio.ensure_future(self._load(use_shared))
+            self._inflight.add_done_callback(self._consume_exception)
+        return self._inflight
+
+    @staticmethod
+    def _consume_exception(task: asyncio.Task):
+        # Background revalidations nobody awaits must not log "exception was never retrieved"
+        if not task.cancelled():
+            task.exception()
+
+    async def _load(self, use_shared: bool) -> float:
+        shared = await self._read_shared() if use_shared else None
+        if shared is not None:
+            rate, remaining = shared
+            # The shared copy is as old as its upstream fetch, not as this read
+            fetched_at = self.clock() - (self.ttl - remaining)
+        else:
+            if self.clock() < self._retry_at:
+                raise RateUnavailableError("Exchange rate source is backing off after failures")
+            started = time.perf_counter()
+            try:
+                rate = await self.source.fetch()
+                EXCHANGE_RATE_FETCH_DURATION.observe(time.perf_counter() - started, outcome="success")
+            except Exception as e:
+                EXCHANGE_RATE_FETCH_DURATION.observe(time.perf_counter() - started, outcome="failure")
+                self._failures += 1
+                delay = min(self.backoff_base * 2 ** (self._failures - 1), self.backoff_max)
+                self._retry_at = self.clock() + delay
+                logger.warning("Exchange rate fetch failed (retry in %.0fs): %s", delay, e)
+                raise RateUnavailableError(str(e)) from e
+            self._failures = 0
+            self._retry_at = 0.0
+            fetched_at = self.clock()
+            await self._write_shared(rate)
+        self._rate = rate
+        self._fetched_at = fetched_at
+        return rate
+
+    async def _read_shared(self) -> Optional[Tuple[float, float]]:
+        """ Returns the shared rate and the seconds it stays fresh, or None if no worker fetched it lately. """
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                value, remaining_ms = await pipe.get(self.REDIS_KEY).pttl(self.REDIS_KEY).execute()
+        except RedisError as e:
+            logger.warning("Reading the shared exchange rate failed: %s", e)
+            return None
+        if value is None:
+            return None
+        # A rate set by hand without expiry counts as just fetched
+        remaining = min(remaining_ms / 1000, self.ttl) if remaining_ms >= 0 else self.ttl
+        return float(value), remaining
+
+    async def _write_shared(self, rate: float):
+        try:
+            await self.redis.set(self.REDIS_KEY, rate, px=int(self.ttl * 1000))
+        except RedisError as e:
+            logger.warning("Storing the shared exchange rate failed: %s", e)
+
+    async def aclose(self):
+        if self._inflight is not None and not self._inflight.done():
+            self._inflight.cancel()
+        if hasattr(self.source, "aclose"):
+            await self.source.aclose()
+
+
+# Exchange rate shared by the delivery cost computations of this worker
+rate_provider = ExchangeRateProvider(CBRRateSource(), redis_client)
+
+# Dependency that provides the exchange rate provider (overridden in tests with a local fake source)
+def get_rate_provider() -> ExchangeRateProvider:
+    return rate_provider
@@ -0,0 +1,27 @@
+# Shared asynchronous Redis client
+import os
+import time
+import redis.asyncio as aioredis
+from app.metrics import REDIS_COMMAND_DURATION, REDIS_COMMAND_ERRORS
+
+# Connection URL of the Redis instance shared by all workers
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
+
+
+class InstrumentedRedis(aioredis.Redis):
+    """ Redis client recording the latency and failures of every command for the /metrics endpoint. """
+
+    async def execute_command(self, *args, **options):
+        command = str(args[0]).upper() if args else "UNKNOWN"
+        started = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        except Exception:
+            REDIS_COMMAND_ERRORS.inc(command=command)
+            raise
+        finally:
+            REDIS_COMMAND_DURATION.observe(time.perf_counter() - started, command=command)
+
+
+# One connection pool per process; the client connects lazily on first use
+redis_client = InstrumentedRedis.from_url(REDIS_URL)
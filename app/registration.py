@@ -0,0 +1,159 @@
+# Package registration shared by /register, /register/batch and the group commit of single registrations
+import asyncio
+import logging
+import os
+from collections import defaultdict
+from typing import List, Optional, Tuple
+from pydantic import ValidationError
+from redis.exceptions import RedisError
+from sqlalchemy.ext.asyncio import AsyncSession
+from app import schemas
+from app.bulk import insert_packages
+from app.cache import PackageCache, package_cache
+from app.cost_worker import CostQueue, cost_queue
+from app.rate_history import RateHistory, rate_history
+from app.rates import ExchangeRateProvider, rate_provider
+from app.sharding import Shard, ShardRouter, shard_router
+from app.summaries import record_registered
+
+logger = logging.getLogger(__name__)
+
+# Opt-in group commit of /register: concurrent registrations are written together in one transaction.
+# A group is written when REGISTER_GROUP_COMMIT_MAX_ITEMS registrations are waiting or
+# REGISTER_GROUP_COMMIT_WINDOW_MS after the first of them arrived, whichever comes first:
+# a longer window gathers larger groups (fewer commits) at the price of that much added latency
+REGISTER_GROUP_COMMIT = os.getenv("REGISTER_GROUP_COMMIT", "0") == "1"
+REGISTER_GROUP_COMMIT_WINDOW_MS = float(os.getenv("REGISTER_GROUP_COMMIT_WINDOW_MS", "5"))
+REGISTER_GROUP_COMMIT_MAX_ITEMS = int(os.getenv("REGISTER_GROUP_COMMIT_MAX_ITEMS", "100"))
+
+
+async def store_packages(db: AsyncSession, rows: List[dict], rates: ExchangeRateProvider,
+                         history: RateHistory) -> List[int]:
+    """ Prices (if this worker knows the rate), inserts and counts packages, returning their ids; the caller commits.
+
+    The rows are updated with the delivery cost and rate version they are stored with.
+    """
+    # In lazy mode the cost is never written, it is derived from the latest rate version on read
+    usd_to_rub = rates.peek() if not history.lazy else None
+    if usd_to_rub is not None:
+        rate_version = await history.publish(db, usd_to_rub)
+        for row in rows:
+            row["delivery_cost"] = history.pricing.cost(row["weight"], row["value"], row["type_id"], usd_to_rub)
+            row["rate_version"] = rate_version
+    ids = await insert_packages(db, rows)
+    # Counted in the users' summaries within the same transaction
+    await record_registered(db, rows)
+    return ids
+
+
+async def after_commit(ids: List[int], rows: List[dict], history: RateHistory, queue: CostQueue,
+                       cache: PackageCache):
+    """ Queues the committed packages left without a delivery cost and drops stale cache entries. """
+    if not history.lazy:
+        pending = [package_id for package_id, row in zip(ids, rows) if row.get("delivery_cost") is None]
+        if pending:
+            await queue.enqueue(pending)
+    await cache.invalidate_packages(ids)
+
+
+class GroupCommitter:
+    """ Coalesces concurrent single-package registrations into one multi-row INSERT and one commit per shard.
+
+    Every caller waits for the commit of its group and gets its own stored package back. If a
+    group fails, its packages are retried one by one, so a bad package only fails its own request.
+    """
+
+    def __init__(self, shards: ShardRouter = shard_router, window_ms: float = REGISTER_GROUP_COMMIT_WINDOW_MS,
+                 max_items: int = REGISTER_GROUP_COMMIT_MAX_ITEMS, rates: ExchangeRateProvider = rate_provider,
+                 history: RateHistory = rate_history, queue: CostQueue = cost_queue,
+                 cache: PackageCache = package_cache):
+        self.shards = shards
+        self.window_ms = window_ms
+        self.max_items = max_items
+        self.rates = rates
+        self.history = history
+        self.queue = queue
+        self.cache = cache
+        self._pending: List[Tuple[dict, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._writes = set()
+
+    async def register(self, row: dict) -> schemas.PackageRecord:
+        """ Stores a package with the next group and returns it once that group is committed. """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((row, future))
+        if len(self._pending) >= self.max_items:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window_ms / 1000, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        group, self._pending = self._pending, []
+        shard_groups = defaultdict(list)
+        for row, future in group:
+            shard_groups[self.shards.for_user(row["user_id"])].append((row, future))
+        for shard, shard_group in shard_groups.items():
+            write = asyncio.ensure_future(self._write(shard, shard_group))
+            self._writes.add(write)
+            write.add_done_callback(self._writes.discard)
+
+    async def _write(self, shard: Shard, group: List[Tuple[dict, asyncio.Future]]):
+        # store_packages fills in the cost and rate version of the rows it stores, so it is given copies:
+        # the one-by-one retry of a failed group starts again from the payloads as they were registered
+        rows = [dict(row) for row, _ in group]
+        try:
+            try:
+                async with shard.sessions() as db:
+                    ids = await store_packages(db, rows, self.rates, self.history)
+                    await db.commit()
+            except Exception as e:
+                if len(group) <= 1:
+                    raise
+                logger.warning("Group of %d registrations failed, retrying them one by one: %s", len(group), e)
+                for item in group:
+                    await self._write(shard, [item])
+                return
+            try:
+                await after_commit(ids, rows, self.history, self.queue, self.cache)
+            except RedisError as e:
+                # The packages are stored; the periodic job prices whatever the cost worker was not told about
+                logger.warning("Post-commit work of %d registrations failed: %s", len(ids), e)
+            except Exception:
+                # Still stored: failing the requests would only have them registered twice
+                logger.exception("Post-commit work of %d registrations failed", len(ids))
+            for (_, future), row, package_id in zip(group, rows, ids):
+                if future.done():  # The request was cancelled while its group was written
+                    continue
+                try:
+                    future.set_result(schemas.PackageRecord.model_validate({**row, "id": package_id}))
+                except ValidationError as e:
+                    future.set_exception(e)
+        except BaseException as e:
+            # No caller is left waiting for a write that failed or was cancelled
+            for _, future in group:
+                if future.done():
+                    continue
+                if isinstance(e, asyncio.CancelledError):
+                    future.cancel()
+                else:
+                    future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+
+    async def close(self):
+        """ Writes the registrations still waiting for their group. """
+        self._flush()
+        await asyncio.gather(*self._writes, return_exceptions=True)
+
+
+# Group committer of this worker, used by /register when REGISTER_GROUP_COMMIT is enabled
+group_committer = GroupCommitter()
+
+# Dependency that provides the group committer, or None when registrations are committed one by one
+def get_group_committer() -> Optional[GroupCommitter]:
+    return group_committer if REGISTER_GROUP_COMMIT else None
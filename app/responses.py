@@ -0,0 +1,64 @@
+# JSON response class for the hot list endpoints, conditional request and streaming helpers
+import zlib
+from typing import Any, AsyncIterator, Optional
+from fastapi import Response
+import orjson
+from fastapi.responses import JSONResponse
+
+
+def dumps(content: Any) -> bytes:
+    """ Encodes plain dicts, lists, strings and numbers as compact JSON with orjson. """
+    return orjson.dumps(content)
+
+
+class FastJSONResponse(JSONResponse):
+    """ JSONResponse encoded with orjson.
+
+    The content must already be made of plain dicts, lists, strings and numbers: it is
+    encoded as is, without the validation and conversion FastAPI applies to return values.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def make_etag(*parts: Any) -> str:
+    """ Returns a strong entity tag made of the given parts (versions and the like). """
+    return '"' + ".".join(str(part) for part in parts) + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """ Tells whether an If-None-Match header lists the entity tag (weak comparison, as RFC 9110 asks for). """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(candidate.strip().removeprefix("W/") == etag for candidate in if_none_match.split(","))
+
+
+# Headers of every response carrying an ETag: clients may keep the body but must revalidate it before reuse
+def conditional_headers(etag: str) -> dict:
+    return {"ETag": etag, "Cache-Control": "no-cache"}
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers=conditional_headers(etag))
+
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    """ Tells whether an Accept-Encoding header allows a gzip-encoded response. """
+    for coding in accept_encoding.split(","):
+        name, _, parameters = coding.partition(";")
+        if name.strip().lower() == "gzip":
+            return parameters.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+
+async def gzip_chunks(chunks: AsyncIterator[bytes], level: int = 6) -> AsyncIterator[bytes]:
+    """ Compresses a stream into a gzip stream chunk by chunk, without buffering the whole body. """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits 16 + 15: gzip header and trailer
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
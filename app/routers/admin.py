@@ -0,0 +1,49 @@
+from typing import List, Optional
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response
+from app.profiling import Profiler, get_profiler
+
+# Create an APIRouter instance for the operator endpoints, hidden from the API docs
+router = APIRouter(prefix="/admin", include_in_schema=False)
+
+
+# Dependency guarding the profiling endpoints with the profile token
+def require_profile_token(x_profile_token: Optional[str] = Header(None),
+                          profiler: Profiler = Depends(get_profiler)) -> Profiler:
+    if not profiler.token:
+        # Without a configured token the endpoints do not exist
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not profiler.authorized(x_profile_token):
+        raise HTTPException(status_code=403, detail="Invalid profile token")
+    return profiler
+
+
+# Endpoint listing the stored profiles
+@router.get("/profiles")
+async def list_profiles(profiler: Profiler = Depends(require_profile_token)) -> List[dict]:
+    """ Returns the metadata of the profiles in the ring buffer, newest first. """
+    return await profiler.recent()
+
+
+# Endpoint downloading a profile
+@router.get("/profiles/{profile_id}")
+async def download_profile(profile_id: int, profiler: Profiler = Depends(require_profile_token)):
+    """ Downloads a profile as pstats (for pstats.Stats or snakeviz) or collapsed stacks (for flamegraph.pl). """
+    profile = await profiler.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    meta, data = profile
+    extension, media_type = {"pstats": ("pstats", "application/octet-stream"),
+                             "collapsed": ("collapsed.txt", "text/plain")}[meta["format"]]
+    return Response(data, media_type=media_type,
+                    headers={"Content-Disposition": f'attachment; filename="profile-{profile_id}.{extension}"'})
+
+
+# Endpoint asking for the next runs of a periodic job to be profiled
+@router.post("/profiles/jobs/{job}")
+async def profile_job(job: str, runs: int = Query(1, ge=0, le=100),
+                      profiler: Profiler = Depends(require_profile_token)):
+    """ Profiles the next runs of a job (0 cancels), on whichever worker runs them. """
+    if job not in profiler.jobs:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    await profiler.profile_job_runs(job, runs)
+    return {"job": job, "runs": runs}
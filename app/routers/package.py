@@ -1,76 +1,358 @@
+import hashlib
+import json
 import logging
-from typing import List
-from fastapi import APIRouter, Depends, HTTPException
+from collections import defaultdict
+from typing import List, Optional
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+from sqlalchemy import select
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from app import models, schemas
-from app.database import SessionLocal
+from app.cache import PackageCache, get_package_cache
+from app.cost_worker import CostQueue, get_cost_queue
+from app.database import reads_replica
+from app.pricing import PricingEngine, get_pricing_engine
+from app.rate_history import PACKAGE_ROW_COLUMNS, RateHistory, get_rate_history
+from app.rates import ExchangeRateProvider, RateUnavailableError, get_rate_provider
+from app.export import MEDIA_TYPES, export_packages, filter_packages
+from app.package_types import PackageTypeRegistry, get_package_type_registry
+from app.responses import (FastJSONResponse, accepts_gzip, conditional_headers, etag_matches, gzip_chunks, make_etag,
+                           not_modified)
+from app.pagination import after_position, encode_cursor, decode_cursor
+from app.registration import GroupCommitter, after_commit, get_group_committer, store_packages
+from app.search import PackageSearch, get_package_search
+from app.sharding import ShardRouter, get_shard_router
+from app.summaries import record_registered, user_summary, user_version
+
+logger = logging.getLogger(__name__)
 
 # Create an APIRouter instance for organizing the endpoints
 router = APIRouter()
 
-# Dependency that provides a database session for each request
-def get_db():
-    """ Returns a database session for the current request. """
-    db = SessionLocal()
-    try:
-        yield db  # Yield the database session to be used by the request
-    finally:
-        db.close()  # Ensure the session is closed after the request is finished
+
+# Dependency for endpoints reading one package: a read session on the shard encoded in its id
+async def get_package_read_db(package_id: int, shards: ShardRouter = Depends(get_shard_router)):
+    shard = shards.for_package(package_id)
+    if shard is None:
+        raise HTTPException(status_code=404, detail="Package not found")
+    async with await shard.reads.read_session() as db:
+        yield db
+
+# Dependency for endpoints reading one user's data: a read session on the user's shard
+async def get_user_read_db(user_id: int, shards: ShardRouter = Depends(get_shard_router)):
+    async with await shards.for_user(user_id).reads.read_session() as db:
+        yield db
+
+
+async def rate_etag_parts(db: AsyncSession, history: RateHistory) -> tuple:
+    """ Returns the ETag parts covering delivery costs derived on read: the latest rate version in lazy mode. """
+    latest = await history.latest(db) if history.lazy else None
+    return (f"r{latest[0]}",) if latest is not None else ()
 
 
 # Endpoint to register a new package
 @router.post("/register", response_model=schemas.Package)
-def register_package(package: schemas.PackageCreate, db: Session = Depends(get_db)):
+async def register_package(package: schemas.PackageCreate, shards: ShardRouter = Depends(get_shard_router),
+                           cache: PackageCache = Depends(get_package_cache),
+                           rates: ExchangeRateProvider = Depends(get_rate_provider),
+                           history: RateHistory = Depends(get_rate_history),
+                           cost_queue: CostQueue = Depends(get_cost_queue),
+                           committer: Optional[GroupCommitter] = Depends(get_group_committer)):
     """ Registers a new package in the database. """
-    # Validate if the provided type_id exists in the predefined package types
-    if package.type_id not in models.PACKAGE_TYPES.values():
-        raise HTTPException(status_code=400, detail="Invalid type_id")
+    # The type_id has been checked against the package type registry by schemas.PackageCreate
     # Validate if the provided user_id is correct
     if package.user_id is None or package.user_id < 0:
         raise HTTPException(status_code=400, detail="Invalid user_id")
-    # Create a new Package instance from the request data
-    db_package = models.Package(**package.dict())
-    db.add(db_package)
-    db.commit()
-    db.refresh(db_package)
-    return db_package
+    # The package lives on the shard of its user
+    async with shards.for_user(package.user_id).sessions() as db:
+        if committer is not None:
+            # Written in one transaction with the registrations arriving at the same time
+            record = await committer.register(package.model_dump())
+            [priced] = await history.price(db, [record])
+            return priced
+        # Create a new Package instance from the request data
+        db_package = models.Package(**package.dict())
+        # Price the package right away if this worker knows the rate, otherwise leave it to the cost worker
+        # (in lazy mode the cost is never written, it is derived from the latest rate version on read)
+        usd_to_rub = rates.peek()
+        if usd_to_rub is not None and not history.lazy:
+            db_package.rate_version = await history.publish(db, usd_to_rub)
+            db_package.delivery_cost = history.pricing.cost(package.weight, package.value, package.type_id, usd_to_rub)
+        db.add(db_package)
+        # Counted in the user's summary within the same transaction
+        await record_registered(db, [{**package.model_dump(), "delivery_cost": db_package.delivery_cost}])
+        await db.commit()
+        await db.refresh(db_package)
+        if db_package.delivery_cost is None and not history.lazy:
+            await cost_queue.enqueue([db_package.id])
+        # Drop whatever may still be cached under this id
+        await cache.invalidate_packages([db_package.id])
+        [priced] = await history.price(db, [schemas.PackageRecord.model_validate(db_package)])
+        return priced
 
-# Endpoint to show user's packages
-@router.post("/show", response_model=List[schemas.Package])
-def show_packages(show_request: schemas.ShowPackagesRequest, db: Session = Depends(get_db)):
-    """ Retrieves a list of packages based on the provided filter criteria. """
-    packages = []
-    if show_request.package_type > -1:
-        packages = (db.query(models.Package)
-                .filter(models.Package.user_id == show_request.user_id,
-                         models.Package.type_id == show_request.package_type
-                        )
-                .offset(show_request.offset)
-                .limit(show_request.limit)
-                .all())
+# Maximum number of packages accepted by a single batch registration request
+MAX_BATCH_SIZE = 10000
+
+async def read_batch_items(request: Request) -> list:
+    """ Reads the items of a batch registration request sent as a JSON array or as NDJSON. """
+    if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+        items = []
+        buffer = b""
+        async for chunk in request.stream():
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            items.extend(line for line in lines if line.strip())
+            if len(items) > MAX_BATCH_SIZE:
+                raise HTTPException(status_code=413, detail="Batch too large")
+        if buffer.strip():
+            items.append(buffer)
+        # A malformed line only rejects that item, so keep it as raw bytes and let validation report it
+        parsed = []
+        for line in items:
+            try:
+                parsed.append(json.loads(line))
+            except ValueError:
+                parsed.append(line)
+        items = parsed
     else:
-        packages = (db.query(models.Package)
-                .filter(models.Package.user_id == show_request.user_id)
-                .offset(show_request.offset)
-                .limit(show_request.limit)
-                .all())
-    return packages
+        try:
+            items = await request.json()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid JSON")
+        if not isinstance(items, list):
+            raise HTTPException(status_code=400, detail="Expected a JSON array of packages")
+    if len(items) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=413, detail="Batch too large")
+    return items
+
+# Endpoint to register many packages in one request
+@router.post("/register/batch", response_model=schemas.BatchRegisterResponse)
+async def register_packages_batch(request: Request, shards: ShardRouter = Depends(get_shard_router),
+                                  cache: PackageCache = Depends(get_package_cache),
+                                  rates: ExchangeRateProvider = Depends(get_rate_provider),
+                                  history: RateHistory = Depends(get_rate_history),
+                                  cost_queue: CostQueue = Depends(get_cost_queue)):
+    """ Registers a batch of packages sent as a JSON array or as NDJSON (application/x-ndjson). """
+    items = await read_batch_items(request)
+    # Validate every item first; invalid ones are reported and skipped, the rest are inserted together
+    rows, positions, errors = [], [], []
+    for index, item in enumerate(items):
+        if isinstance(item, bytes):
+            errors.append(schemas.BatchItemError(index=index, detail=["Invalid JSON"]))
+            continue
+        if not isinstance(item, dict):
+            errors.append(schemas.BatchItemError(index=index, detail=["Expected a JSON object"]))
+            continue
+        try:
+            package = schemas.PackageCreate.model_validate(item)
+        except ValidationError as e:
+            errors.append(schemas.BatchItemError(index=index, detail=[error["msg"] for error in e.errors()]))
+            continue
+        if package.user_id is None or package.user_id < 0:
+            errors.append(schemas.BatchItemError(index=index, detail=["Invalid user_id"]))
+            continue
+        rows.append(package.model_dump())
+        positions.append(index)
+
+    ids = [None] * len(items)
+    shard_entries = defaultdict(list)
+    for row, position in zip(rows, positions):
+        shard_entries[shards.for_user(row["user_id"])].append((row, position))
+    # One transaction per shard: once a shard has committed, the packages of a failing one are
+    # reported as rejected instead of failing the whole request
+    for shard, entries in shard_entries.items():
+        shard_rows = [row for row, _ in entries]
+        try:
+            async with shard.sessions() as db:
+                inserted_ids = await store_packages(db, shard_rows, rates, history)
+                await db.commit()
+        except SQLAlchemyError as e:
+            if all(package_id is None for package_id in ids):
+                raise
+            logger.warning("Storing %d packages on shard %d failed: %s", len(entries), shard.index, e)
+            errors.extend(schemas.BatchItemError(index=position, detail=["Storage failed"]) for _, position in entries)
+            continue
+        for (_, position), package_id in zip(entries, inserted_ids):
+            ids[position] = package_id
+        await after_commit(inserted_ids, shard_rows, history, cost_queue, cache)
+    errors.sort(key=lambda error: error.index)
+    return schemas.BatchRegisterResponse(ids=ids, errors=errors)
+
+# Endpoint pricing packages without registering them
+@router.post("/quote", response_model=schemas.QuoteResponse, response_class=FastJSONResponse)
+async def quote(quote_request: schemas.QuoteRequest, rates: ExchangeRateProvider = Depends(get_rate_provider),
+                pricing: PricingEngine = Depends(get_pricing_engine)):
+    """ Returns the delivery costs of a batch of packages at the current exchange rate; nothing is stored. """
+    try:
+        usd_to_rub = await rates.get_rate()
+    except RateUnavailableError:
+        raise HTTPException(status_code=503, detail="Exchange rate unavailable", headers={"Retry-After": "60"})
+    # Priced with the tariffs the cost job stores costs with, as whole arrays at once
+    costs = pricing.quote(quote_request.weights, quote_request.values, quote_request.type_ids, usd_to_rub)
+    return FastJSONResponse({"usd_to_rub": usd_to_rub, "costs": costs})
+
+# Endpoint to show user's packages
+@router.post("/show", response_model=List[schemas.Package], response_class=FastJSONResponse)
+async def show_packages(show_request: schemas.ShowPackagesRequest,
+                        shards: ShardRouter = Depends(get_shard_router),
+                        history: RateHistory = Depends(get_rate_history),
+                        if_none_match: Optional[str] = Header(None)):
+    """ Retrieves a list of packages based on the provided filter criteria.
+
+    Answers 304 without reading the packages if the page of the client (If-None-Match) is still current.
+    """
+    # Packages are returned in the order of the (user_id, type_id, id) index, so a page
+    # requested with the cursor of the previous one is a single index range seek.
+    # Only the needed columns are selected, as plain tuples, and turned straight into JSON:
+    # loading entities and validating them through schemas.Package dominated the CPU time of a page
+    # All packages of a user live on the user's shard
+    async with await shards.for_user(show_request.user_id).reads.read_session() as db:
+        query = filter_packages(select(*PACKAGE_ROW_COLUMNS), show_request.user_id, show_request.package_type,
+                                show_request.calculated_value, await history.derives_every_cost(db))
+        query = query.order_by(models.Package.type_id, models.Package.id)
+        if show_request.cursor is not None:
+            # Continue right after the last package of the previous page
+            query = query.filter(after_position(decode_cursor(show_request.cursor)))
+        else:
+            query = query.offset(show_request.offset)
+        # The page changes only with the user's change counter (and the filters of the request).
+        # The counter is read before the page: a write in between makes the page newer than its ETag, never older
+        request_digest = hashlib.blake2b(show_request.model_dump_json().encode(), digest_size=8).hexdigest()
+        etag = make_etag(show_request.user_id, await user_version(db, show_request.user_id),
+                         *await rate_etag_parts(db, history), request_digest)
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
+        result = await db.execute(query.limit(show_request.limit))
+        packages = await history.price_rows(db, result.all())
+    headers = conditional_headers(etag)
+    # A full page may be followed by more packages: hand out the cursor for the next one
+    if len(packages) == show_request.limit:
+        headers["X-Next-Cursor"] = encode_cursor(packages[-1]["type_id"], packages[-1]["id"])
+    return FastJSONResponse(packages, headers=headers)
+
+# Endpoint searching a user's packages by name
+@router.post("/search", response_model=List[schemas.Package], response_class=FastJSONResponse)
+async def search_packages(search_request: schemas.SearchPackagesRequest,
+                          shards: ShardRouter = Depends(get_shard_router),
+                          search: PackageSearch = Depends(get_package_search),
+                          history: RateHistory = Depends(get_rate_history),
+                          if_none_match: Optional[str] = Header(None)):
+    """ Finds a user's packages whose name starts with or contains the query, a page at a time.
+
+    Pages are in the order of /show and continue with the X-Next-Cursor header of the previous one.
+    """
+    after = decode_cursor(search_request.cursor) if search_request.cursor is not None else None
+    shard = shards.for_user(search_request.user_id)
+    async with await shard.reads.read_session() as db:
+        # Like a /show page, the results change only with the user's change counter
+        request_digest = hashlib.blake2b(search_request.model_dump_json().encode(), digest_size=8).hexdigest()
+        etag = make_etag(search_request.user_id, await user_version(db, search_request.user_id),
+                         *await rate_etag_parts(db, history), request_digest)
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
+        rows = await search.search(db, shard.index, search_request, after)
+        packages = await history.price_rows(db, rows)
+    headers = conditional_headers(etag)
+    if len(packages) == search_request.limit:
+        headers["X-Next-Cursor"] = encode_cursor(packages[-1]["type_id"], packages[-1]["id"])
+    return FastJSONResponse(packages, headers=headers)
+
+# Endpoint streaming all packages matching the filters, without the page size limit of /show
+@router.get("/export", response_class=StreamingResponse)
+async def export(request: Request,
+                 export_format: schemas.ExportFormat = Query(schemas.ExportFormat.ndjson, alias="format"),
+                 user_id: Optional[int] = None, package_type: int = -1,
+                 calculated_value: schemas.PackageValueStatus = schemas.PackageValueStatus.any,
+                 shards: ShardRouter = Depends(get_shard_router),
+                 history: RateHistory = Depends(get_rate_history)):
+    """ Exports packages as NDJSON or CSV, gzip-compressed on the fly if the client accepts it. """
+    if package_type < -1:
+        raise HTTPException(status_code=400, detail="Invalid package_type")
+    # One user's packages are on one shard; everyone's are read shard after shard
+    exported = [shards.for_user(user_id)] if user_id is not None else shards.shards
+    chunks = export_packages([shard.reads for shard in exported], history, export_format, user_id=user_id,
+                             package_type=package_type, calculated_value=calculated_value)
+    headers = {"Content-Disposition": f'attachment; filename="packages.{export_format.value}"',
+               "Vary": "Accept-Encoding"}
+    if accepts_gzip(request.headers.get("accept-encoding", "")):
+        chunks = gzip_chunks(chunks)
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(chunks, media_type=MEDIA_TYPES[export_format], headers=headers)
 
 # Endpoint to retrieve all package types
 @router.get("/types", response_model=List[schemas.PackageType])
-def get_package_types(db: Session = Depends(get_db)):
+async def get_package_types(registry: PackageTypeRegistry = Depends(get_package_type_registry)):
     """ Retrieves a list of all available package types. """
-    # Query the database for all PackageType entries
-    return db.query(models.PackageType).all()
+    # Served from the in-process registry, which follows changes of the package_types table
+    return [schemas.PackageType(id=type_id, name=name) for type_id, name in sorted(registry.types.items())]
 
 
 # Endpoint to retrieve data about a package by its id
 @router.get("/package/{package_id}", response_model=schemas.Package)
-def get_package(package_id: int, db: Session = Depends(get_db)):
-    """ Retrieves a single package by its ID. """
-    package = db.query(models.Package).filter(models.Package.id == package_id).first()
+async def get_package(package_id: int, response: Response, db: AsyncSession = Depends(get_package_read_db),
+                      cache: PackageCache = Depends(get_package_cache),
+                      history: RateHistory = Depends(get_rate_history),
+                      if_none_match: Optional[str] = Header(None)):
+    """ Retrieves a single package by its ID, or answers 304 if the copy of the client (If-None-Match) is current. """
+    rate_parts = await rate_etag_parts(db, history)
+    package = await cache.get_package(package_id)
     if package is None:
-        raise HTTPException(status_code=404, detail="Package not found")
-    return package
+        if if_none_match:
+            # Revalidation reads the row version alone and loads the row only if it changed
+            version = (await db.execute(select(models.Package.version)
+                                        .where(models.Package.id == package_id))).scalar()
+            if version is None:
+                raise HTTPException(status_code=404, detail="Package not found")
+            etag = make_etag(package_id, version, *rate_parts)
+            if etag_matches(if_none_match, etag):
+                return not_modified(etag)
+        db_package = await db.get(models.Package, package_id)
+        if db_package is None:
+            raise HTTPException(status_code=404, detail="Package not found")
+        package = schemas.PackageRecord.model_validate(db_package)
+        # Only rows read from the primary fill the shared cache: a lagging replica could put back the
+        # row a write has just invalidated, served (and its ETag answered with 304) until it expires
+        if not reads_replica(db):
+            await cache.set_package(package)
+    etag = make_etag(package.id, package.version, *rate_parts)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    # The cache holds the stored row; a cost not materialized yet is derived from its rate version
+    [priced] = await history.price(db, [package])
+    response.headers.update(conditional_headers(etag))
+    return priced
+
+
+# Endpoint summarizing a user's packages per type
+@router.get("/summary/{user_id}", response_model=schemas.UserSummary)
+async def get_user_summary(user_id: int, db: AsyncSession = Depends(get_user_read_db),
+                           history: RateHistory = Depends(get_rate_history)):
+    """ Returns package counts, weights, values and delivery costs of a user, per package type and in total. """
+    # One pre-aggregated row per type, however many packages the user has
+    rows = await user_summary(db, user_id)
+    latest = await history.latest(db) if history.lazy and any(row.pending_packages for row in rows) else None
+    types = []
+    for row in rows:
+        cost = row.total_delivery_cost
+        if row.pending_packages and latest is not None:
+            # The cost formula is linear, so the pending costs follow from the pending sums
+            cost += history.pricing.cost(row.pending_weight, row.pending_value, row.type_id, latest[1])
+        pending = row.pending_packages if latest is None else 0
+        types.append(schemas.TypeSummary(type_id=row.type_id, packages=row.packages, total_weight=row.total_weight,
+                                         total_value=row.total_value, total_delivery_cost=cost,
+                                         pending_packages=pending))
+    return schemas.UserSummary(
+        user_id=user_id, types=types,
+        packages=sum(item.packages for item in types), total_weight=sum(item.total_weight for item in types),
+        total_value=sum(item.total_value for item in types),
+        total_delivery_cost=sum(item.total_delivery_cost for item in types),
+        pending_packages=sum(item.pending_packages for item in types))
+
 
+# Endpoint exposing the hit/miss counters of the lookup cache
+@router.get("/cache/stats")
+async def get_cache_stats(cache: PackageCache = Depends(get_package_cache)):
+    """ Returns the cache hit/miss counters of this worker. """
+    return cache.stats()
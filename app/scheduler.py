@@ -0,0 +1,249 @@
+# Cluster-safe periodic jobs
+import asyncio
+import json
+import logging
+import random
+import time
+from collections import deque
+from dataclasses import dataclass, asdict
+from typing import Awaitable, Callable, List, Optional, Tuple
+from app.metrics import JOB_DURATION, JOB_ROWS, JOB_RUNS
+
+logger = logging.getLogger(__name__)
+
+# Take the lease only if nobody holds it, stamping it with a new fencing token
+ACQUIRE_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 1 then
+    return nil
+end
+local token = redis.call('incr', KEYS[2])
+redis.call('set', KEYS[1], token, 'PX', ARGV[1])
+return token
+"""
+
+# Extend the lease only if it still carries our token
+RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Drop the lease only if it still carries our token
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Write (or with no value, delete) the state of a run only while the lease still carries our token: the
+# check and the write are one atomic step, so a holder that lost the lease (e.g. paused past its expiry)
+# cannot overwrite the state written since by the worker holding the lease with a newer token
+FENCED_WRITE_SCRIPT = """
+if redis.call('get', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+if #ARGV < 2 then
+    redis.call('del', KEYS[2])
+else
+    redis.call('set', KEYS[2], ARGV[2])
+end
+return 1
+"""
+
+
+class LeaseLostError(Exception):
+    """ Raised inside a job run whose lease expired or was taken over by another worker. """
+
+
+class LeaseLock:
+    """ Redis lease that elects one worker at a time, identified by a monotonically increasing fencing token. """
+
+    def __init__(self, redis, name: str, ttl_ms: int):
+        self.redis = redis
+        self.name = name
+        self.ttl_ms = ttl_ms
+        self.token: Optional[int] = None
+
+    async def acquire(self) -> Optional[int]:
+        token = await self.redis.eval(ACQUIRE_SCRIPT, 2, self.name, f"{self.name}:fence", self.ttl_ms)
+        self.token = int(token) if token is not None else None
+        return self.token
+
+    async def renew(self) -> bool:
+        if self.token is None:
+            return False
+        return bool(await self.redis.eval(RENEW_SCRIPT, 1, self.name, self.token, self.ttl_ms))
+
+    async def release(self):
+        if self.token is not None:
+            await self.redis.eval(RELEASE_SCRIPT, 1, self.name, self.token)
+            self.token = None
+
+    async def write(self, key: str, value=None) -> bool:
+        """ Sets key to value (deletes it if value is None) if the lease is still ours; tells whether it was. """
+        if self.token is None:
+            return False
+        args = (self.token,) if value is None else (self.token, value)
+        return bool(await self.redis.eval(FENCED_WRITE_SCRIPT, 2, self.name, key, *args))
+
+
+@dataclass
+class JobContext:
+    """ Describes the share of work a job run is responsible for. """
+    partition: int = 0
+    partitions: int = 1
+    token: Optional[int] = None
+    lock: Optional[LeaseLock] = None
+
+    async def check(self):
+        """ Raises LeaseLostError if another worker may have taken over this run. """
+        if self.lock is not None and not await self.lock.renew():
+            raise LeaseLostError(f"Lease {self.lock.name} (token {self.token}) was lost")
+
+    async def write(self, redis, key: str, value=None):
+        """ Sets (or with no value, deletes) a Redis key holding the state of the run, such as a checkpoint.
+
+        Under a lease the write is fenced: it raises LeaseLostError instead of overwriting the state
+        of a newer holder.
+        """
+        if self.lock is None:
+            await (redis.delete(key) if value is None else redis.set(key, value))
+        elif not await self.lock.write(key, value):
+            raise LeaseLostError(f"Lease {self.lock.name} (token {self.token}) was lost")
+
+
+@dataclass
+class JobRun:
+    """ Outcome of a single job run. """
+    job: str
+    partition: int
+    token: int
+    started_at: float
+    duration: float
+    rows: int
+    error: Optional[str] = None
+
+
+def id_range_partition(max_id: int, partition: int, partitions: int,
+                       first_after: int = 0) -> Tuple[int, Optional[int]]:
+    """ Splits ids first_after+1..max_id into equal ranges and returns (start_after, end_at) of one of them.
+
+    The last range is left open so rows inserted during the run are still covered.
+    """
+    span = max(max_id - first_after, 0) // partitions + 1
+    start_after = first_after + partition * span
+    end_at = first_after + (partition + 1) * span if partition < partitions - 1 else None
+    return start_after, end_at
+
+
+class ScheduledJob:
+    """ A coroutine run once per interval across all workers, optionally split into partitions.
+
+    Every partition runs under its own lease, so a run never overlaps with another run of
+    the same partition, and is claimed once per interval slot, so the total work per
+    interval does not depend on how many workers are running.
+    """
+
+    def __init__(self, redis, name: str, func: Callable[[JobContext], Awaitable[int]], seconds: float,
+                 partitions: int = 1, jitter: float = 0.1, lease_ms: Optional[int] = None, history: int = 100):
+        self.redis = redis
+        self.name = name
+        self.func = func
+        self.seconds = seconds
+        self.partitions = partitions
+        self.jitter = jitter
+        self.lease_ms = lease_ms or int(seconds * 1000)
+        self.history = history
+        self.runs = deque(maxlen=history)
+
+    async def run_slot(self, slot: int) -> List[JobRun]:
+        """ Runs every partition of the given interval slot that no other worker has claimed. """
+        runs = []
+        for partition in random.sample(range(self.partitions), self.partitions):
+            run = await self.run_partition(slot, partition)
+            if run is not None:
+                runs.append(run)
+        return runs
+
+    async def run_partition(self, slot: int, partition: int) -> Optional[JobRun]:
+        lock = LeaseLock(self.redis, f"job:{self.name}:{partition}:lease", self.lease_ms)
+        token = await lock.acquire()
+        if token is None:
+            # Another worker is still running this partition
+            return None
+        renewal = None
+        try:
+            claimed = await self.redis.set(f"job:{self.name}:{partition}:slot:{slot}", token,
+                                           nx=True, ex=max(int(self.seconds * 2), 1))
+            if not claimed:
+                # This partition already ran in the current interval
+                return None
+            renewal = asyncio.ensure_future(self._renew(lock))
+            started_at, started = time.time(), time.monotonic()
+            rows, error = 0, None
+            try:
+                rows = await self.func(JobContext(partition, self.partitions, token, lock)) or 0
+            except Exception as e:
+                error = repr(e)
+                logger.exception("Job %s partition %d failed", self.name, partition)
+            run = JobRun(self.name, partition, token, started_at, time.monotonic() - started, rows, error)
+            await self._record(run)
+            return run
+        finally:
+            if renewal is not None:
+                renewal.cancel()
+            await lock.release()
+
+    async def _renew(self, lock: LeaseLock):
+        while True:
+            await asyncio.sleep(lock.ttl_ms / 3000)
+            if not await lock.renew():
+                logger.warning("Lease %s was lost", lock.name)
+                return
+
+    async def _record(self, run: JobRun):
+        self.runs.append(run)
+        JOB_RUNS.inc(job=run.job, status="failure" if run.error else "success")
+        JOB_DURATION.observe(run.duration, job=run.job)
+        JOB_ROWS.inc(run.rows, job=run.job)
+        logger.info("Job %s partition %d: %d rows in %.3fs", run.job, run.partition, run.rows, run.duration)
+        key = f"job:{self.name}:runs"
+        await self.redis.lpush(key, json.dumps(asdict(run)))
+        await self.redis.ltrim(key, 0, self.history - 1)
+
+    async def run_forever(self):
+        # Spread the workers' first attempts so they do not all hit Redis at once
+        await asyncio.sleep(random.uniform(0, self.jitter * self.seconds))
+        while True:
+            slot = int(time.time() // self.seconds)
+            try:
+                await self.run_slot(slot)
+            except Exception:
+                logger.exception("Scheduling job %s failed", self.name)
+            next_run = (slot + 1) * self.seconds + random.uniform(0, self.jitter * self.seconds)
+            await asyncio.sleep(max(next_run - time.time(), 0))
+
+
+class JobScheduler:
+    """ Runs registered ScheduledJobs in the background of a worker. """
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.jobs = {}
+        self._tasks = []
+
+    def add_job(self, name: str, func: Callable[[JobContext], Awaitable[int]], seconds: float, **kwargs) -> ScheduledJob:
+        job = ScheduledJob(self.redis, name, func, seconds, **kwargs)
+        self.jobs[name] = job
+        return job
+
+    def start(self):
+        self._tasks = [asyncio.ensure_future(job.run_forever()) for job in self.jobs.values()]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
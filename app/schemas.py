@@ -2,8 +2,9 @@
 import html
 import re
 from pydantic import BaseModel, validator
-from app.models import PACKAGE_TYPES
-from typing import Optional
+from app.package_types import package_type_registry
+from app.pagination import decode_cursor
+from typing import List, Optional
 
 # Base schema for package data
 class PackageBase(BaseModel):
@@ -18,7 +19,8 @@ class PackageCreate(PackageBase):
     # Inherits all fields from PackageBase
     @validator('type_id')
     def type_id_must_be_valid(cls, v):
-        if v not in PACKAGE_TYPES.values():
+        # Checked against the in-process registry, so validation needs no database round-trip
+        if not package_type_registry.is_valid(v):
             raise ValueError('Invalid type_id')
         return v
 
@@ -47,8 +49,23 @@ class Package(PackageBase):
     delivery_cost: Optional[float] = None
     # Configuration settings for the Pydantic model
     class Config:
-        # Enables ORM mode for compatibility with SQLAlchemy models
-        orm_mode = True
+        # Enables ORM mode for compatibility with SQLAlchemy models (pydantic v2 name of orm_mode)
+        from_attributes = True
+
+# Package as stored, including the exchange rate version used to derive its delivery cost
+class PackageRecord(Package):
+    rate_version: Optional[int] = None
+    version: int = 1  # Row version, incremented by every update
+
+# Per-item error reported by the batch registration endpoint
+class BatchItemError(BaseModel):
+    index: int  # Position of the rejected item in the submitted batch
+    detail: List[str]  # Validation messages for the item
+
+# Result of a batch registration: ids are aligned with the submitted items (None for rejected ones)
+class BatchRegisterResponse(BaseModel):
+    ids: List[Optional[int]]
+    errors: List[BatchItemError]
 
 # Schema representing a package type
 class PackageType(BaseModel):
@@ -58,20 +75,79 @@ class PackageType(BaseModel):
 
     # Configuration settings for the Pydantic model
     class Config:
-        # Enables ORM mode for compatibility with SQLAlchemy models
-        orm_mode = True
+        # Enables ORM mode for compatibility with SQLAlchemy models (pydantic v2 name of orm_mode)
+        from_attributes = True
+
+# Totals of a user's packages of one type
+class TypeSummary(BaseModel):
+    type_id: int
+    packages: int  # Number of packages
+    total_weight: float
+    total_value: float
+    total_delivery_cost: float  # Sum of the known delivery costs
+    pending_packages: int  # Packages whose delivery cost is not known yet (not part of total_delivery_cost)
+
+# Totals of a user's packages, per type and overall
+class UserSummary(BaseModel):
+    user_id: int
+    packages: int
+    total_weight: float
+    total_value: float
+    total_delivery_cost: float
+    pending_packages: int
+    types: List[TypeSummary]
+
+# Maximum number of packages priced by a single quote request
+MAX_QUOTE_SIZE = 10000
+
+# Packages to quote, as equally long arrays: the i-th package weighs weights[i], is worth values[i]
+# and is of type type_ids[i]. Arrays rather than objects keep thousands of quotes cheap to parse
+class QuoteRequest(BaseModel):
+    weights: List[float]
+    values: List[float]
+    type_ids: List[int]
+
+    @validator('weights', 'values')
+    def amounts_must_be_valid(cls, amounts):
+        if len(amounts) > MAX_QUOTE_SIZE:
+            raise ValueError(f'At most {MAX_QUOTE_SIZE} packages per quote')
+        if amounts and min(amounts) < 0:
+            raise ValueError('Weights and values must be non-negative')
+        return amounts
+
+    @validator('type_ids')
+    def type_ids_must_be_valid(cls, type_ids, values):
+        lengths = {len(type_ids)} | {len(values[field]) for field in ('weights', 'values') if field in values}
+        if len(lengths) > 1:
+            raise ValueError('weights, values and type_ids must have the same length')
+        if not all(package_type_registry.is_valid(type_id) for type_id in set(type_ids)):
+            raise ValueError('Invalid type_id')
+        return type_ids
+
+# Delivery costs of the quoted packages, in the order of the request, at the given exchange rate
+class QuoteResponse(BaseModel):
+    usd_to_rub: float
+    costs: List[float]
 
 from enum import Enum
 class PackageValueStatus(str, Enum):
     any = 'any'
     calculated = 'calculated'
     pending = 'pending'
+class ExportFormat(str, Enum):
+    ndjson = 'ndjson'
+    csv = 'csv'
+class SearchMatch(str, Enum):
+    prefix = 'prefix'
+    substring = 'substring'
 class ShowPackagesRequest(BaseModel):
     user_id: int
     offset: int = 0
     limit: int = 20
     package_type: int = -1
     calculated_value: PackageValueStatus = PackageValueStatus.any
+    # Opaque position returned in the X-Next-Cursor header of the previous page; takes precedence over offset
+    cursor: Optional[str] = None
 
     @validator('package_type')
     def package_type_must_be_valid(cls, package_type):
@@ -89,4 +165,47 @@ class ShowPackagesRequest(BaseModel):
     def offset_must_be_valid(cls, offset):
         if offset < 0:
             raise ValueError('Invalid offset')
-        return offset
\ No newline at end of file
+        return offset
+
+    @validator('cursor')
+    def cursor_must_be_valid(cls, cursor):
+        if cursor is not None:
+            decode_cursor(cursor)
+        return cursor
+
+# Maximum length of a name search query, that of a stored name
+MAX_SEARCH_QUERY_LENGTH = 100
+
+class SearchPackagesRequest(BaseModel):
+    user_id: int
+    # Text looked for in the package names, case-insensitively, as typed when registering them
+    query: str
+    match: SearchMatch = SearchMatch.substring
+    package_type: int = -1
+    limit: int = 20
+    # Opaque position returned in the X-Next-Cursor header of the previous page
+    cursor: Optional[str] = None
+
+    @validator('query')
+    def query_must_be_valid(cls, query):
+        if not query or len(query) > MAX_SEARCH_QUERY_LENGTH:
+            raise ValueError('Invalid query')
+        return query
+
+    @validator('package_type')
+    def package_type_must_be_valid(cls, package_type):
+        if package_type < -1:
+            raise ValueError('Invalid package_type')
+        return package_type
+
+    @validator('limit')
+    def limit_must_be_valid(cls, limit):
+        if limit > 50 or limit < 1:
+            raise ValueError('Invalid limit')
+        return limit
+
+    @validator('cursor')
+    def cursor_must_be_valid(cls, cursor):
+        if cursor is not None:
+            decode_cursor(cursor)
+        return cursor
@@ -0,0 +1,150 @@
+# Search of a user's packages by name: SQL indexes on MySQL, an in-process trigram index elsewhere
+import asyncio
+import html
+import os
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import select
+from sqlalchemy.sql import Select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app import models, schemas
+from app.export import filter_packages
+from app.pagination import after_position
+from app.rate_history import PACKAGE_ROW_COLUMNS
+
+# Rows read at a time while the trigram index catches up with the packages table
+SEARCH_INDEX_CHUNK_SIZE = int(os.getenv("SEARCH_INDEX_CHUNK_SIZE", "50000"))
+
+
+def stored_form(query: str) -> str:
+    """ Returns a query as names are stored: html-escaped by schemas.PackageCreate.sanitize_name. """
+    return html.escape(query)
+
+
+def trigrams(name: str) -> set:
+    return {name[start:start + 3] for start in range(len(name) - 2)}
+
+
+class TrigramIndex:
+    """ In-process index of the package names of one database, by user and by name trigram.
+
+    Names are never changed and packages never deleted, so the index catches up by reading the rows
+    with ids above the last one it has seen; it relies on ids being committed in increasing order,
+    which holds for SQLite, where one transaction writes at a time.
+    A query is answered from the shorter of the user's packages and the packages sharing the
+    rarest trigram of the query, each candidate being checked against the whole query.
+    """
+
+    def __init__(self, chunk_size: int = SEARCH_INDEX_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.last_id = 0
+        self.names: Dict[int, str] = {}  # package id -> casefolded stored name
+        self.types: Dict[int, int] = {}  # package id -> type id
+        self.owners: Dict[int, int] = {}  # package id -> user id
+        # Package ids in increasing order, per user and per trigram of the casefolded name
+        self.by_user: Dict[int, List[int]] = defaultdict(list)
+        self.by_trigram: Dict[str, List[int]] = defaultdict(list)
+        self._lock = asyncio.Lock()
+
+    def add(self, package_id: int, user_id: int, type_id: int, name: Optional[str]):
+        name = (name or "").casefold()
+        self.names[package_id] = name
+        self.types[package_id] = type_id
+        self.owners[package_id] = user_id
+        self.by_user[user_id].append(package_id)
+        for trigram in trigrams(name):
+            self.by_trigram[trigram].append(package_id)
+        self.last_id = max(self.last_id, package_id)
+
+    async def refresh(self, db: AsyncSession) -> int:
+        """ Adds the packages stored since the last refresh and returns how many there were. """
+        added = 0
+        async with self._lock:
+            while True:
+                rows = (await db.execute(
+                    select(models.Package.id, models.Package.user_id, models.Package.type_id, models.Package.name)
+                    .where(models.Package.id > self.last_id).order_by(models.Package.id)
+                    .limit(self.chunk_size))).all()
+                for row in rows:
+                    self.add(*row)
+                added += len(rows)
+                if len(rows) < self.chunk_size:
+                    return added
+
+    def search(self, user_id: int, query: str, match: schemas.SearchMatch, package_type: int = -1,
+               after: Optional[Tuple[int, int]] = None, limit: int = 20) -> List[int]:
+        """ Returns the ids of a page of the user's packages whose stored name matches the query. """
+        query = query.casefold()
+        candidates = self.by_user.get(user_id, [])
+        for trigram in trigrams(query):
+            posting = self.by_trigram.get(trigram, [])
+            if len(posting) < len(candidates):
+                candidates = posting
+        matches = [(self.types[package_id], package_id) for package_id in candidates
+                   if self.owners[package_id] == user_id
+                   and (package_type == -1 or self.types[package_id] == package_type)
+                   and (self.names[package_id].startswith(query) if match == schemas.SearchMatch.prefix
+                        else query in self.names[package_id])
+                   and (after is None or (self.types[package_id], package_id) > after)]
+        return [package_id for _, package_id in sorted(matches)[:limit]]
+
+
+class PackageSearch:
+    """ Finds a user's packages by name on their shard, in the (type_id, id) order of /show. """
+
+    def __init__(self):
+        # Trigram indexes of the shards on databases other than MySQL, by shard index
+        self.indexes: Dict[int, TrigramIndex] = {}
+
+    async def search(self, db: AsyncSession, shard_index: int, request: schemas.SearchPackagesRequest,
+                     after: Optional[Tuple[int, int]] = None) -> list:
+        """ Returns the rows (PACKAGE_ROW_COLUMNS) of a page of the matching packages. """
+        query = stored_form(request.query)
+        if db.bind.dialect.name == "mysql":
+            return await self._search_sql(db, query, request, after)
+        index = self.indexes.setdefault(shard_index, TrigramIndex())
+        await index.refresh(db)
+        ids = index.search(request.user_id, query, request.match, request.package_type, after, request.limit)
+        if not ids:
+            return []
+        result = await db.execute(select(*PACKAGE_ROW_COLUMNS).where(models.Package.id.in_(ids))
+                                  .order_by(models.Package.type_id, models.Package.id))
+        return result.all()
+
+    async def _search_sql(self, db: AsyncSession, query: str, request: schemas.SearchPackagesRequest,
+                          after: Optional[Tuple[int, int]]) -> list:
+        return (await db.execute(search_statement(query, request, after))).all()
+
+
+def search_statement(query: str, request: schemas.SearchPackagesRequest,
+                     after: Optional[Tuple[int, int]] = None) -> Select:
+    """ MySQL query of a page of the user's packages whose stored name matches the query (in stored form).
+
+    The search is scoped by user before anything else: MySQL reads the user's entries of the
+    (user_id, name) index, a range of it for a prefix, all of them for a substring, and checks the
+    name on the index entries themselves (index condition pushdown). Only the matching packages are
+    then read and sorted into the order of /show, so the work grows with the user's packages and
+    not with the table. The index is named, or the optimizer may walk the user's (type_id, id)
+    entries to skip the sort, reading every package of the user in full to check its name.
+    """
+    statement = filter_packages(select(*PACKAGE_ROW_COLUMNS), request.user_id, request.package_type)
+    statement = statement.with_hint(models.Package, "USE INDEX (ix_packages_user_id_name)", dialect_name="mysql")
+    statement = statement.where(name_condition(query, request.match))
+    if after is not None:
+        statement = statement.where(after_position(after))
+    return statement.order_by(models.Package.type_id, models.Package.id).limit(request.limit)
+
+
+def name_condition(query: str, match: schemas.SearchMatch):
+    """ Condition on the stored name of a package (case-insensitive, as the column's collation). """
+    if match == schemas.SearchMatch.prefix:
+        return models.Package.name.startswith(query, autoescape=True)
+    return models.Package.name.contains(query, autoescape=True)
+
+
+# Name search of this worker
+package_search = PackageSearch()
+
+# Dependency that provides the name search
+def get_package_search() -> PackageSearch:
+    return package_search
@@ -0,0 +1,69 @@
+# Multi-process serving with gunicorn: worker sizing, the uvicorn worker class and the fork hooks
+import os
+import time
+from typing import Optional
+from uvicorn_worker import UvicornWorker
+import app as app_package
+
+# Explicit number of workers; when unset it follows the CPUs available to the container
+WEB_CONCURRENCY = os.getenv("WEB_CONCURRENCY")
+# Workers started per CPU, and the most ever started (0: no limit). Each worker is a single-threaded event loop,
+# so one per CPU keeps every core busy; every worker also opens its own database pools (DB_POOL_SIZE +
+# DB_MAX_OVERFLOW connections per engine), which the database's connection limit must allow for
+WORKERS_PER_CORE = float(os.getenv("WORKERS_PER_CORE", "1"))
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", "0"))
+
+# Seconds a stopping worker keeps for its shutdown handlers (group commit flush, job stop, pool close)
+# once its in-flight requests are done or cut off; the rest of GRACEFUL_TIMEOUT goes to the requests
+SHUTDOWN_HANDLERS_TIMEOUT = 5
+
+
+def available_cpus() -> int:
+    """ Returns the CPUs this process may run on, which a container's cpuset can make fewer than the host's. """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def worker_count(web_concurrency: Optional[str] = WEB_CONCURRENCY, workers_per_core: float = WORKERS_PER_CORE,
+                 max_workers: int = MAX_WORKERS, cpus: Optional[int] = None) -> int:
+    """ Returns the number of gunicorn workers to start. """
+    if web_concurrency:
+        return max(int(web_concurrency), 1)
+    workers = max(int(workers_per_core * (cpus or available_cpus())), 1)
+    return min(workers, max_workers) if max_workers > 0 else workers
+
+
+class UvloopWorker(UvicornWorker):
+    """ Uvicorn worker on the uvloop event loop and the httptools HTTP parser.
+
+    Unlike the "auto" defaults, a missing uvloop or httptools fails the worker start instead of
+    silently serving on the slower asyncio loop and h11 parser.
+    """
+
+    CONFIG_KWARGS = {"loop": "uvloop", "http": "httptools"}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # On SIGTERM uvicorn stops accepting and waits for in-flight requests; cut them off early enough for
+        # the shutdown handlers to run before gunicorn kills the worker at its graceful timeout
+        self.config.timeout_graceful_shutdown = max(self.cfg.graceful_timeout - SHUTDOWN_HANDLERS_TIMEOUT, 1)
+
+
+def reset_after_fork():
+    """ Makes a worker forked from a preloaded master open its own connections.
+
+    The engines and the Redis client are created when app.main is imported, which with preloading happens
+    once in the master. Creating them opens no connection, but any connection a pool did hold would be
+    shared by every worker's socket; the pools are emptied without closing those connections, which
+    belong to the master.
+    """
+    from app import database, redis_client
+    from app.sharding import shard_router
+    for async_engine in database.async_engines:
+        async_engine.sync_engine.dispose(close=False)
+    for shard in shard_router:
+        shard.engine.dispose(close=False)
+    redis_client.redis_client.connection_pool.reset()
+    # The worker's cold start begins at the fork, not at the master's import
+    app_package.IMPORT_STARTED = time.perf_counter()
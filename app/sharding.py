@@ -0,0 +1,181 @@
+# Horizontal sharding of packages by user_id across several databases
+import asyncio
+import bisect
+import hashlib
+import os
+from collections import defaultdict
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Sequence
+from sqlalchemy import create_engine, func, select, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from app import models
+from app.database import (AsyncSessionLocal, SessionRouter, create_pooled_async_engine, engine, pool_options,
+                          session_router, to_async_url)
+from app.metrics import instrument_engine
+
+# Optional comma-separated URLs (sync driver, like DATABASE_URL) of the shards after the first one,
+# which is the database of DATABASE_URL (with its read replicas). A shard is identified by its
+# position in this list, so new shards must only ever be appended
+DATABASE_SHARD_URLS = [url.strip() for url in os.getenv("DATABASE_SHARD_URLS", "").split(",") if url.strip()]
+
+# Low bits of a package id that number the packages within their shard; the bits above hold the
+# index of the shard, so the shard of a package follows from its id without a lookup.
+# 40 bits leave room for a trillion packages per shard, and the ids of up to 8192 shards stay
+# below 2**53, the largest integer a JSON client reading numbers as doubles gets exactly
+SHARD_ID_BITS = 40
+
+# Points of every shard on the hash ring; more points spread the users more evenly
+SHARD_VIRTUAL_NODES = int(os.getenv("SHARD_VIRTUAL_NODES", "128"))
+
+
+def ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+def id_base(index: int) -> int:
+    """ Returns the id right below the first package id of a shard. """
+    return index << SHARD_ID_BITS
+
+
+def shard_of_id(package_id: int) -> int:
+    return package_id >> SHARD_ID_BITS
+
+
+class HashRing:
+    """ Consistent hashing of user ids onto shard indexes.
+
+    Every shard owns virtual_nodes points of a 64-bit ring, and a user belongs to the shard
+    owning the first point at or after the hash of the user's id. Adding a shard only moves
+    the users now closest to one of its points, about 1/N of them, and leaves the rest in place.
+    """
+
+    def __init__(self, shard_count: int, virtual_nodes: int = SHARD_VIRTUAL_NODES):
+        points = sorted((ring_hash(f"shard-{index}-{node}"), index)
+                        for index in range(shard_count) for node in range(virtual_nodes))
+        self._hashes = [point for point, _ in points]
+        self._shards = [index for _, index in points]
+
+    def shard_for(self, user_id: int) -> int:
+        position = bisect.bisect_left(self._hashes, ring_hash(f"user-{user_id}"))
+        return self._shards[position % len(self._shards)]
+
+
+class Shard:
+    """ One database holding the packages and summaries of the users hashed to it. """
+
+    def __init__(self, index: int, sessions: async_sessionmaker, reads: Optional[SessionRouter] = None,
+                 engine=None):
+        self.index = index
+        # Sessions on the shard's primary, for writes
+        self.sessions = sessions
+        # Sessions for reads, on the shard's replicas if it has any
+        self.reads = reads or SessionRouter(sessions)
+        # Sync engine used by migrations and scripts
+        self.engine = engine
+
+
+class ShardRouter:
+    """ Maps users and packages to their shard and runs work on every shard at once. """
+
+    def __init__(self, shards: Sequence[Shard], ring: Optional[HashRing] = None):
+        self.shards = list(shards)
+        self.ring = ring or HashRing(len(self.shards))
+
+    def __len__(self) -> int:
+        return len(self.shards)
+
+    def __iter__(self):
+        return iter(self.shards)
+
+    def for_user(self, user_id: int) -> Shard:
+        if len(self.shards) == 1:
+            return self.shards[0]
+        return self.shards[self.ring.shard_for(user_id)]
+
+    def for_package(self, package_id: int) -> Optional[Shard]:
+        """ Returns the shard a package id was handed out by, or None if no such shard exists. """
+        index = shard_of_id(package_id)
+        return self.shards[index] if 0 <= index < len(self.shards) else None
+
+    def group_ids(self, package_ids: Iterable[int]) -> Dict[Shard, List[int]]:
+        """ Splits package ids by shard, dropping ids no shard could have handed out. """
+        groups = defaultdict(list)
+        for package_id in package_ids:
+            shard = self.for_package(package_id)
+            if shard is not None:
+                groups[shard].append(package_id)
+        return groups
+
+    async def gather(self, work: Callable[[Shard], Awaitable]) -> list:
+        """ Runs work on every shard concurrently and returns the results in shard order.
+
+        Every shard runs to completion even if another one fails; the first failure is raised afterwards.
+        """
+        results = await asyncio.gather(*(work(shard) for shard in self.shards), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
+
+async def copy_to_shards(router: ShardRouter, table, rows: List[dict]):
+    """ Copies rows of a reference table (ids assigned by the first shard) to the other shards.
+
+    Packages reference package types and exchange rate versions, so every shard keeps a copy of them.
+    """
+    for shard in router.shards[1:]:
+        async with shard.sessions() as db:
+            await db.execute(models.insert_ignore(table, db.get_bind().dialect.name), rows)
+            await db.commit()
+
+
+def prepare_shard(connection, index: int):
+    """ Makes the packages table of a shard hand out ids carrying the shard index; safe to run any number of times. """
+    if index == 0:
+        # The first shard keeps the ids it always had
+        return
+    base = id_base(index)
+    package_id = models.Package.id
+    lowest, highest = connection.execute(select(func.min(package_id), func.max(package_id))).one()
+    if lowest is not None and lowest <= base:
+        raise RuntimeError(f"Shard {index} holds package ids below {base + 1}, which route to another shard")
+    if highest is not None:
+        return
+    dialect_name = connection.dialect.name
+    if dialect_name == "mysql":
+        connection.execute(text(f"ALTER TABLE packages AUTO_INCREMENT = {base + 1}"))
+    elif dialect_name == "postgresql":
+        connection.execute(text("SELECT setval(pg_get_serial_sequence('packages', 'id'), :base)"), {"base": base})
+    elif dialect_name == "sqlite":
+        # Only an AUTOINCREMENT table takes its next id from sqlite_sequence
+        schema = connection.execute(text("SELECT sql FROM sqlite_master WHERE name = 'packages'")).scalar()
+        if "AUTOINCREMENT" not in schema.upper():
+            raise RuntimeError("The packages table of a SQLite shard must be created with AUTOINCREMENT")
+        connection.execute(text("DELETE FROM sqlite_sequence WHERE name = 'packages'"))
+        connection.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES ('packages', :base)"), {"base": base})
+    else:
+        raise NotImplementedError(f"No shard id ranges for the {dialect_name} dialect")
+
+
+def create_schema(shard: Shard):
+    """ Creates missing tables, registers the package types and sets the id range of a shard. """
+    models.Base.metadata.create_all(bind=shard.engine)
+    models.register_package_types(bind=shard.engine)
+    with shard.engine.begin() as connection:
+        prepare_shard(connection, shard.index)
+
+
+def build_shard(index: int, url: str) -> Shard:
+    """ Creates the engines of a shard after the first one from its sync URL. """
+    async_engine = create_pooled_async_engine(to_async_url(url))
+    instrument_engine(async_engine.sync_engine, f"shard{index}")
+    return Shard(index, async_sessionmaker(async_engine, expire_on_commit=False, class_=AsyncSession),
+                 engine=create_engine(url, **pool_options(url)))
+
+
+# Shards of this worker: the primary database first, then those of DATABASE_SHARD_URLS
+shard_router = ShardRouter([Shard(0, AsyncSessionLocal, session_router, engine)] +
+                           [build_shard(index, url) for index, url in enumerate(DATABASE_SHARD_URLS, start=1)])
+
+# Dependency that provides the shard router
+def get_shard_router() -> ShardRouter:
+    return shard_router
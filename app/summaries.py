@@ -0,0 +1,165 @@
+# Per-user, per-type package aggregates maintained incrementally on every write
+#
+# Usage: python -m app.summaries rebuild [--user-id ID]
+import argparse
+import asyncio
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import case, delete, func, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app import models
+from app.sharding import shard_router
+
+# Aggregated columns of package_summaries, in the order of the deltas below
+SUMMARY_COLUMNS = ("packages", "total_weight", "total_value", "total_delivery_cost",
+                   "pending_packages", "pending_weight", "pending_value")
+
+
+def adding_upsert(table, columns: Iterable[str], dialect_name: str):
+    """ Returns an INSERT adding the values it is executed with to the columns of existing rows, creating missing ones.
+
+    Executed with a list of rows rather than built with a multi-row VALUES clause, so the
+    statement is compiled once and cached instead of once per batch of deltas.
+    """
+    if dialect_name == "mysql":
+        from sqlalchemy.dialects.mysql import insert as dialect_insert
+        statement = dialect_insert(table)
+        return statement.on_duplicate_key_update(
+            {column: table.c[column] + statement.inserted[column] for column in columns})
+    if dialect_name in ("sqlite", "postgresql"):
+        if dialect_name == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        statement = dialect_insert(table)
+        return statement.on_conflict_do_update(
+            index_elements=list(table.primary_key),
+            set_={column: table.c[column] + statement.excluded[column] for column in columns})
+    raise NotImplementedError(f"No upsert of {table.name} for the {dialect_name} dialect")
+
+
+def summary_upsert(dialect_name: str):
+    """ Returns an INSERT adding the deltas it is executed with to the summary rows, creating missing ones. """
+    return adding_upsert(models.PackageSummary.__table__, SUMMARY_COLUMNS, dialect_name)
+
+
+async def apply_deltas(db: AsyncSession, deltas: Dict[Tuple[int, int], list]):
+    """ Adds per-(user_id, type_id) deltas to the summary in one executemany and bumps the users' change counters.
+
+    The caller commits.
+    """
+    if not deltas:
+        return
+    dialect_name = db.get_bind().dialect.name
+    rows = [{"user_id": user_id, "type_id": type_id, **dict(zip(SUMMARY_COLUMNS, values))}
+            for (user_id, type_id), values in sorted(deltas.items())]
+    await db.execute(summary_upsert(dialect_name), rows)
+    # Every write to packages goes through here, so the counters change whenever a user's packages do
+    await db.execute(adding_upsert(models.UserVersion.__table__, ("version",), dialect_name),
+                     [{"user_id": user_id, "version": 1} for user_id in sorted({user_id for user_id, _ in deltas})])
+
+
+async def user_version(db: AsyncSession, user_id: int) -> int:
+    """ Returns the change counter of a user's packages (0 before the first write). """
+    result = await db.execute(select(models.UserVersion.version).where(models.UserVersion.user_id == user_id))
+    return result.scalar() or 0
+
+
+async def record_registered(db: AsyncSession, packages: Iterable[dict]):
+    """ Counts newly inserted packages (dicts with user_id, type_id, weight, value and delivery_cost). """
+    deltas = defaultdict(lambda: [0, 0.0, 0.0, 0.0, 0, 0.0, 0.0])
+    for package in packages:
+        delta = deltas[package["user_id"], package["type_id"]]
+        cost = package.get("delivery_cost")
+        delta[0] += 1
+        delta[1] += package["weight"]
+        delta[2] += package["value"]
+        if cost is None:
+            delta[4] += 1
+            delta[5] += package["weight"]
+            delta[6] += package["value"]
+        else:
+            delta[3] += cost
+    await apply_deltas(db, deltas)
+
+
+async def pending_groups(db: AsyncSession, condition, cost_expression) -> Dict[Tuple[int, int], list]:
+    """ Locks the packages without a delivery cost that match condition and returns the deltas of pricing them.
+
+    Must run in the transaction of the UPDATE writing the costs, so that no other worker
+    prices (and counts) the same packages in between. The rows are locked by a plain
+    SELECT ... FOR UPDATE and added up here: PostgreSQL rejects FOR UPDATE with GROUP BY.
+    """
+    package = models.Package
+    result = await db.execute(
+        select(package.user_id, package.type_id, package.weight, package.value, cost_expression)
+        .where(condition, package.delivery_cost.is_(None))
+        .with_for_update())
+    deltas = defaultdict(lambda: [0, 0.0, 0.0, 0.0, 0, 0.0, 0.0])
+    for user_id, type_id, weight, value, cost in result.all():
+        delta = deltas[user_id, type_id]
+        delta[3] += cost or 0.0
+        delta[4] -= 1
+        delta[5] -= weight or 0.0
+        delta[6] -= value or 0.0
+    return dict(deltas)
+
+
+def aggregate_query(user_id: Optional[int] = None):
+    """ Returns a SELECT computing the summary rows from the packages themselves. """
+    package = models.Package
+    pending = package.delivery_cost.is_(None)
+    query = (select(package.user_id, package.type_id, func.count(),
+                    func.coalesce(func.sum(package.weight), 0), func.coalesce(func.sum(package.value), 0),
+                    func.coalesce(func.sum(package.delivery_cost), 0),
+                    func.sum(case((pending, 1), else_=0)),
+                    func.coalesce(func.sum(case((pending, package.weight))), 0),
+                    func.coalesce(func.sum(case((pending, package.value))), 0))
+             .where(package.user_id.is_not(None), package.type_id.is_not(None))
+             .group_by(package.user_id, package.type_id))
+    if user_id is not None:
+        query = query.where(package.user_id == user_id)
+    return query
+
+
+async def rebuild(db: AsyncSession, user_id: Optional[int] = None) -> int:
+    """ Recomputes the summary (of one user, or of everyone) from the packages and returns the number of rows. """
+    summary = models.PackageSummary
+    statement = delete(summary)
+    if user_id is not None:
+        statement = statement.where(summary.user_id == user_id)
+    await db.execute(statement)
+    result = await db.execute(insert(summary).from_select(("user_id", "type_id") + SUMMARY_COLUMNS,
+                                                          aggregate_query(user_id)))
+    await db.commit()
+    return result.rowcount
+
+
+async def user_summary(db: AsyncSession, user_id: int) -> List[models.PackageSummary]:
+    """ Returns the summary rows of a user, one per package type they own. """
+    result = await db.execute(select(models.PackageSummary).where(models.PackageSummary.user_id == user_id)
+                              .order_by(models.PackageSummary.type_id))
+    return result.scalars().all()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the per-user package summaries.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    rebuild_parser = commands.add_parser("rebuild", help="recompute the summaries from the packages")
+    rebuild_parser.add_argument("--user-id", type=int, default=None, help="only rebuild this user's summary")
+    args = parser.parse_args()
+
+    async def run():
+        # A user's packages and summary rows live on the user's shard
+        shards = [shard_router.for_user(args.user_id)] if args.user_id is not None else shard_router.shards
+        rows = 0
+        for shard in shards:
+            async with shard.sessions() as db:
+                rows += await rebuild(db, args.user_id)
+        return rows
+
+    print(f"Rebuilt {asyncio.run(run())} summary rows")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+import pytest
+from app import models
+from app.database import engine
+
+
+@pytest.fixture(scope="session", autouse=True)
+def database_schema():
+    """ Creates the tables and package types the tests run against; importing the app no longer does. """
+    models.Base.metadata.create_all(bind=engine)
+    models.register_package_types()
@@ -0,0 +1,139 @@
+import asyncio
+import time
+import httpx
+import pytest
+from fakeredis import aioredis as fake_aioredis
+from fastapi import FastAPI
+from redis.exceptions import ConnectionError as RedisConnectionError
+from sqlalchemy.ext.asyncio import create_async_engine
+from app.admission import AdmissionController, AdmissionMiddleware, parse_route_limits
+from app.database import MonitoredPool
+
+
+class FakePool:
+    """ Stands in for a MonitoredPool. """
+
+    def __init__(self, capacity=10):
+        self._capacity = capacity
+        self.checked_out = 0
+        self.waiting = 0
+        self.last_wait = 0.0
+        self.last_wait_at = 0.0
+
+    def capacity(self):
+        return self._capacity
+
+    def checkedout(self):
+        return self.checked_out
+
+
+class BrokenRedis:
+    async def eval(self, *args):
+        raise RedisConnectionError("Redis is down")
+
+
+def limited_app(controller):
+    app = FastAPI()
+
+    @app.get("/package/{package_id}")
+    async def get_package(package_id: int):
+        return {"id": package_id}
+
+    @app.get("/metrics")
+    async def metrics():
+        return {}
+
+    app.add_middleware(AdmissionMiddleware, controller=controller)
+    return app
+
+
+def client(controller):
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=limited_app(controller)), base_url="http://test")
+
+
+def controller(redis=None, pool=None, **options):
+    return AdmissionController(redis or fake_aioredis.FakeRedis(), enabled=True,
+                               pools=lambda: [pool] if pool is not None else [], **options)
+
+
+def test_route_limits_are_parsed():
+    assert parse_route_limits("POST /register=100/200, get /package/{package_id}=5,") == {
+        "POST /register": (100.0, 200.0), "GET /package/{package_id}": (5.0, 5.0)}
+
+
+@pytest.mark.asyncio
+async def test_caller_bucket_allows_a_burst_then_refills():
+    admission = controller(caller_rate=2, caller_burst=3, route_limits={})
+    async with client(admission) as app_client:
+        statuses = [(await app_client.get("/package/1", headers={"X-User-Id": "7"})).status_code for _ in range(4)]
+        assert statuses == [200, 200, 200, 429]
+        response = await app_client.get("/package/1", headers={"X-User-Id": "7"})
+        assert response.status_code == 429 and response.headers["Retry-After"] == "1"
+        # Other callers have buckets of their own; exempt paths are never limited
+        assert (await app_client.get("/package/1", headers={"X-User-Id": "8"})).status_code == 200
+        assert (await app_client.get("/metrics", headers={"X-User-Id": "7"})).status_code == 200
+
+        await asyncio.sleep(0.5)  # One token at 2 per second
+        assert (await app_client.get("/package/1", headers={"X-User-Id": "7"})).status_code == 200
+        assert (await app_client.get("/package/1", headers={"X-User-Id": "7"})).status_code == 429
+
+
+@pytest.mark.asyncio
+async def test_buckets_run_on_the_redis_clock():
+    redis = fake_aioredis.FakeRedis()
+    # Left by a worker whose clock ran an hour ahead; the next call puts the bucket back on the server's clock
+    await redis.hset("admission:caller:user:7", mapping={"tokens": "0", "ts": str(int(time.time() * 1000) + 3600000)})
+    admission = controller(redis=redis, caller_rate=1000, caller_burst=1, route_limits={})
+    await asyncio.sleep(0.01)
+    assert await admission.wait_ms("user:7", None) > 0
+    seconds, microseconds = await redis.time()
+    stored = int(await redis.hget("admission:caller:user:7", "ts"))
+    assert abs(stored - (seconds * 1000 + microseconds // 1000)) < 1000
+    await asyncio.sleep(0.01)
+    assert await admission.wait_ms("user:7", None) == 0
+
+
+@pytest.mark.asyncio
+async def test_route_bucket_is_shared_by_all_callers():
+    admission = controller(caller_rate=100, caller_burst=100,
+                           route_limits={"GET /package/{package_id}": (1, 2)})
+    async with client(admission) as app_client:
+        statuses = [(await app_client.get(f"/package/{user_id}", headers={"X-User-Id": str(user_id)})).status_code
+                    for user_id in range(3)]
+    assert statuses == [200, 200, 429]
+
+
+@pytest.mark.asyncio
+async def test_saturated_pool_sheds_load_before_touching_redis():
+    pool = FakePool(capacity=10)
+    admission = controller(redis=BrokenRedis(), pool=pool, busy_ratio=0.9, max_pool_wait_ms=100, route_limits={})
+    async with client(admission) as app_client:
+        # Redis being down admits everyone
+        assert (await app_client.get("/package/1")).status_code == 200
+
+        pool.checked_out, pool.waiting = 10, 3
+        response = await app_client.get("/package/1")
+        assert response.status_code == 503 and response.headers["Retry-After"] == "1"
+
+        # Once the queue drains, a recent slow checkout still sheds until the window has passed
+        pool.checked_out, pool.waiting = 4, 0
+        pool.last_wait, pool.last_wait_at = 0.3, time.monotonic()
+        assert (await app_client.get("/package/1")).status_code == 503
+        pool.last_wait_at -= 5
+        assert (await app_client.get("/package/1")).status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_monitored_pool_counts_callers_waiting_for_a_connection(tmp_path):
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'pool.db'}", poolclass=MonitoredPool,
+                                       pool_size=1, max_overflow=0)
+    pool = async_engine.sync_engine.pool
+    assert pool.capacity() == 1
+    async with async_engine.connect():
+        waiter = asyncio.ensure_future(async_engine.connect().start())
+        await asyncio.sleep(0.1)
+        assert pool.waiting == 1 and pool.checkedout() == 1
+    connection = await waiter
+    await connection.close()
+    assert pool.waiting == 0 and pool.last_wait >= 0.1
+    await async_engine.dispose()
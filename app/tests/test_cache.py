@@ -0,0 +1,56 @@
+import asyncio
+import pytest
+from fakeredis import aioredis as fake_aioredis
+from app import schemas
+from app.cache import PackageCache
+
+
+@pytest.fixture
+def cache():
+    # Local Redis stand-in, so these tests do not need the docker-compose Redis
+    return PackageCache(fake_aioredis.FakeRedis(), package_ttl=60)
+
+
+@pytest.mark.asyncio
+async def test_package_cache_read_through(cache):
+    package = schemas.PackageRecord(id=1, name="Cached Package", weight=2.5, type_id=1, value=100.0, user_id=164)
+
+    # The first lookup misses, the one after storing hits
+    assert await cache.get_package(1) is None
+    await cache.set_package(package)
+    assert await cache.get_package(1) == package
+    assert cache.stats()["package"] == {"hits": 1, "misses": 1}
+
+
+@pytest.mark.asyncio
+async def test_package_cache_invalidation(cache):
+    package = schemas.PackageRecord(id=2, name="Cached Package", weight=2.5, type_id=1, value=100.0, user_id=164)
+    await cache.set_package(package)
+
+    await cache.invalidate_packages([2])
+    assert await cache.get_package(2) is None
+
+
+@pytest.mark.asyncio
+async def test_package_cache_ttl(cache):
+    package = schemas.PackageRecord(id=3, name="Cached Package", weight=2.5, type_id=1, value=100.0, user_id=164)
+    await cache.set_package(package)
+
+    assert 0 < await cache.client.ttl(cache.package_key(3)) <= 60
+
+
+
+@pytest.mark.asyncio
+async def test_row_read_before_an_invalidation_is_not_stored(cache):
+    cache.invalidation_ms = 100
+    stale = schemas.PackageRecord(id=4, name="Cached Package", weight=2.5, type_id=1, value=100.0, user_id=164)
+
+    # A request reads the row, then a write commits and invalidates it before the request stores the row
+    await cache.invalidate_packages([4])
+    assert await cache.set_package(stale) is False
+    assert await cache.get_package(4) is None
+
+    # Once the marker is gone, reads fill the cache again
+    await asyncio.sleep(0.15)
+    assert await cache.set_package(stale) is True
+    assert await cache.get_package(4) == stale
@@ -0,0 +1,127 @@
+import httpx
+import pytest
+from fakeredis import aioredis as fake_aioredis
+from sqlalchemy import event, select
+from app import models
+from app.cache import PackageCache, get_package_cache
+from app.costs import recompute_delivery_costs
+from app.cost_worker import CostQueue, get_cost_queue
+from app.database import AsyncSessionLocal, SessionRouter, async_engine
+from app.main import app
+from app.rates import ExchangeRateProvider, get_rate_provider
+from app.responses import etag_matches
+from app.sharding import Shard, ShardRouter, get_shard_router
+
+USER_ID = 9168
+
+
+class FakeRateSource:
+    async def fetch(self):
+        return 75.0
+
+
+@pytest.fixture
+async def app_client():
+    redis = fake_aioredis.FakeRedis()
+    # The rate is not fetched yet, so registered packages stay pending until the cost job prices them
+    app.dependency_overrides[get_rate_provider] = lambda: ExchangeRateProvider(FakeRateSource(), redis)
+    app.dependency_overrides[get_cost_queue] = lambda: CostQueue(redis, stream="test:conditional")
+    app.dependency_overrides[get_package_cache] = lambda: PackageCache(redis)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as app_client:
+        yield app_client
+    app.dependency_overrides.clear()
+
+
+@pytest.fixture
+def statements():
+    """ SQL statements run by the app while the test runs. """
+    executed = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        executed.append(statement)
+
+    event.listen(async_engine.sync_engine, "before_cursor_execute", record)
+    yield executed
+    event.remove(async_engine.sync_engine, "before_cursor_execute", record)
+
+
+def test_if_none_match_lists_and_weak_tags():
+    assert etag_matches('"a", W/"7.1"', '"7.1"')
+    assert etag_matches("*", '"7.1"')
+    assert not etag_matches('"7.2"', '"7.1"') and not etag_matches(None, '"7.1"')
+
+
+@pytest.mark.asyncio
+async def test_package_is_revalidated_without_loading_it(app_client, statements):
+    response = await app_client.post("/register", json={
+        "name": "Polled", "weight": 2.0, "type_id": 1, "value": 10.0, "user_id": USER_ID})
+    package_id = response.json()["id"]
+    response = await app_client.get(f"/package/{package_id}")
+    etag = response.headers["ETag"]
+    assert response.json()["delivery_cost"] is None
+
+    # Not cached: only the version is read
+    await app.dependency_overrides[get_package_cache]().invalidate_packages([package_id])
+    statements.clear()
+    response = await app_client.get(f"/package/{package_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 304 and response.headers["ETag"] == etag and not response.content
+    assert not any("packages.name" in statement for statement in statements)
+
+    # Pricing bumps the version, so the next poll gets the cost
+    async with AsyncSessionLocal() as db:
+        await recompute_delivery_costs(db, 75.0)
+    await app.dependency_overrides[get_package_cache]().invalidate_packages([package_id])
+    response = await app_client.get(f"/package/{package_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 200 and response.json()["delivery_cost"] is not None
+    assert response.headers["ETag"] != etag
+    assert (await app_client.get(f"/package/{package_id}",
+                                 headers={"If-None-Match": response.headers["ETag"]})).status_code == 304
+
+
+@pytest.mark.asyncio
+async def test_show_follows_the_users_change_counter(app_client, statements):
+    page = {"user_id": USER_ID, "limit": 50}
+    response = await app_client.post("/show", json=page)
+    etag = response.headers["ETag"]
+
+    statements.clear()
+    response = await app_client.post("/show", json=page, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert any("user_versions" in statement for statement in statements)
+    assert not any("FROM packages" in statement for statement in statements)
+    # Another page of the same user is another entity
+    assert (await app_client.post("/show", json={**page, "limit": 10},
+                                  headers={"If-None-Match": etag})).status_code == 200
+
+    await app_client.post("/register", json={
+        "name": "Polled", "weight": 1.0, "type_id": 2, "value": 5.0, "user_id": USER_ID})
+    response = await app_client.post("/show", json=page, headers={"If-None-Match": etag})
+    assert response.status_code == 200 and response.headers["ETag"] != etag
+
+    etag = response.headers["ETag"]
+    async with AsyncSessionLocal() as db:
+        await recompute_delivery_costs(db, 75.0)
+        version = (await db.execute(select(models.UserVersion.version)
+                                    .where(models.UserVersion.user_id == USER_ID))).scalar_one()
+    response = await app_client.post("/show", json=page, headers={"If-None-Match": etag})
+    assert response.status_code == 200 and f".{version}." in response.headers["ETag"]
+
+
+@pytest.mark.asyncio
+async def test_replica_reads_do_not_fill_the_cache(app_client):
+    response = await app_client.post("/register", json={
+        "name": "Replicated", "weight": 2.0, "type_id": 1, "value": 10.0, "user_id": USER_ID})
+    package_id = response.json()["id"]
+    cache = app.dependency_overrides[get_package_cache]()
+
+    # The primary doubles as the replica: the reads are answered, but a replica might lag behind
+    replicated = ShardRouter([Shard(0, AsyncSessionLocal, SessionRouter(AsyncSessionLocal, [AsyncSessionLocal]))])
+    app.dependency_overrides[get_shard_router] = lambda: replicated
+    assert (await app_client.get(f"/package/{package_id}")).json()["name"] == "Replicated"
+    assert await cache.get_package(package_id) is None
+
+    del app.dependency_overrides[get_shard_router]
+    # Past the invalidation marker the registration left, primary reads fill the cache
+    await cache.client.delete(cache.invalidated_key(package_id))
+    await app_client.get(f"/package/{package_id}")
+    assert (await cache.get_package(package_id)).name == "Replicated"
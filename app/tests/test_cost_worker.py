@@ -0,0 +1,69 @@
+import httpx
+import pytest
+from fakeredis import aioredis as fake_aioredis
+from sqlalchemy import select
+from app.cost_worker import CostQueue, CostStreamWorker, get_cost_queue
+from app.database import AsyncSessionLocal
+from app.main import app
+from app.models import Package
+from app.rates import ExchangeRateProvider, get_rate_provider
+from app.sharding import Shard, ShardRouter
+
+
+class FakeRateSource:
+    async def fetch(self):
+        return 75.0
+
+
+@pytest.fixture
+def redis():
+    return fake_aioredis.FakeRedis()
+
+
+@pytest.fixture
+async def app_client(redis):
+    # A provider that has not fetched the rate yet, so registrations are queued instead of priced inline
+    provider = ExchangeRateProvider(FakeRateSource(), redis)
+    queue = CostQueue(redis, stream="test:cost_pending")
+    app.dependency_overrides[get_rate_provider] = lambda: provider
+    app.dependency_overrides[get_cost_queue] = lambda: queue
+    async with httpx.AsyncClient(app=app, base_url="http://test") as app_client:
+        yield app_client
+    app.dependency_overrides.clear()
+
+
+@pytest.mark.asyncio
+async def test_registered_package_is_priced_by_the_stream_worker(app_client, redis):
+    response = await app_client.post("/register", json={
+        "name": "Streamed Package", "weight": 4.0, "type_id": 1, "value": 200.0, "user_id": 165,
+    })
+    assert response.status_code == 200
+    package_id = response.json()["id"]
+    assert response.json()["delivery_cost"] is None
+    assert await redis.xlen("test:cost_pending") == 1
+
+    worker = CostStreamWorker(redis, ExchangeRateProvider(FakeRateSource(), redis),
+                              ShardRouter([Shard(0, AsyncSessionLocal)]),
+                              stream="test:cost_pending", consumer="test", block_ms=10)
+    await worker.ensure_group()
+    assert await worker.process_batch() == 1
+    # Processed entries are acknowledged and removed from the stream
+    assert await redis.xlen("test:cost_pending") == 0
+
+    async with AsyncSessionLocal() as session:
+        package = (await session.execute(select(Package).filter_by(id=package_id))).scalar_one()
+        assert package.delivery_cost == (4.0 * 0.5 + 200.0 * 0.01) * 75.0
+
+
+@pytest.mark.asyncio
+async def test_registered_package_is_priced_inline_when_rate_is_known(app_client, redis):
+    provider = ExchangeRateProvider(FakeRateSource(), redis)
+    await provider.get_rate()
+    app.dependency_overrides[get_rate_provider] = lambda: provider
+
+    response = await app_client.post("/register", json={
+        "name": "Inline Package", "weight": 4.0, "type_id": 1, "value": 200.0, "user_id": 165,
+    })
+    assert response.status_code == 200
+    assert response.json()["delivery_cost"] == (4.0 * 0.5 + 200.0 * 0.01) * 75.0
+    assert await redis.xlen("test:cost_pending") == 0
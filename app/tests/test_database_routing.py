@@ -0,0 +1,72 @@
+import pytest
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from app.database import SessionRouter, reads_replica
+
+
+def make_factory(url):
+    return async_sessionmaker(create_async_engine(url), expire_on_commit=False, class_=AsyncSession)
+
+
+async def database_name(db):
+    return (await db.execute(text("SELECT name FROM origin"))).scalar_one()
+
+
+@pytest.fixture
+async def databases(tmp_path):
+    """ A primary and two replicas as SQLite files, each knowing its own name. """
+    factories = {}
+    for name in ("primary", "replica0", "replica1"):
+        factory = make_factory(f"sqlite+aiosqlite:///{tmp_path / name}.db")
+        async with factory() as db:
+            await db.execute(text("CREATE TABLE origin (name TEXT)"))
+            await db.execute(text("INSERT INTO origin VALUES (:name)"), {"name": name})
+            await db.commit()
+        factories[name] = factory
+    return factories
+
+
+@pytest.mark.asyncio
+async def test_reads_are_spread_over_replicas(databases):
+    router = SessionRouter(databases["primary"], [databases["replica0"], databases["replica1"]])
+    names = []
+    for _ in range(4):
+        db = await router.read_session()
+        names.append(await database_name(db))
+        assert reads_replica(db)
+        await db.close()
+    assert names == ["replica0", "replica1", "replica0", "replica1"]
+
+
+@pytest.mark.asyncio
+async def test_unreachable_replica_is_skipped_until_retry(databases, tmp_path):
+    now = [0.0]
+    broken = make_factory(f"sqlite+aiosqlite:///{tmp_path / 'missing' / 'replica.db'}")
+    router = SessionRouter(databases["primary"], [broken, databases["replica1"]], retry_after=30,
+                           clock=lambda: now[0])
+
+    db = await router.read_session()
+    assert await database_name(db) == "replica1"
+    await db.close()
+    assert router._unhealthy_until[0] == 30
+
+    # While the broken replica is being skipped, every read goes to the healthy one
+    for _ in range(3):
+        db = await router.read_session()
+        assert await database_name(db) == "replica1"
+        await db.close()
+
+
+@pytest.mark.asyncio
+async def test_reads_fall_back_to_primary(databases, tmp_path):
+    broken = make_factory(f"sqlite+aiosqlite:///{tmp_path / 'missing' / 'replica.db'}")
+    router = SessionRouter(databases["primary"], [broken])
+    for _ in range(2):
+        db = await router.read_session()
+        assert await database_name(db) == "primary"
+        await db.close()
+
+    # Without replicas every read goes to the primary
+    db = await SessionRouter(databases["primary"]).read_session()
+    assert await database_name(db) == "primary" and not reads_replica(db)
+    await db.close()
@@ -0,0 +1,52 @@
+import json
+import pytest
+from app import models, schemas
+from app.database import AsyncSessionLocal, SessionRouter
+from app.export import export_packages
+from app.rate_history import RateHistory
+
+USER_ID = 6217
+
+
+class RecordingRouter(SessionRouter):
+    """ Session router remembering the sessions it hands out. """
+
+    def __init__(self):
+        super().__init__(AsyncSessionLocal)
+        self.sessions = []
+
+    async def read_session(self):
+        db = await super().read_session()
+        self.sessions.append(db)
+        return db
+
+
+class RecordingHistory(RateHistory):
+    """ Rate history remembering the sessions it looks rates up through. """
+
+    def __init__(self):
+        super().__init__(lazy=False)
+        self.lookups = []
+
+    async def rate(self, db, version):
+        if version not in self._rates:
+            self.lookups.append(db)
+        return await super().rate(db, version)
+
+
+@pytest.mark.asyncio
+async def test_rates_are_not_looked_up_on_the_streaming_session():
+    async with AsyncSessionLocal() as db:
+        version = await RateHistory(lazy=False).publish(db, 64.5)
+        db.add_all([models.Package(name=f"Export {index}", weight=2.0, type_id=1, value=100.0, user_id=USER_ID,
+                                   rate_version=version) for index in range(5)])
+        await db.commit()
+    router, history = RecordingRouter(), RecordingHistory()
+    chunks = [chunk async for chunk in export_packages([router], history, schemas.ExportFormat.ndjson,
+                                                       batch_size=2, user_id=USER_ID)]
+
+    packages = [json.loads(line) for chunk in chunks for line in chunk.splitlines()]
+    assert [package["delivery_cost"] for package in packages] == [(2.0 * 0.5 + 100.0 * 0.01) * 64.5] * 5
+    # The version was not memoized, so it was looked up while the rows were streamed, on another session
+    streaming = router.sessions[0]
+    assert history.lookups and all(db is not streaming for db in history.lookups)
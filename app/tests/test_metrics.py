@@ -0,0 +1,41 @@
+import httpx
+import pytest
+from app.main import app
+from app.metrics import Counter, Histogram
+
+
+def test_counter_renders_labels():
+    counter = Counter("test_events_total", "Test events", ("kind",))
+    counter.inc(kind="a")
+    counter.inc(2, kind="a")
+    counter.inc(kind='quoted "b"')
+
+    rendered = counter.render()
+    assert "# TYPE test_events_total counter" in rendered
+    assert 'test_events_total{kind="a"} 3' in rendered
+    assert 'test_events_total{kind="quoted \\"b\\""} 1' in rendered
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram("test_latency_seconds", "Test latency", buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 5.0):
+        histogram.observe(value)
+
+    rendered = histogram.render()
+    assert 'test_latency_seconds_bucket{le="0.1"} 1' in rendered
+    assert 'test_latency_seconds_bucket{le="1.0"} 2' in rendered
+    assert 'test_latency_seconds_bucket{le="+Inf"} 3' in rendered
+    assert "test_latency_seconds_count 3" in rendered
+    assert histogram.count() == 3
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint_reports_requests():
+    async with httpx.AsyncClient(app=app, base_url="http://test") as app_client:
+        await app_client.get("/metrics")
+        response = await app_client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'http_requests_total{method="GET",route="/metrics",status="200"}' in response.text
+    assert "http_request_duration_seconds_bucket" in response.text
@@ -0,0 +1,45 @@
+from sqlalchemy import Column, Float, ForeignKey, Integer, MetaData, String, Table, create_engine, inspect, select
+from sqlalchemy.orm import Session
+from app import models
+from app.migrate import migrate_shard
+from app.sharding import Shard
+
+
+def baseline_metadata() -> MetaData:
+    """ The tables the service created with metadata.create_all before it had migrations. """
+    metadata = MetaData()
+    Table("package_types", metadata,
+          Column("id", Integer, primary_key=True, index=True),
+          Column("name", String(50), unique=True, index=True))
+    Table("packages", metadata,
+          Column("id", Integer, primary_key=True, index=True),
+          Column("name", String(100), index=True),
+          Column("weight", Float),
+          Column("type_id", Integer, ForeignKey("package_types.id")),
+          Column("value", Float),
+          Column("delivery_cost", Float, nullable=True),
+          Column("user_id", Integer, index=True))
+    return metadata
+
+
+def test_database_of_the_baseline_schema_is_migrated(tmp_path):
+    engine = create_engine(f"sqlite+pysqlite:///{tmp_path / 'baseline.db'}")
+    metadata = baseline_metadata()
+    metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(metadata.tables["package_types"].insert(), [{"id": 1, "name": "clothing"}])
+        connection.execute(metadata.tables["packages"].insert(), [
+            {"name": "Old", "weight": 2.0, "type_id": 1, "value": 100.0, "delivery_cost": 150.0, "user_id": 7}])
+
+    migrate_shard(Shard(0, None, engine=engine))
+
+    inspector = inspect(engine)
+    assert "exchange_rates" in inspector.get_table_names()
+    assert "rate_version" in {column["name"] for column in inspector.get_columns("packages")}
+    assert "ix_packages_user_id_type_id_id" in {index["name"] for index in inspector.get_indexes("packages")}
+    with Session(engine) as db:
+        [package] = db.scalars(select(models.Package)).all()
+        summary = db.get(models.PackageSummary, (7, 1))
+    assert (package.name, package.delivery_cost, package.rate_version) == ("Old", 150.0, None)
+    assert summary.packages == 1
+    engine.dispose()
@@ -0,0 +1,18 @@
+from sqlalchemy import create_engine, select
+from app import models
+
+
+def test_package_types_are_seeded_idempotently(tmp_path):
+    engine = create_engine(f"sqlite+pysqlite:///{tmp_path / 'seed.db'}")
+    models.Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        connection.execute(models.PackageType.__table__.insert().values(id=1, name="clothing"))
+
+    # Registering again, e.g. from every deployment, neither fails nor duplicates types
+    models.register_package_types(engine)
+    models.register_package_types(engine)
+
+    with engine.connect() as connection:
+        rows = connection.execute(select(models.PackageType.id, models.PackageType.name)
+                                  .order_by(models.PackageType.id)).all()
+    assert [tuple(row) for row in rows] == [(type_id, name) for name, type_id in models.PACKAGE_TYPES.items()]
@@ -1,4 +1,7 @@
 import asyncio
+import csv
+import io
+import json
 import httpx
 import pytest
 from sqlalchemy import text, delete
@@ -135,9 +138,11 @@ async def test_get_package(app_client):
     assert response.status_code == 200
 
     package = response.json()
+    # The cost is filled in at registration only if the worker already knows the exchange rate
+    delivery_cost = package.pop('delivery_cost')
+    assert delivery_cost is None or delivery_cost > 0
     # Verify the package data
-    expected_data = {'delivery_cost': None,
-                     'id': package_id,
+    expected_data = {'id': package_id,
                      'name': 'Valid Package',
                      'type_id': 1,
                      'value': 100.0,
@@ -332,3 +337,129 @@ async def test_get_package_invalid_id(app_client):
     assert response.status_code == 422
     error_response = response.json()
     assert error_response["detail"][0]["msg"] == "Input should be a valid integer, unable to parse string as an integer"
+
+
+@pytest.mark.asyncio
+async def test_show_packages_cursor_pagination(app_client, add_packages_for_user):
+    user_id = 164
+    limit = 3
+
+    # Walk all pages of the user's packages by following the X-Next-Cursor header
+    seen_ids = []
+    request = {"user_id": user_id, "limit": limit}
+    while True:
+        response = await app_client.post("/show", json=request)
+        assert response.status_code == 200
+        packages = response.json()
+        seen_ids.extend(package["id"] for package in packages)
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+        request["cursor"] = cursor
+
+    # Every package is returned exactly once
+    assert len(seen_ids) == len(set(seen_ids))
+    assert len(seen_ids) >= 8
+
+
+@pytest.mark.asyncio
+async def test_show_packages_calculated_value_filter(app_client, add_packages_for_user):
+    response = await app_client.post("/show", json={
+        "user_id": 164,
+        "limit": 50,
+        "calculated_value": "calculated",
+    })
+    assert response.status_code == 200
+    for package in response.json():
+        assert package["delivery_cost"] is not None
+
+
+@pytest.mark.asyncio
+async def test_show_packages_invalid_cursor(app_client):
+    response = await app_client.post("/show", json={
+        "user_id": 164,
+        "cursor": "not a cursor",
+    })
+    assert response.status_code == 422
+    assert response.json()["detail"][0]["msg"] == "Value error, Invalid cursor"
+
+
+@pytest.mark.asyncio
+async def test_register_packages_batch(app_client):
+    valid = {"name": "Batch Package", "weight": 1.5, "type_id": 2, "value": 20.0, "user_id": 164}
+    response = await app_client.post("/register/batch", json=[
+        valid,
+        {**valid, "weight": -1.0},  # invalid weight
+        valid,
+    ])
+    assert response.status_code == 200
+    result = response.json()
+    assert result["ids"][1] is None
+    assert result["errors"] == [{"index": 1, "detail": ["Value error, Weight must be non-negative"]}]
+
+    # The returned ids point at the inserted packages
+    for package_id in (result["ids"][0], result["ids"][2]):
+        response = await app_client.get(f"/package/{package_id}")
+        assert response.status_code == 200
+        assert response.json()["name"] == "Batch Package"
+
+
+@pytest.mark.asyncio
+async def test_register_packages_batch_ndjson(app_client):
+    body = "\n".join([
+        '{"name": "NDJSON Package", "weight": 1.5, "type_id": 1, "value": 20.0, "user_id": 164}',
+        '{not json',
+    ])
+    response = await app_client.post("/register/batch", content=body,
+                                     headers={"content-type": "application/x-ndjson"})
+    assert response.status_code == 200
+    result = response.json()
+    assert result["ids"][0] is not None
+    assert result["errors"] == [{"index": 1, "detail": ["Invalid JSON"]}]
+
+
+@pytest.mark.asyncio
+async def test_user_summary(app_client):
+    user_id = 9164
+    before = (await app_client.get(f"/summary/{user_id}")).json()
+    packages = [{"name": "Summary Package", "weight": 2.0, "type_id": 1, "value": 10.0, "user_id": user_id},
+                {"name": "Summary Package", "weight": 3.0, "type_id": 2, "value": 30.0, "user_id": user_id}]
+    assert (await app_client.post("/register", json=packages[0])).status_code == 200
+    assert (await app_client.post("/register/batch", json=packages[1:])).status_code == 200
+
+    response = await app_client.get(f"/summary/{user_id}")
+    assert response.status_code == 200
+    summary = response.json()
+    assert summary["user_id"] == user_id
+    assert summary["packages"] == before["packages"] + 2
+    assert summary["total_weight"] == pytest.approx(before["total_weight"] + 5.0)
+    assert summary["total_value"] == pytest.approx(before["total_value"] + 40.0)
+    assert {item["type_id"] for item in summary["types"]} >= {1, 2}
+
+
+@pytest.mark.asyncio
+async def test_export_ndjson(app_client):
+    user_id = 9166
+    for weight in (1.0, 2.0):
+        await app_client.post("/register", json={"name": "Exported Package", "weight": weight, "type_id": 1,
+                                                 "value": 10.0, "user_id": user_id})
+    response = await app_client.get("/export", params={"user_id": user_id})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    packages = [json.loads(line) for line in response.text.splitlines()]
+    assert [package["weight"] for package in packages][-2:] == [1.0, 2.0]
+    assert all(package["user_id"] == user_id for package in packages)
+    assert list(packages[0]) == ["name", "weight", "type_id", "value", "user_id", "id", "delivery_cost"]
+
+
+@pytest.mark.asyncio
+async def test_export_csv_gzip(app_client):
+    response = await app_client.get("/export", params={"format": "csv", "package_type": 1,
+                                                       "calculated_value": "any"},
+                                    headers={"accept-encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    # httpx decompresses the body
+    rows = list(csv.reader(io.StringIO(response.text)))
+    assert rows[0] == ["name", "weight", "type_id", "value", "user_id", "id", "delivery_cost"]
+    assert all(row[2] == "1" for row in rows[1:])
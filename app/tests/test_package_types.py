@@ -0,0 +1,76 @@
+import asyncio
+import uuid
+import fakeredis
+import pytest
+import redis.asyncio as aioredis
+from fakeredis import aioredis as fake_aioredis
+from app import schemas
+from app.package_types import PackageTypeRegistry
+
+
+@pytest.fixture
+def server():
+    # Redis stand-in shared by the registries of several simulated workers
+    return fakeredis.FakeServer()
+
+
+def make_registry(server):
+    return PackageTypeRegistry(fake_aioredis.FakeRedis(server=server), check_interval=0.05)
+
+
+@pytest.mark.asyncio
+async def test_registry_loads_types_from_the_database(server):
+    registry = make_registry(server)
+    await registry.load()
+    assert registry.types[1] == "clothing"
+    assert registry.is_valid(2)
+    assert not registry.is_valid(10 ** 6)
+
+
+@pytest.mark.asyncio
+async def test_worker_loads_types_at_startup_without_redis(monkeypatch):
+    from app import main
+    # Nothing listens on the port, as when Redis is down while the worker starts
+    registry = PackageTypeRegistry(aioredis.Redis(port=1, socket_connect_timeout=0.1))
+    monkeypatch.setattr(main, "package_type_registry", registry)
+    await main.load_package_types()
+    assert registry._types[1] == "clothing"
+    assert registry.version == -1
+    await registry.redis.aclose()
+
+
+@pytest.mark.asyncio
+async def test_added_type_reaches_other_workers(server):
+    writer, follower = make_registry(server), make_registry(server)
+    await follower.load()
+    listener = asyncio.ensure_future(follower.run_forever())
+    try:
+        await asyncio.sleep(0.1)
+        name = f"type-{uuid.uuid4().hex[:8]}"
+        type_id = await writer.add(name)
+        assert writer.types[type_id] == name
+        for _ in range(50):
+            if follower.version == writer.version:
+                break
+            await asyncio.sleep(0.02)
+        assert follower.types[type_id] == name
+        assert follower.version == writer.version == await writer.remote_version()
+    finally:
+        listener.cancel()
+        await asyncio.gather(listener, return_exceptions=True)
+
+
+@pytest.mark.asyncio
+async def test_missed_announcement_is_caught_up(server):
+    registry = make_registry(server)
+    await registry.load()
+    # A change whose message nobody received only bumps the counter
+    await registry.redis.incr(registry.version_key)
+    await registry.sync()
+    assert registry.version == await registry.remote_version()
+
+
+def test_create_schema_validates_against_the_registry():
+    with pytest.raises(ValueError):
+        schemas.PackageCreate(name="Package", weight=1.0, type_id=10 ** 6, value=1.0, user_id=1)
+    assert schemas.PackageCreate(name="Package", weight=1.0, type_id=1, value=1.0, user_id=1).type_id == 1
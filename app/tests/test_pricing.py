@@ -0,0 +1,75 @@
+import httpx
+import pytest
+from fakeredis import aioredis as fake_aioredis
+from sqlalchemy import delete, insert, select
+from app import models
+from app.costs import recompute_delivery_costs
+from app.database import AsyncSessionLocal
+from app.main import app
+from app.pricing import PricingEngine, Tariff, get_pricing_engine, parse_tariffs
+from app.rates import ExchangeRateProvider, get_rate_provider
+
+USER_ID = 9167
+
+# Electronics cost more by value, miscellaneous less by weight; clothing keeps the default tariff
+TARIFFS = {2: Tariff(0.5, 0.03), 3: Tariff(0.2, 0.01)}
+
+
+class FakeRateSource:
+    async def fetch(self):
+        return 80.0
+
+
+def test_tariffs_are_parsed_by_type_name_or_id():
+    assert parse_tariffs("electronics=0.5/0.03, 3=0.2/0.01") == TARIFFS
+    with pytest.raises(ValueError):
+        parse_tariffs("furniture=1/0.1")
+
+
+def test_quotes_match_single_package_costs():
+    engine = PricingEngine(TARIFFS, Tariff(0.5, 0.01))
+    weights, values, type_ids = [1.0, 2.5, 4.0, 0.3], [100.0, 50.0, 10.0, 7.7], [1, 2, 3, 99]
+    costs = engine.quote(weights, values, type_ids, 80.0)
+    assert costs == [engine.cost(weight, value, type_id, 80.0)
+                     for weight, value, type_id in zip(weights, values, type_ids)]
+    # Unknown types get the default tariff
+    assert costs[3] == (0.3 * 0.5 + 7.7 * 0.01) * 80.0
+
+
+@pytest.mark.asyncio
+async def test_cost_job_stores_the_quoted_costs():
+    engine = PricingEngine(TARIFFS, Tariff(0.5, 0.01))
+    packages = [{"name": "Tariffed", "weight": 1.5 + index, "type_id": 1 + index % 3, "value": 10.0 * index,
+                 "user_id": USER_ID} for index in range(6)]
+    async with AsyncSessionLocal() as db:
+        await db.execute(delete(models.Package).where(models.Package.user_id == USER_ID))
+        await db.execute(insert(models.Package), packages)
+        await db.commit()
+        await recompute_delivery_costs(db, 80.0, pricing=engine)
+        result = await db.execute(select(models.Package.delivery_cost).where(models.Package.user_id == USER_ID)
+                                  .order_by(models.Package.id))
+        stored = result.scalars().all()
+    quoted = engine.quote([package["weight"] for package in packages], [package["value"] for package in packages],
+                          [package["type_id"] for package in packages], 80.0)
+    assert stored == pytest.approx(quoted, rel=1e-12)
+
+
+@pytest.mark.asyncio
+async def test_quote_endpoint_prices_without_storing():
+    engine = PricingEngine(TARIFFS, Tariff(0.5, 0.01))
+    app.dependency_overrides[get_rate_provider] = lambda: ExchangeRateProvider(FakeRateSource(),
+                                                                               fake_aioredis.FakeRedis())
+    app.dependency_overrides[get_pricing_engine] = lambda: engine
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            response = await client.post("/quote", json={"weights": [1.0, 2.0], "values": [100.0, 100.0],
+                                                         "type_ids": [1, 2]})
+            assert response.status_code == 200
+            assert response.json() == {"usd_to_rub": 80.0, "costs": [(0.5 + 1.0) * 80.0, (1.0 + 3.0) * 80.0]}
+
+            for invalid in ({"weights": [1.0], "values": [1.0, 2.0], "type_ids": [1, 1]},
+                            {"weights": [1.0], "values": [-1.0], "type_ids": [1]},
+                            {"weights": [1.0], "values": [1.0], "type_ids": [1000]}):
+                assert (await client.post("/quote", json=invalid)).status_code == 422
+    finally:
+        app.dependency_overrides.clear()
@@ -0,0 +1,105 @@
+import marshal
+import threading
+import time
+import httpx
+import pytest
+from fakeredis import aioredis as fake_aioredis
+from fastapi import FastAPI
+from app.profiling import Profiler, ProfilingMiddleware, StackSampler, get_profiler
+from app.routers import admin
+
+TOKEN = "s3cret"
+
+
+def busy_loop(seconds):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        sum(range(100))
+
+
+def profiled_app(profiler):
+    app = FastAPI()
+
+    @app.get("/work")
+    async def work():
+        busy_loop(0.05)
+        return {}
+
+    app.include_router(admin.router)
+    app.add_middleware(ProfilingMiddleware, profiler=profiler)
+    app.dependency_overrides[get_profiler] = lambda: profiler
+    return app
+
+
+def client(profiler):
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=profiled_app(profiler)), base_url="http://test")
+
+
+def test_sampler_records_the_stacks_of_another_thread():
+    worker = threading.Thread(target=busy_loop, args=(0.2,))
+    worker.start()
+    sampler = StackSampler(worker.ident, interval_ms=1)
+    sampler.start()
+    worker.join()
+    stacks = sampler.stop()
+    assert sum(stacks.values()) > 10
+    assert all("busy_loop" in stack for stack in stacks)
+
+
+@pytest.mark.asyncio
+async def test_request_with_the_token_is_profiled_and_downloadable():
+    profiler = Profiler(fake_aioredis.FakeRedis(), sample_rate=0, token=TOKEN, mode="cprofile")
+    async with client(profiler) as app_client:
+        assert "x-profile-id" not in (await app_client.get("/work")).headers
+        response = await app_client.get("/work", headers={"X-Profile-Token": TOKEN})
+        profile_id = response.headers["x-profile-id"]
+
+        assert (await app_client.get("/admin/profiles")).status_code == 403
+        [meta] = (await app_client.get("/admin/profiles", headers={"X-Profile-Token": TOKEN})).json()
+        assert meta["name"] == "GET /work" and meta["format"] == "pstats" and meta["status"] == 200
+        response = await app_client.get(f"/admin/profiles/{profile_id}", headers={"X-Profile-Token": TOKEN})
+        stats = marshal.loads(response.content)
+        assert any(function == "busy_loop" for _, _, function in stats)
+
+
+@pytest.mark.asyncio
+async def test_ring_buffer_keeps_the_latest_profiles():
+    redis = fake_aioredis.FakeRedis()
+    profiler = Profiler(redis, sample_rate=1.0, token=TOKEN, interval_ms=1, capacity=2)
+    headers = {"X-Profile-Token": TOKEN}
+    async with client(profiler) as app_client:
+        ids = [(await app_client.get("/work")).headers["x-profile-id"] for _ in range(3)]
+        listed = (await app_client.get("/admin/profiles", headers=headers)).json()
+        assert [str(meta["id"]) for meta in listed] == ids[:0:-1]
+        assert (await app_client.get(f"/admin/profiles/{ids[0]}", headers=headers)).status_code == 404
+        response = await app_client.get(f"/admin/profiles/{ids[2]}", headers=headers)
+        assert "busy_loop" in response.text and response.text.endswith("\n")
+    assert await redis.exists(f"profiles:{ids[0]}") == 0
+
+
+@pytest.mark.asyncio
+async def test_next_job_runs_are_profiled_on_request():
+    profiler = Profiler(fake_aioredis.FakeRedis(), token=TOKEN, mode="cprofile")
+
+    async def update_delivery_costs(context=None):
+        busy_loop(0.01)
+        return 3
+
+    job = profiler.job("update_delivery_costs", update_delivery_costs)
+    headers = {"X-Profile-Token": TOKEN}
+    async with client(profiler) as app_client:
+        assert (await app_client.post("/admin/profiles/jobs/unknown", headers=headers)).status_code == 404
+        response = await app_client.post("/admin/profiles/jobs/update_delivery_costs?runs=2", headers=headers)
+        assert response.status_code == 200
+        assert [await job() for _ in range(3)] == [3, 3, 3]
+        profiles = (await app_client.get("/admin/profiles", headers=headers)).json()
+    assert [(meta["kind"], meta["name"]) for meta in profiles] == [("job", "update_delivery_costs")] * 2
+
+
+@pytest.mark.asyncio
+async def test_profiling_is_off_without_token_or_sample_rate():
+    profiler = Profiler(fake_aioredis.FakeRedis(), sample_rate=0, token="")
+    async with client(profiler) as app_client:
+        response = await app_client.get("/work", headers={"X-Profile-Token": ""})
+        assert "x-profile-id" not in response.headers
+        assert (await app_client.get("/admin/profiles")).status_code == 404
@@ -0,0 +1,99 @@
+import httpx
+import pytest
+from fastapi.responses import JSONResponse
+from app import models, schemas
+from app.database import AsyncSessionLocal
+from app.main import app
+from app.rate_history import RateHistory, get_rate_history
+from app.responses import FastJSONResponse
+
+
+def make_package(**fields):
+    return schemas.PackageRecord(**{"id": 1, "name": "Package", "weight": 2.0, "type_id": 1, "value": 100.0,
+                                    "user_id": 166, "delivery_cost": None, "rate_version": None, **fields})
+
+
+@pytest.mark.asyncio
+async def test_publish_creates_a_version_only_on_change():
+    history = RateHistory()
+    async with AsyncSessionLocal() as db:
+        first = await history.publish(db, 81.25)
+        assert await history.publish(db, 81.25) == first
+        second = await history.publish(db, 82.5)
+        assert second > first
+        assert await history.rate(db, first) == 81.25
+
+
+@pytest.mark.asyncio
+async def test_price_derives_costs_from_rate_versions():
+    history = RateHistory(lazy=True, latest_ttl=0)
+    async with AsyncSessionLocal() as db:
+        pinned_version = await history.publish(db, 70.0)
+        await history.publish(db, 80.0)
+        materialized, pinned, floating = await history.price(db, [
+            make_package(delivery_cost=5.0, rate_version=pinned_version),
+            make_package(rate_version=pinned_version),
+            make_package(),
+        ])
+
+    # Materialized costs are returned as stored
+    assert materialized.delivery_cost == 5.0
+    # Pinned packages are priced at their own version, the others at the latest one
+    assert pinned.delivery_cost == (2.0 * 0.5 + 100.0 * 0.01) * 70.0
+    assert floating.delivery_cost == (2.0 * 0.5 + 100.0 * 0.01) * 80.0
+
+
+@pytest.mark.asyncio
+async def test_price_leaves_unpinned_costs_pending_in_eager_mode():
+    history = RateHistory(lazy=False)
+    async with AsyncSessionLocal() as db:
+        await history.publish(db, 80.0)
+        [package] = await history.price(db, [make_package()])
+    assert package.delivery_cost is None
+
+
+@pytest.mark.asyncio
+async def test_price_rows_matches_the_schema_serialization():
+    history = RateHistory(lazy=True, latest_ttl=0)
+    async with AsyncSessionLocal() as db:
+        version = await history.publish(db, 70.0)
+        records = [make_package(delivery_cost=5.0), make_package(id=2, rate_version=version), make_package(id=3)]
+        expected = [package.model_dump() for package in await history.price(db, records)]
+        rows = [(record.id, record.name, record.weight, record.type_id, record.value, record.user_id,
+                 record.delivery_cost, record.rate_version) for record in records]
+        priced = await history.price_rows(db, rows)
+    assert priced == expected
+    assert [list(package) for package in priced] == [list(package) for package in expected]
+    assert FastJSONResponse(priced).body == JSONResponse(expected).body
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("lazy", [True, False])
+async def test_calculated_value_filter_follows_the_derived_costs(lazy):
+    user_id = 5121 if lazy else 5122
+    history = RateHistory(lazy=lazy, latest_ttl=0)
+    app.dependency_overrides[get_rate_history] = lambda: history
+    try:
+        async with AsyncSessionLocal() as db:
+            version = await history.publish(db, 70.0)
+            db.add_all([models.Package(name="Stored", weight=1.0, type_id=1, value=10.0, user_id=user_id,
+                                       delivery_cost=5.0),
+                        models.Package(name="Pinned", weight=1.0, type_id=1, value=10.0, user_id=user_id,
+                                       rate_version=version),
+                        models.Package(name="Unpriced", weight=1.0, type_id=1, value=10.0, user_id=user_id)])
+            await db.commit()
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            async def show(calculated_value):
+                response = await client.post("/show", json={"user_id": user_id, "limit": 50,
+                                                            "calculated_value": calculated_value})
+                return {package["name"]: package["delivery_cost"] for package in response.json()}
+
+            calculated, pending = await show("calculated"), await show("pending")
+    finally:
+        app.dependency_overrides.clear()
+    # Every package listed as calculated has a cost, every pending one has none
+    assert None not in calculated.values() and set(pending.values()) <= {None}
+    if lazy:
+        assert set(calculated) == {"Stored", "Pinned", "Unpriced"} and not pending
+    else:
+        assert set(calculated) == {"Stored", "Pinned"} and set(pending) == {"Unpriced"}
@@ -0,0 +1,119 @@
+import asyncio
+import pytest
+from fakeredis import aioredis as fake_aioredis
+from app.rates import ExchangeRateProvider, RateUnavailableError
+
+
+class FakeRateSource:
+    """ Local stand-in for the CBR feed that counts fetches and can be made to fail. """
+
+    def __init__(self, rate=90.0):
+        self.rate = rate
+        self.fetches = 0
+        self.fail = False
+
+    async def fetch(self):
+        self.fetches += 1
+        await asyncio.sleep(0.01)
+        if self.fail:
+            raise RuntimeError("upstream is down")
+        return self.rate
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def source():
+    return FakeRateSource()
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def provider(source, clock):
+    return ExchangeRateProvider(source, fake_aioredis.FakeRedis(), ttl=60, backoff_base=10, clock=clock)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_callers_share_one_fetch(provider, source):
+    rates = await asyncio.gather(*(provider.get_rate() for _ in range(20)))
+    assert rates == [90.0] * 20
+    assert source.fetches == 1
+
+
+@pytest.mark.asyncio
+async def test_rate_is_shared_through_redis(provider, source, clock):
+    await provider.get_rate()
+
+    # A second worker finds the rate in Redis and does not call the source
+    other = ExchangeRateProvider(source, provider.redis, ttl=60, clock=clock)
+    assert await other.get_rate() == 90.0
+    assert source.fetches == 1
+
+
+@pytest.mark.asyncio
+async def test_shared_rate_is_fresh_for_the_ttl_of_its_fetch(provider, source, clock):
+    await provider.get_rate()
+    # The shared copy expires with the freshness of the rate, so an expired rate is fetched again
+    assert 0 < await provider.redis.pttl(ExchangeRateProvider.REDIS_KEY) <= 60000
+
+    # A copy fetched 55s ago by another worker is used for the 5s it stays fresh, not for another ttl
+    await provider.redis.set(ExchangeRateProvider.REDIS_KEY, 91.0, px=5000)
+    other = ExchangeRateProvider(source, provider.redis, ttl=60, clock=clock)
+    assert await other.get_rate() == 91.0
+    assert other.peek() == 91.0
+    clock.now += 6
+    assert other.peek() is None
+    assert source.fetches == 1
+
+
+@pytest.mark.asyncio
+async def test_stale_rate_is_served_while_revalidating(provider, source, clock):
+    await provider.get_rate()
+    await provider.redis.flushall()
+    source.rate = 95.0
+    clock.now += 61
+
+    # The stale value is returned at once and a single background refresh replaces it
+    assert await provider.get_rate() == 90.0
+    assert await provider.get_rate() == 90.0
+    await provider._inflight
+    assert await provider.get_rate() == 95.0
+    assert source.fetches == 2
+
+
+@pytest.mark.asyncio
+async def test_failed_fetch_backs_off(provider, source, clock):
+    source.fail = True
+    with pytest.raises(RateUnavailableError):
+        await provider.get_rate()
+    # Inside the backoff window the source is not called again
+    with pytest.raises(RateUnavailableError):
+        await provider.get_rate()
+    assert source.fetches == 1
+
+    source.fail = False
+    clock.now += 10
+    assert await provider.get_rate() == 90.0
+    assert provider.peek() == 90.0
+
+
+@pytest.mark.asyncio
+async def test_worker_warm_up_uses_the_shared_rate(provider, source, monkeypatch):
+    from app import main
+    await provider.get_rate()
+    # A worker starting next to the first one finds the rate in Redis
+    starting = ExchangeRateProvider(source, provider.redis, ttl=60)
+    monkeypatch.setattr(main, "rate_provider", starting)
+    await main.warm_up_exchange_rate()
+    assert starting.peek() == 90.0
+    assert source.fetches == 1
@@ -7,6 +7,7 @@ from sqlalchemy import select
 from app.main import app, update_delivery_costs, on_startup
 from app.database import Base, DATABASE_URL
 from app.models import Package, PackageType
+from app.costs import recompute_delivery_costs
 import redis
 import os
 
@@ -58,3 +59,32 @@ async def test_update_delivery_costs(setup_database):
             expected_cost = (package.weight * 0.5 + package.value * 0.01) * usd_to_rub
             assert package.delivery_cost == expected_cost
             session.close()
+
+
+@pytest.mark.asyncio
+async def test_recompute_delivery_costs_in_chunks(setup_database):
+    usd_to_rub = 80.0
+    engine = create_async_engine(ASYNC_DATABASE_URL, echo=True, future=True)
+    AsyncSessionLocal = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+
+    async with AsyncSessionLocal() as session:
+        packages = [Package(name="Chunked Package", weight=1.0 + i, type_id=1, value=10.0, user_id=2) for i in range(5)]
+        session.add_all(packages)
+        await session.commit()
+
+        # A batch size of 2 forces several chunks, each committed separately
+        committed_chunks = []
+
+        async def on_chunk(ids):
+            committed_chunks.append(ids)
+
+        start_after = min(package.id for package in packages) - 1
+        updated = await recompute_delivery_costs(session, usd_to_rub, batch_size=2,
+                                                 start_after=start_after, on_chunk=on_chunk)
+        assert updated >= len(packages)
+        assert all(len(ids) <= 2 for ids in committed_chunks)
+
+        result = await session.execute(select(Package).filter_by(name="Chunked Package"))
+        for package in result.scalars().all():
+            await session.refresh(package)
+            assert package.delivery_cost == (package.weight * 0.5 + package.value * 0.01) * usd_to_rub
@@ -0,0 +1,149 @@
+import asyncio
+import pytest
+from fakeredis import aioredis as fake_aioredis
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+from app import bulk, models, registration
+from app.cache import PackageCache
+from app.cost_worker import CostQueue
+from app.database import AsyncSessionLocal
+from app.rate_history import RateHistory
+from app.rates import ExchangeRateProvider
+from app.registration import GroupCommitter
+from app.sharding import Shard, ShardRouter
+
+USER_ID = 9166
+
+
+class FakeRateSource:
+    async def fetch(self):
+        return 75.0
+
+
+class CountingSessionFactory:
+    """ Session factory counting the transactions the group committer opens. """
+
+    def __init__(self):
+        self.sessions = 0
+
+    def __call__(self):
+        self.sessions += 1
+        return AsyncSessionLocal()
+
+
+def committer(sessions, redis, **options):
+    # The provider has not fetched the rate yet, so the packages are queued for the cost worker
+    return GroupCommitter(ShardRouter([Shard(0, sessions)]), rates=ExchangeRateProvider(FakeRateSource(), redis),
+                          history=RateHistory(lazy=False), queue=CostQueue(redis, stream="test:group_commit"),
+                          cache=PackageCache(redis), **options)
+
+
+def package(index):
+    return {"name": f"Grouped {index}", "weight": 1.0 + index, "type_id": 1, "value": 10.0, "user_id": USER_ID}
+
+
+@pytest.mark.asyncio
+async def test_concurrent_registrations_share_one_commit():
+    redis = fake_aioredis.FakeRedis()
+    sessions = CountingSessionFactory()
+    group = committer(sessions, redis, window_ms=50, max_items=100)
+    records = await asyncio.gather(*(group.register(package(index)) for index in range(10)))
+
+    assert sessions.sessions == 1
+    assert len({record.id for record in records}) == 10
+    # Every caller gets its own package back
+    assert [record.name for record in records] == [f"Grouped {index}" for index in range(10)]
+    assert await redis.xlen("test:group_commit") == 10
+    async with AsyncSessionLocal() as db:
+        stored = dict((await db.execute(select(models.Package.id, models.Package.name)
+                                        .where(models.Package.id.in_([record.id for record in records])))).all())
+    assert stored == {record.id: record.name for record in records}
+
+
+@pytest.mark.asyncio
+async def test_full_group_is_written_without_waiting_for_the_window():
+    sessions = CountingSessionFactory()
+    group = committer(sessions, fake_aioredis.FakeRedis(), window_ms=60000, max_items=4)
+    records = await asyncio.wait_for(asyncio.gather(*(group.register(package(index)) for index in range(8))), 10)
+    assert len({record.id for record in records}) == 8
+    assert sessions.sessions == 2
+
+
+@pytest.mark.asyncio
+async def test_failed_registration_does_not_fail_its_group(monkeypatch):
+    async def insert_packages(db, rows):
+        if any(row["name"] == "Broken" for row in rows):
+            raise SQLAlchemyError("broken package")
+        return await bulk.insert_packages(db, rows)
+
+    monkeypatch.setattr(registration, "insert_packages", insert_packages)
+    sessions = CountingSessionFactory()
+    group = committer(sessions, fake_aioredis.FakeRedis(), window_ms=50, max_items=100)
+    results = await asyncio.gather(group.register(package(0)), group.register({**package(1), "name": "Broken"}),
+                                   group.register(package(2)), return_exceptions=True)
+    assert isinstance(results[1], SQLAlchemyError)
+    assert results[0].id != results[2].id
+    assert results[0].name == "Grouped 0" and results[2].name == "Grouped 2"
+    # The failed group, then one transaction per package
+    assert sessions.sessions == 4
+
+
+class ExpiringRates:
+    """ Rate provider whose rate expires after the first group is priced. """
+
+    def __init__(self):
+        self.rates = [75.0]
+
+    def peek(self):
+        return self.rates.pop(0) if self.rates else None
+
+
+@pytest.mark.asyncio
+async def test_retried_registrations_start_from_their_payloads(monkeypatch):
+    async def insert_packages(db, rows):
+        if any(row["name"] == "Broken" for row in rows):
+            raise SQLAlchemyError("broken package")
+        return await bulk.insert_packages(db, rows)
+
+    monkeypatch.setattr(registration, "insert_packages", insert_packages)
+    redis = fake_aioredis.FakeRedis()
+    group = GroupCommitter(ShardRouter([Shard(0, AsyncSessionLocal)]), window_ms=50, rates=ExpiringRates(),
+                           history=RateHistory(lazy=False), queue=CostQueue(redis, stream="test:group_retry"),
+                           cache=PackageCache(redis))
+    payloads = [package(0), {**package(1), "name": "Broken"}]
+    results = await asyncio.gather(*(group.register(payload) for payload in payloads), return_exceptions=True)
+
+    assert payloads == [package(0), {**package(1), "name": "Broken"}]
+    # Priced by the failed group only: the retry stores no cost nor the rolled back rate version
+    assert results[0].delivery_cost is None
+    async with AsyncSessionLocal() as db:
+        stored = await db.get(models.Package, results[0].id)
+    assert stored.delivery_cost is None and stored.rate_version is None
+    assert await redis.xlen("test:group_retry") == 1
+
+
+@pytest.mark.asyncio
+async def test_callers_are_answered_whatever_happens_after_the_commit(monkeypatch):
+    async def invalidate_packages(ids):
+        raise RuntimeError("cache client bug")
+
+    redis = fake_aioredis.FakeRedis()
+    group = committer(AsyncSessionLocal, redis, window_ms=10)
+    monkeypatch.setattr(group.cache, "invalidate_packages", invalidate_packages)
+    record = await asyncio.wait_for(group.register(package(0)), 10)
+    assert record.name == "Grouped 0"
+
+    # A write cancelled mid-way (the worker shutting down) cancels its callers instead of leaving them waiting
+    stalled = asyncio.Event()
+
+    async def insert_packages(db, rows):
+        stalled.set()
+        await asyncio.Event().wait()
+
+    monkeypatch.setattr(registration, "insert_packages", insert_packages)
+    registering = asyncio.ensure_future(group.register(package(1)))
+    await asyncio.wait_for(stalled.wait(), 10)
+    for write in list(group._writes):
+        write.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await asyncio.wait_for(registering, 10)
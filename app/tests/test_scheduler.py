@@ -0,0 +1,116 @@
+import asyncio
+import pytest
+from fakeredis import aioredis as fake_aioredis
+from app.scheduler import JobContext, LeaseLock, LeaseLostError, ScheduledJob, id_range_partition
+
+
+@pytest.fixture
+def redis():
+    # Local Redis stand-in (with Lua support), shared by all "workers" of a test
+    return fake_aioredis.FakeRedis()
+
+
+@pytest.mark.asyncio
+async def test_lease_lock_fencing_tokens(redis):
+    first = LeaseLock(redis, "lock", ttl_ms=1000)
+    second = LeaseLock(redis, "lock", ttl_ms=1000)
+
+    token = await first.acquire()
+    assert token is not None
+    assert await second.acquire() is None
+
+    await first.release()
+    assert await second.acquire() > token
+    # The old holder can neither renew nor release the new holder's lease
+    assert await first.renew() is False
+    await first.release()
+    assert await second.renew() is True
+
+
+@pytest.mark.asyncio
+async def test_writes_of_a_lost_lease_are_fenced(redis):
+    paused = LeaseLock(redis, "lock", ttl_ms=1000)
+    context = JobContext(token=await paused.acquire(), lock=paused)
+    await context.write(redis, "checkpoint", 10)
+
+    # The lease expires while its holder is paused, and another worker takes over
+    await redis.delete("lock")
+    current = LeaseLock(redis, "lock", ttl_ms=1000)
+    await JobContext(token=await current.acquire(), lock=current).write(redis, "checkpoint", 50)
+
+    with pytest.raises(LeaseLostError):
+        await context.write(redis, "checkpoint", 20)
+    with pytest.raises(LeaseLostError):
+        await context.write(redis, "checkpoint")
+    assert await redis.get("checkpoint") == b"50"
+
+
+@pytest.mark.asyncio
+async def test_job_runs_once_per_slot_across_workers(redis):
+    calls = []
+
+    async def job(context):
+        calls.append(context.partition)
+        await asyncio.sleep(0.01)
+        return 7
+
+    workers = [ScheduledJob(redis, "test_job", job, seconds=60, partitions=3) for _ in range(4)]
+    await asyncio.gather(*(worker.run_slot(1) for worker in workers))
+
+    # Every partition ran exactly once, whatever the number of workers
+    assert sorted(calls) == [0, 1, 2]
+    runs = [run for worker in workers for run in worker.runs]
+    assert sum(run.rows for run in runs) == 21
+    assert await redis.llen("job:test_job:runs") == 3
+
+    # The next slot runs every partition again
+    await asyncio.gather(*(worker.run_slot(2) for worker in workers))
+    assert len(calls) == 6
+
+
+@pytest.mark.asyncio
+async def test_job_does_not_overlap_a_running_partition(redis):
+    started = asyncio.Event()
+    release = asyncio.Event()
+
+    async def slow_job(context):
+        started.set()
+        await release.wait()
+        return 0
+
+    first = ScheduledJob(redis, "slow_job", slow_job, seconds=60)
+    second = ScheduledJob(redis, "slow_job", slow_job, seconds=60)
+    running = asyncio.ensure_future(first.run_slot(1))
+    await started.wait()
+
+    # Even in the next slot the partition is skipped while the first run holds its lease
+    assert await second.run_slot(2) == []
+    release.set()
+    assert len(await running) == 1
+
+
+@pytest.mark.asyncio
+async def test_job_context_detects_lost_lease(redis):
+    async def job(context):
+        await redis.delete("job:lost_job:0:lease")
+        await context.check()
+        return 1
+
+    worker = ScheduledJob(redis, "lost_job", job, seconds=60)
+    [run] = await worker.run_slot(1)
+    assert run.error is not None and LeaseLostError.__name__ in run.error
+
+
+def test_id_range_partition_covers_all_ids():
+    ranges = [id_range_partition(100, partition, 3) for partition in range(3)]
+    assert ranges[0][0] == 0
+    assert ranges[-1][1] is None
+    for (_, end_at), (start_after, _) in zip(ranges, ranges[1:]):
+        assert end_at == start_after
+
+
+def test_id_range_partition_starts_after_the_first_id():
+    ranges = [id_range_partition(1000 + 100, partition, 3, first_after=1000) for partition in range(3)]
+    assert ranges[0][0] == 1000
+    assert ranges[1] == (1034, 1068)
+    assert ranges[-1][1] is None
@@ -0,0 +1,85 @@
+import httpx
+import pytest
+from fakeredis import aioredis as fake_aioredis
+from sqlalchemy.dialects import mysql
+from app.cache import PackageCache, get_package_cache
+from app.cost_worker import CostQueue, get_cost_queue
+from app.main import app
+from app.rates import ExchangeRateProvider, get_rate_provider
+from app.schemas import SearchMatch, SearchPackagesRequest
+from app.search import TrigramIndex, search_statement
+
+USER_ID = 7311
+
+
+class FakeRateSource:
+    async def fetch(self):
+        return 75.0
+
+
+@pytest.fixture
+async def app_client():
+    redis = fake_aioredis.FakeRedis()
+    app.dependency_overrides[get_rate_provider] = lambda: ExchangeRateProvider(FakeRateSource(), redis)
+    app.dependency_overrides[get_cost_queue] = lambda: CostQueue(redis, stream="test:search")
+    app.dependency_overrides[get_package_cache] = lambda: PackageCache(redis)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as app_client:
+        yield app_client
+    app.dependency_overrides.clear()
+
+
+def test_trigram_index_checks_every_candidate():
+    index = TrigramIndex()
+    for package_id, (user_id, type_id, name) in enumerate([
+            (1, 1, "Tomato box"), (1, 2, "Atom"), (2, 1, "Tomato crate"), (1, 1, "Bottom"), (1, 1, "TO")], start=1):
+        index.add(package_id, user_id, type_id, name)
+    assert index.search(1, "TOM", SearchMatch.substring) == [1, 4, 2]
+    assert index.search(1, "tom", SearchMatch.prefix) == [1]
+    assert index.search(1, "to", SearchMatch.prefix) == [1, 5]
+    assert index.search(1, "tom", SearchMatch.substring, package_type=2) == [2]
+    assert index.search(1, "tom", SearchMatch.substring, after=(1, 1), limit=1) == [4]
+    assert index.search(3, "tom", SearchMatch.substring) == []
+
+
+def test_mysql_search_is_scoped_by_user_on_the_name_index():
+    def sql(query, match):
+        request = SearchPackagesRequest(user_id=USER_ID, query=query, match=match)
+        return str(search_statement(query, request).compile(dialect=mysql.dialect()))
+
+    for match in SearchMatch:
+        statement = sql("om &amp; j", match)
+        assert "FROM packages USE INDEX (ix_packages_user_id_name)" in statement
+        assert "packages.user_id = %s" in statement and "LIKE" in statement and "MATCH" not in statement
+
+
+@pytest.mark.asyncio
+async def test_search_finds_a_users_packages_by_name(app_client):
+    async def register(name, user_id=USER_ID, type_id=1):
+        response = await app_client.post("/register", json={
+            "name": name, "weight": 1.0, "type_id": type_id, "value": 10.0, "user_id": user_id})
+        return response.json()["id"]
+
+    jerry = await register("Tom & Jerry")
+    tomato = await register("tomato box", type_id=2)
+    await register("Tom's other package", user_id=USER_ID + 1)
+
+    response = await app_client.post("/search", json={"user_id": USER_ID, "query": "TOM"})
+    assert [package["id"] for package in response.json()] == [jerry, tomato]
+    assert response.json()[0]["name"] == "Tom &amp; Jerry"
+    # Queries are compared with the names as stored, html-escaped
+    response = await app_client.post("/search", json={"user_id": USER_ID, "query": "m & j"})
+    assert [package["id"] for package in response.json()] == [jerry]
+    response = await app_client.post("/search", json={"user_id": USER_ID, "query": "to", "match": "prefix",
+                                                      "package_type": 2})
+    assert [package["id"] for package in response.json()] == [tomato]
+
+    # Packages registered after the index was built are found too
+    atom = await register("Atom", type_id=2)
+    response = await app_client.post("/search", json={"user_id": USER_ID, "query": "tom", "limit": 2})
+    assert [package["id"] for package in response.json()] == [jerry, tomato]
+    response = await app_client.post("/search", json={"user_id": USER_ID, "query": "tom", "limit": 2,
+                                                      "cursor": response.headers["X-Next-Cursor"]})
+    assert [package["id"] for package in response.json()] == [atom]
+    assert "X-Next-Cursor" not in response.headers
+
+    assert (await app_client.post("/search", json={"user_id": USER_ID, "query": ""})).status_code == 422
@@ -0,0 +1,28 @@
+from sqlalchemy import text
+import app as app_package
+from app import database
+from app.serving import reset_after_fork, worker_count
+
+
+def test_worker_count_follows_the_cpus():
+    assert worker_count(None, 1, 0, cpus=8) == 8
+    assert worker_count(None, 0.5, 0, cpus=1) == 1
+    assert worker_count(None, 2, 6, cpus=8) == 6
+    # An explicit count wins
+    assert worker_count("3", 1, 2, cpus=8) == 3
+
+
+def test_worker_drops_the_connections_of_the_master():
+    with database.engine.connect() as connection:
+        inherited = connection.connection.dbapi_connection
+    assert database.engine.pool.checkedin() == 1
+    started = app_package.IMPORT_STARTED
+
+    reset_after_fork()
+    assert database.engine.pool.checkedin() == 0
+    assert app_package.IMPORT_STARTED > started
+    # The connection still belongs to the master, so it is left open
+    assert inherited.execute("SELECT 1").fetchone() == (1,)
+    with database.engine.connect() as connection:
+        assert connection.connection.dbapi_connection is not inherited
+        assert connection.execute(text("SELECT 1")).scalar() == 1
@@ -0,0 +1,118 @@
+import httpx
+import pytest
+from fakeredis import aioredis as fake_aioredis
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from app import main, models
+from app.cache import PackageCache, get_package_cache
+from app.cost_worker import CostQueue, get_cost_queue
+from app.main import app
+from app.rate_history import RateHistory
+from app.rates import ExchangeRateProvider, get_rate_provider
+from app.sharding import HashRing, Shard, ShardRouter, create_schema, get_shard_router, id_base, shard_of_id
+
+
+class FakeRateSource:
+    async def fetch(self):
+        return 75.0
+
+
+@pytest.fixture
+def shards(tmp_path):
+    """ Three shards, each a SQLite file with its own id range. """
+    shards = []
+    for index in range(3):
+        path = tmp_path / f"shard{index}.db"
+        sessions = async_sessionmaker(create_async_engine(f"sqlite+aiosqlite:///{path}"), expire_on_commit=False,
+                                      class_=AsyncSession)
+        shard = Shard(index, sessions, engine=create_engine(f"sqlite+pysqlite:///{path}"))
+        create_schema(shard)
+        shards.append(shard)
+    return ShardRouter(shards)
+
+
+@pytest.fixture
+def redis():
+    return fake_aioredis.FakeRedis()
+
+
+@pytest.fixture
+async def app_client(shards, redis):
+    # A provider that has not fetched the rate yet, so registered packages are left for the cost job
+    provider = ExchangeRateProvider(FakeRateSource(), redis)
+    app.dependency_overrides[get_shard_router] = lambda: shards
+    app.dependency_overrides[get_rate_provider] = lambda: provider
+    app.dependency_overrides[get_cost_queue] = lambda: CostQueue(redis, stream="test:sharded")
+    app.dependency_overrides[get_package_cache] = lambda: PackageCache(redis)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as app_client:
+        yield app_client
+    app.dependency_overrides.clear()
+
+
+def test_hash_ring_spreads_users_and_moves_few_when_a_shard_is_added():
+    users = range(20000)
+    four, five = HashRing(4), HashRing(5)
+    placement = [four.shard_for(user_id) for user_id in users]
+    for index in range(4):
+        assert 0.15 < placement.count(index) / len(users) < 0.35
+    moved = [user_id for user_id in users if five.shard_for(user_id) != placement[user_id]]
+    # Only users taken over by the new shard move, about a fifth of them
+    assert all(five.shard_for(user_id) == 4 for user_id in moved)
+    assert 0.1 < len(moved) / len(users) < 0.3
+
+
+@pytest.mark.asyncio
+async def test_packages_are_stored_and_read_on_their_users_shard(app_client, shards):
+    registered = {}
+    for user_id in range(1, 13):
+        response = await app_client.post("/register", json={
+            "name": f"Sharded {user_id}", "weight": 1.0, "type_id": 1, "value": 10.0, "user_id": user_id})
+        assert response.status_code == 200
+        package_id = response.json()["id"]
+        # The id carries the shard of the user, so the package is found without a lookup
+        assert shard_of_id(package_id) == shards.for_user(user_id).index
+        registered[user_id] = package_id
+    assert len({shard_of_id(package_id) for package_id in registered.values()}) > 1
+
+    for user_id, package_id in registered.items():
+        response = await app_client.get(f"/package/{package_id}")
+        assert response.status_code == 200 and response.json()["user_id"] == user_id
+        response = await app_client.post("/show", json={"user_id": user_id})
+        assert [package["id"] for package in response.json()] == [package_id]
+        assert (await app_client.get(f"/summary/{user_id}")).json()["packages"] == 1
+    assert (await app_client.get(f"/package/{id_base(7) + 1}")).status_code == 404
+
+    # A batch spanning shards is split between them
+    response = await app_client.post("/register/batch", json=[
+        {"name": "Batched", "weight": 2.0, "type_id": 2, "value": 5.0, "user_id": user_id} for user_id in range(1, 13)])
+    ids = response.json()["ids"]
+    assert [shard_of_id(package_id) for package_id in ids] == [shards.for_user(user_id).index
+                                                               for user_id in range(1, 13)]
+
+    # Exporting everyone's packages reads every shard, in id order
+    lines = (await app_client.get("/export")).text.splitlines()
+    exported = [int(line.split('"id":')[1].split(",")[0]) for line in lines]
+    assert exported == sorted(list(registered.values()) + ids)
+
+
+@pytest.mark.asyncio
+async def test_cost_job_prices_every_shard(app_client, shards, redis, monkeypatch):
+    for user_id in range(1, 13):
+        await app_client.post("/register", json={
+            "name": "Pending", "weight": 2.0, "type_id": 1, "value": 100.0, "user_id": user_id})
+
+    history = RateHistory(lazy=False, shards=shards)
+    monkeypatch.setattr(main, "shard_router", shards)
+    monkeypatch.setattr(main, "rate_history", history)
+    monkeypatch.setattr(main, "rate_provider", ExchangeRateProvider(FakeRateSource(), redis))
+    monkeypatch.setattr(main, "redis_client", redis)
+    monkeypatch.setattr(main, "package_cache", PackageCache(redis))
+    assert await main.update_delivery_costs() == 12
+
+    for shard in shards:
+        async with shard.sessions() as db:
+            # Every shard holds the rate version its packages were priced with
+            versions = (await db.execute(select(models.ExchangeRate.id, models.ExchangeRate.usd_to_rub))).all()
+            assert versions == [(history._latest[0], 75.0)]
+            pending = await db.execute(select(func.count()).where(models.Package.delivery_cost.is_(None)))
+            assert pending.scalar_one() == 0
@@ -0,0 +1,70 @@
+import pytest
+from sqlalchemy import delete, insert, literal, select, true
+from sqlalchemy.dialects import postgresql
+from app import models
+from app.costs import recompute_delivery_costs
+from app.database import AsyncSessionLocal
+from app.summaries import pending_groups, rebuild, record_registered, user_summary
+
+USER_ID = 9165
+
+
+def totals(rows):
+    return {row.type_id: (row.packages, round(row.total_weight, 6), round(row.total_value, 6),
+                          round(row.total_delivery_cost, 6), row.pending_packages, round(row.pending_weight, 6),
+                          round(row.pending_value, 6))
+            for row in rows}
+
+
+@pytest.mark.asyncio
+async def test_incremental_summary_matches_rebuild():
+    packages = [
+        {"name": "Summarized", "weight": 1.0, "type_id": 1, "value": 100.0, "user_id": USER_ID, "delivery_cost": 90.0},
+        {"name": "Summarized", "weight": 2.5, "type_id": 1, "value": 50.0, "user_id": USER_ID, "delivery_cost": None},
+        {"name": "Summarized", "weight": 4.0, "type_id": 3, "value": 10.0, "user_id": USER_ID, "delivery_cost": None},
+    ]
+    async with AsyncSessionLocal() as db:
+        await db.execute(delete(models.Package).where(models.Package.user_id == USER_ID))
+        await db.execute(delete(models.PackageSummary).where(models.PackageSummary.user_id == USER_ID))
+        await db.execute(insert(models.Package), packages)
+        await record_registered(db, packages)
+        await db.commit()
+
+        rows = await user_summary(db, USER_ID)
+        assert totals(rows) == {1: (2, 3.5, 150.0, 90.0, 1, 2.5, 50.0), 3: (1, 4.0, 10.0, 0.0, 1, 4.0, 10.0)}
+
+        # Pricing the pending packages moves them from pending to priced
+        await recompute_delivery_costs(db, 80.0)
+        db.expire_all()
+        incremental = totals(await user_summary(db, USER_ID))
+        assert incremental[1][3] == pytest.approx(90.0 + (2.5 * 0.5 + 50.0 * 0.01) * 80.0)
+        assert incremental[1][4] == incremental[3][4] == 0
+
+        # The rebuild reconciles to the same numbers
+        assert await rebuild(db, USER_ID) == 2
+        db.expire_all()
+        assert totals(await user_summary(db, USER_ID)) == incremental
+        count = (await db.execute(select(models.PackageSummary.user_id)
+                                  .where(models.PackageSummary.user_id == USER_ID))).all()
+        assert len(count) == 2
+
+
+@pytest.mark.asyncio
+async def test_pending_groups_lock_without_group_by():
+    class Recorder:
+        """ Stands in for the session: keeps the statement and returns priced rows. """
+        statement = None
+
+        async def execute(self, statement):
+            self.statement = statement
+            return self
+
+        def all(self):
+            return [(1, 1, 2.0, 10.0, 5.0), (1, 1, None, 20.0, 7.0), (1, 2, 1.0, None, None)]
+
+    db = Recorder()
+    deltas = await pending_groups(db, true(), literal(1.0))
+    # PostgreSQL rejects FOR UPDATE combined with GROUP BY, so the rows are added up in Python
+    sql = str(db.statement.compile(dialect=postgresql.dialect()))
+    assert "FOR UPDATE" in sql and "GROUP BY" not in sql
+    assert deltas == {(1, 1): [0, 0.0, 0.0, 12.0, -2, -2.0, -30.0], (1, 2): [0, 0.0, 0.0, 0.0, -1, -1.0, 0.0]}
@@ -0,0 +1,4 @@
+# __init__.py
+#
+# Offline benchmark suite: runs the service against a local SQLite database and an in-process
+# Redis stand-in, so it needs neither the docker-compose MySQL nor Redis.
@@ -0,0 +1,66 @@
+# Cold-start time of an API worker: interpreter start, import of app.main and startup handlers
+#
+# Usage: python -m benchmarks.cold_start [--workers N] [--output cold_start.json]
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.harness import percentile
+
+# Runs in a fresh interpreter per simulated worker, against the same SQLite file and a fake Redis
+WORKER_SCRIPT = """
+import asyncio, json, os, sys, time
+started = time.perf_counter()
+from benchmarks.harness import setup_environment
+setup_environment(sys.argv[1])
+import app.main
+imported = time.perf_counter()
+
+async def start():
+    # Startup handlers run on entering the lifespan
+    async with app.main.app.router.lifespan_context(app.main.app):
+        ready = time.perf_counter()
+        print(json.dumps({"import_seconds": imported - started, "ready_seconds": ready - started,
+                          "startup_seconds": ready - imported}), flush=True)
+        # Only the start is measured; leave without waiting for the background tasks
+        os._exit(0)
+
+asyncio.run(start())
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--workers", type=int, default=10, help="worker starts to measure")
+    parser.add_argument("--output", default="bench_results_cold_start.json", help="where to write the JSON results")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    db_path = os.path.join(tempfile.mkdtemp(prefix="delivery-cold-start-"), "bench.db")
+    # Migrate once, as a deployment does before starting the workers
+    env = {**os.environ, "DATABASE_URL": f"sqlite+pysqlite:///{db_path}"}
+    subprocess.run([sys.executable, "-m", "app.migrate"], env=env, check=True, capture_output=True)
+    runs = []
+    for _ in range(args.workers):
+        started = time.perf_counter()
+        output = subprocess.run([sys.executable, "-c", WORKER_SCRIPT, db_path], env=env, check=True,
+                                capture_output=True, text=True).stdout
+        runs.append({**json.loads(output.splitlines()[-1]), "process_seconds": time.perf_counter() - started})
+    summary = {key: {"p50_ms": percentile([run[key] for run in runs], 0.5) * 1000,
+                     "max_ms": max(run[key] for run in runs) * 1000}
+               for key in ("import_seconds", "startup_seconds", "ready_seconds", "process_seconds")}
+    with open(args.output, "w") as output:
+        json.dump({"parameters": vars(args), "runs": runs, "summary": summary}, output, indent=2)
+    for key, stats in summary.items():
+        print(f"{key:18} p50 {stats['p50_ms']:8.1f} ms  max {stats['max_ms']:8.1f} ms")
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+# Local stand-ins, data seeding and latency statistics shared by the benchmarks
+import asyncio
+import os
+import random
+import sqlite3
+import time
+from typing import Awaitable, Callable, List
+
+
+def setup_environment(db_path: str):
+    """ Points the service at a SQLite file and an in-process Redis stand-in.
+
+    Must run before any other module of the app package is imported, because the
+    engines and the Redis client are created when their modules are imported.
+    """
+    os.environ["DATABASE_URL"] = f"sqlite+pysqlite:///{db_path}"
+    # The register scenario measures one commit per request; group commit is measured separately
+    os.environ["REGISTER_GROUP_COMMIT"] = "0"
+    import fakeredis
+    import redis.asyncio as aioredis
+    from fakeredis import aioredis as fake_aioredis
+    import app.redis_client
+    # Same client class as in production, talking to an in-process fake server instead of a socket
+    pool = aioredis.ConnectionPool(connection_class=fake_aioredis.FakeConnection, server=fakeredis.FakeServer())
+    app.redis_client.redis_client = app.redis_client.InstrumentedRedis(connection_pool=pool)
+
+
+def seed_packages(db_path: str, packages: int, users: int, pending_ratio: float = 0.0,
+                  batch_size: int = 50000, seed: int = 42) -> dict:
+    """ Bulk-loads random packages straight through sqlite3 and returns what was created.
+
+    A share of pending_ratio packages is left without a delivery cost. Users are skewed:
+    30% of the packages belong to the heaviest 1% of users, as in production.
+    """
+    from app import models
+    from app.database import engine
+    models.Base.metadata.create_all(bind=engine)
+    models.register_package_types()
+    rng = random.Random(seed)
+    type_ids = list(models.PACKAGE_TYPES.values())
+    heavy_users = max(users // 100, 1)
+    connection = sqlite3.connect(db_path)
+    connection.execute("PRAGMA journal_mode=OFF")
+    connection.execute("PRAGMA synchronous=OFF")
+    started = time.perf_counter()
+    for start in range(0, packages, batch_size):
+        rows = []
+        for index in range(start, min(start + batch_size, packages)):
+            weight = round(rng.uniform(0.1, 50.0), 2)
+            value = round(rng.uniform(1.0, 5000.0), 2)
+            cost = None if rng.random() < pending_ratio else (weight * 0.5 + value * 0.01) * 90.0
+            user_id = rng.randint(1, heavy_users) if rng.random() < 0.3 else rng.randint(1, users)
+            rows.append((f"Package {index}", weight, rng.choice(type_ids), value, cost, user_id))
+        connection.executemany("INSERT INTO packages (name, weight, type_id, value, delivery_cost, user_id) "
+                               "VALUES (?, ?, ?, ?, ?, ?)", rows)
+        connection.commit()
+    heaviest_user, heaviest_count = connection.execute(
+        "SELECT user_id, COUNT(*) AS n FROM packages GROUP BY user_id ORDER BY n DESC LIMIT 1").fetchone()
+    max_id = connection.execute("SELECT MAX(id) FROM packages").fetchone()[0]
+    connection.execute("ANALYZE")
+    connection.close()
+    # The rows bypassed the API, so build the per-user summaries from them in one go
+    from sqlalchemy import insert
+    from app.summaries import SUMMARY_COLUMNS, aggregate_query
+    with engine.begin() as db:
+        db.execute(insert(models.PackageSummary).from_select(("user_id", "type_id") + SUMMARY_COLUMNS,
+                                                             aggregate_query()))
+    return {"packages": packages, "users": users, "max_id": max_id, "heaviest_user": heaviest_user,
+            "heaviest_user_packages": heaviest_count, "seconds": time.perf_counter() - started}
+
+
+def percentile(samples: List[float], fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def summarize(samples: List[float], elapsed: float, cpu: float = 0.0) -> dict:
+    """ Turns per-operation latencies and process CPU time (seconds) into throughput and milliseconds. """
+    if not samples:
+        return {"operations": 0}
+    return {
+        "operations": len(samples),
+        "throughput_per_second": len(samples) / elapsed,
+        "cpu_ms_per_operation": cpu / len(samples) * 1000,
+        "p50_ms": percentile(samples, 0.50) * 1000,
+        "p99_ms": percentile(samples, 0.99) * 1000,
+        "max_ms": max(samples) * 1000,
+    }
+
+
+async def measure(operation: Callable[[int], Awaitable[None]], count: int, concurrency: int) -> dict:
+    """ Runs operation(0..count-1) with the given concurrency and summarizes the latencies. """
+    samples = []
+    queue = iter(range(count))
+
+    async def worker():
+        for index in queue:
+            started = time.perf_counter()
+            await operation(index)
+            samples.append(time.perf_counter() - started)
+
+    started, cpu_started = time.perf_counter(), time.process_time()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(samples, time.perf_counter() - started, time.process_time() - cpu_started)
@@ -0,0 +1,330 @@
+# Offline benchmark of the package API and the delivery cost job
+#
+# Usage: python -m benchmarks.run [--packages N] [--users N] [--output results.json]
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+
+from benchmarks.harness import measure, seed_packages, setup_environment
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--packages", type=int, default=200000, help="packages to seed (e.g. 10000000)")
+    parser.add_argument("--users", type=int, default=2000, help="users owning them (e.g. 100000)")
+    parser.add_argument("--requests", type=int, default=2000, help="requests per endpoint scenario")
+    parser.add_argument("--concurrency", type=int, default=32, help="requests in flight at once")
+    parser.add_argument("--backlog", type=int, default=100000, help="NULL-cost packages for the cost job")
+    parser.add_argument("--db", default=None, help="SQLite file to use (default: a temporary file)")
+    parser.add_argument("--output", default="bench_results.json", help="where to write the JSON results")
+    return parser.parse_args()
+
+
+async def bench_endpoints(args, seeded: dict) -> dict:
+    import httpx
+    from app.main import app
+    rng = random.Random(7)
+    results = {}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def register(index):
+            response = await client.post("/register", json={
+                "name": f"Bench {index}", "weight": 1.5, "type_id": 1 + index % 3, "value": 100.0,
+                "user_id": rng.randint(1, args.users)})
+            assert response.status_code == 200, response.text
+        results["register"] = await measure(register, args.requests, args.concurrency)
+
+        async def get_package(index):
+            response = await client.get(f"/package/{rng.randint(1, seeded['max_id'])}")
+            assert response.status_code == 200, response.text
+        results["package"] = await measure(get_package, args.requests, args.concurrency)
+
+        # Polling clients revalidating the copies they hold: 304 without the row or the body
+        etags = {}
+        for package_id in rng.sample(range(1, seeded["max_id"] + 1), 200):
+            etags[package_id] = (await client.get(f"/package/{package_id}")).headers["ETag"]
+        polled = list(etags.items())
+
+        async def revalidate_package(index):
+            package_id, etag = polled[index % len(polled)]
+            response = await client.get(f"/package/{package_id}", headers={"If-None-Match": etag})
+            assert response.status_code == 304, response.text
+        results["package_revalidate"] = await measure(revalidate_package, args.requests, args.concurrency)
+
+        # Deep pages of the heaviest user: OFFSET pagination against the cursor walk over the same rows
+        heaviest, owned = seeded["heaviest_user"], seeded["heaviest_user_packages"]
+        for depth in sorted({0, owned // 10, owned // 2, max(owned - 50, 0)}):
+            async def show_offset(index, depth=depth):
+                response = await client.post("/show", json={"user_id": heaviest, "offset": depth, "limit": 50})
+                assert response.status_code == 200, response.text
+            results[f"show_offset_{depth}"] = await measure(show_offset, min(args.requests, 500), args.concurrency)
+
+        page = {"user_id": heaviest, "limit": 50}
+        show_etag = (await client.post("/show", json=page)).headers["ETag"]
+
+        async def revalidate_show(index):
+            response = await client.post("/show", json=page, headers={"If-None-Match": show_etag})
+            assert response.status_code == 304, response.text
+        results["show_revalidate"] = await measure(revalidate_show, args.requests, args.concurrency)
+
+        async def summary(index):
+            response = await client.get(f"/summary/{heaviest if index % 2 else rng.randint(1, args.users)}")
+            assert response.status_code == 200, response.text
+        results["summary"] = await measure(summary, args.requests, args.concurrency)
+
+        # Name search of the heaviest user's packages, after a first search has built the index of the shard
+        await client.post("/search", json={"user_id": heaviest, "query": "Package"})
+
+        async def search_substring(index):
+            response = await client.post("/search", json={"user_id": heaviest,
+                                                          "query": str(rng.randint(100, seeded["max_id"]))[:3]})
+            assert response.status_code == 200, response.text
+        results["search_substring"] = await measure(search_substring, args.requests, args.concurrency)
+
+        async def search_prefix(index):
+            response = await client.post("/search", json={"user_id": heaviest, "match": "prefix",
+                                                          "query": f"Package {rng.randint(1, 99)}"})
+            assert response.status_code == 200, response.text
+        results["search_prefix"] = await measure(search_prefix, args.requests, args.concurrency)
+
+        cursors = []
+        request = {"user_id": heaviest, "limit": 50}
+        while len(cursors) < owned // 50:
+            response = await client.post("/show", json=request)
+            if "X-Next-Cursor" not in response.headers:
+                break
+            request = {**request, "cursor": response.headers["X-Next-Cursor"]}
+            cursors.append(request["cursor"])
+        if cursors:
+            async def show_cursor(index):
+                response = await client.post("/show", json={"user_id": heaviest, "limit": 50,
+                                                             "cursor": cursors[-1 - index % min(len(cursors), 10)]})
+                assert response.status_code == 200, response.text
+            results["show_cursor_deep"] = await measure(show_cursor, min(args.requests, 500), args.concurrency)
+    return results
+
+
+async def bench_register_modes(args) -> dict:
+    """ /register with group commit at several window lengths (the register scenario commits per request). """
+    import httpx
+    from app.main import app
+    from app.registration import GroupCommitter, get_group_committer
+    rng = random.Random(11)
+    results = {}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def register(index):
+            response = await client.post("/register", json={
+                "name": f"Grouped {index}", "weight": 1.5, "type_id": 1 + index % 3, "value": 100.0,
+                "user_id": rng.randint(1, args.users)})
+            assert response.status_code == 200, response.text
+
+        for window_ms in (1, 5, 20):
+            committer = GroupCommitter(window_ms=window_ms)
+            # Bound through a closure: FastAPI would read a default argument as a request parameter
+            app.dependency_overrides[get_group_committer] = (lambda committer: lambda: committer)(committer)
+            try:
+                results[f"group_{window_ms}ms"] = await measure(register, args.requests, args.concurrency)
+            finally:
+                app.dependency_overrides.pop(get_group_committer)
+                await committer.close()
+    return results
+
+
+async def bench_export(args) -> dict:
+    """ Streams every package through /export and records throughput and peak memory. """
+    import tracemalloc
+    from urllib.parse import urlencode
+    from app.main import app
+    results = {}
+    for name, params, encoding in (("export_ndjson", {}, b"identity"), ("export_csv_gzip", {"format": "csv"}, b"gzip")):
+        # Drive the ASGI app directly: httpx's ASGITransport would collect the whole body in memory
+        scope = {"type": "http", "asgi": {"version": "3.0", "spec_version": "2.4"}, "http_version": "1.1", "method": "GET",
+                 "scheme": "http", "path": "/export", "raw_path": b"/export", "root_path": "",
+                 "query_string": urlencode(params).encode(), "headers": [(b"accept-encoding", encoding)],
+                 "client": ("127.0.0.1", 1), "server": ("bench", 80)}
+        sent = {"bytes": 0, "status": None}
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                sent["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                sent["bytes"] += len(message.get("body", b""))
+
+        tracemalloc.start()
+        started = time.perf_counter()
+        await app(scope, receive, send)
+        elapsed = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        assert sent["status"] == 200
+        results[name] = {"rows": args.packages, "seconds": elapsed, "rows_per_second": args.packages / elapsed,
+                         "bytes": sent["bytes"], "peak_memory_mb": peak / 2 ** 20}
+    return results
+
+
+async def bench_show_serialization(args, seeded: dict) -> dict:
+    """ CPU time of building a 50-package /show page from entities and schemas against column tuples. """
+    from pydantic import TypeAdapter
+    from sqlalchemy import select
+    from typing import List
+    from app import models, schemas
+    from app.database import AsyncSessionLocal
+    from app.rate_history import PACKAGE_ROW_COLUMNS, RateHistory
+    from app.responses import FastJSONResponse
+    history = RateHistory()
+    adapter = TypeAdapter(List[schemas.Package])
+    condition = models.Package.user_id == seeded["heaviest_user"]
+    order = (models.Package.type_id, models.Package.id)
+
+    async def entities_page(db):
+        # What /show did before: ORM entities, validated and encoded through the response model
+        result = await db.execute(select(models.Package).filter(condition).order_by(*order).limit(50))
+        records = [schemas.PackageRecord.model_validate(package) for package in result.scalars().all()]
+        return adapter.dump_json(await history.price(db, records))
+
+    async def tuples_page(db):
+        result = await db.execute(select(*PACKAGE_ROW_COLUMNS).filter(condition).order_by(*order).limit(50))
+        return FastJSONResponse(await history.price_rows(db, result.all())).body
+
+    results = {}
+    async with AsyncSessionLocal() as db:
+        assert json.loads(await entities_page(db)) == json.loads(await tuples_page(db))
+        for name, page in (("entities", entities_page), ("tuples", tuples_page)):
+            async def build(index, page=page):
+                await page(db)
+            results[name] = await measure(build, min(args.requests, 1000), 1)
+    results["cpu_reduction"] = 1 - results["tuples"]["cpu_ms_per_operation"] / results["entities"]["cpu_ms_per_operation"]
+    return results
+
+
+async def bench_quotes(args) -> dict:
+    """ Quote pricing: the engine alone, against pricing the packages one by one, then /quote end to end. """
+    import httpx
+    from app import pricing
+    from app.main import app
+    from app.rates import ExchangeRateProvider, get_rate_provider
+    from app.redis_client import redis_client
+    rng = random.Random(11)
+    size = 1000
+    weights = [rng.uniform(0.1, 30.0) for _ in range(size)]
+    values = [rng.uniform(1.0, 5000.0) for _ in range(size)]
+    type_ids = [rng.randint(1, 3) for _ in range(size)]
+    engine = pricing.PricingEngine({2: pricing.Tariff(0.5, 0.03)})
+    results = {}
+    modes = {
+        "loop": lambda: [engine.cost(weight, value, type_id, 90.0)
+                         for weight, value, type_id in zip(weights, values, type_ids)],
+        "vectorized": lambda: engine.quote(weights, values, type_ids, 90.0),
+    }
+    for mode, price in modes.items():
+        rounds = 200
+        started = time.perf_counter()
+        for _ in range(rounds):
+            price()
+        elapsed = time.perf_counter() - started
+        results[f"engine_{mode}"] = {"packages_per_second": rounds * size / elapsed}
+
+    class FixedRateSource:
+        async def fetch(self):
+            return 90.0
+
+    provider = ExchangeRateProvider(FixedRateSource(), redis_client)
+    app.dependency_overrides[get_rate_provider] = lambda: provider
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+            async def quote(index):
+                response = await client.post("/quote", json={"weights": weights, "values": values,
+                                                              "type_ids": type_ids})
+                assert response.status_code == 200, response.text
+            summary = await measure(quote, min(args.requests, 500), args.concurrency)
+    finally:
+        app.dependency_overrides.clear()
+    results["endpoint"] = {**summary, "packages_per_request": size,
+                           "packages_per_second": summary["throughput_per_second"] * size}
+    return results
+
+
+async def bench_cost_job(args) -> dict:
+    from sqlalchemy import update
+    from app import models
+    from app.costs import recompute_delivery_costs
+    from app.database import AsyncSessionLocal
+    async with AsyncSessionLocal() as db:
+        # Turn the most recent packages into a NULL-cost backlog
+        result = await db.execute(update(models.Package)
+                                  .where(models.Package.id > args.packages - args.backlog)
+                                  .values(delivery_cost=None))
+        await db.commit()
+        backlog = result.rowcount
+        started = time.perf_counter()
+        updated = await recompute_delivery_costs(db, 90.0)
+        elapsed = time.perf_counter() - started
+    return {"backlog": backlog, "updated": updated, "seconds": elapsed,
+            "rows_per_second": updated / elapsed if elapsed else None}
+
+
+def main():
+    args = parse_args()
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix="delivery-bench-"), "bench.db")
+    setup_environment(db_path)
+    seeded = seed_packages(db_path, args.packages, args.users)
+    print(f"Seeded {seeded['packages']} packages in {seeded['seconds']:.1f}s "
+          f"(heaviest user owns {seeded['heaviest_user_packages']})")
+
+    async def run():
+        return {"endpoints": await bench_endpoints(args, seeded),
+                "register_modes": await bench_register_modes(args),
+                "show_serialization": await bench_show_serialization(args, seeded),
+                "export": await bench_export(args),
+                "quotes": await bench_quotes(args),
+                "update_delivery_costs": await bench_cost_job(args)}
+
+    results = asyncio.run(run())
+    report = {
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "database": "sqlite", "redis": "fakeredis"},
+        "parameters": vars(args),
+        "seed": seeded,
+        "results": results,
+    }
+    with open(args.output, "w") as output:
+        json.dump(report, output, indent=2)
+    for name, summary in results["endpoints"].items():
+        print(f"{name:24} {summary['throughput_per_second']:9.1f} req/s  "
+              f"p50 {summary['p50_ms']:7.2f} ms  p99 {summary['p99_ms']:7.2f} ms  "
+              f"cpu {summary['cpu_ms_per_operation']:6.2f} ms/req")
+    single = results["endpoints"]["register"]["throughput_per_second"]
+    for name, summary in results["register_modes"].items():
+        print(f"{'register ' + name:24} {summary['throughput_per_second']:9.1f} req/s  "
+              f"p50 {summary['p50_ms']:7.2f} ms  p99 {summary['p99_ms']:7.2f} ms  "
+              f"({summary['throughput_per_second'] / single:.1f}x one commit per request)")
+    serialization = results["show_serialization"]
+    print(f"{'show page (entities)':24} cpu {serialization['entities']['cpu_ms_per_operation']:6.2f} ms/page")
+    print(f"{'show page (tuples)':24} cpu {serialization['tuples']['cpu_ms_per_operation']:6.2f} ms/page  "
+          f"({serialization['cpu_reduction']:.0%} less)")
+    for name, export in results["export"].items():
+        print(f"{name:24} {export['rows_per_second']:9.1f} rows/s  {export['bytes'] / 2 ** 20:7.1f} MB sent  "
+              f"peak memory {export['peak_memory_mb']:6.1f} MB")
+    quotes = results["quotes"]
+    for name in ("engine_loop", "engine_vectorized"):
+        if name in quotes:
+            print(f"{'quote ' + name[7:]:24} {quotes[name]['packages_per_second']:9.0f} packages/s")
+    print(f"{'quote endpoint':24} {quotes['endpoint']['packages_per_second']:9.0f} packages/s  "
+          f"p50 {quotes['endpoint']['p50_ms']:7.2f} ms  p99 {quotes['endpoint']['p99_ms']:7.2f} ms  "
+          f"({quotes['endpoint']['packages_per_request']} per request)")
+    job = results["update_delivery_costs"]
+    print(f"{'update_delivery_costs':24} {job['rows_per_second'] or 0:9.1f} rows/s  ({job['updated']} rows)")
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
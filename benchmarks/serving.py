@@ -0,0 +1,164 @@
+# Requests per second of the service behind a single uvicorn process and behind gunicorn workers
+#
+# Usage: python -m benchmarks.serving [--workers N] [--output bench_results_serving.json]
+#
+# Both servers listen on a local port and are driven over real sockets by several client processes,
+# so the clients themselves do not cap the throughput of the workers.
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.harness import measure, seed_packages, setup_environment
+from app.serving import available_cpus
+
+QUOTE_SIZE = 200
+
+
+class FixedRateSource:
+    async def fetch(self):
+        return 90.0
+
+
+async def idle():
+    await asyncio.Event().wait()
+
+
+def create_app():
+    """ App factory the servers load: the service on the benchmark's SQLite file, with a fixed exchange rate. """
+    setup_environment(os.environ["BENCH_DB"])
+    from app.main import app, cost_worker, rate_provider
+    rate_provider.source = FixedRateSource()
+    # The fake Redis answers a blocking XREADGROUP at once, which would turn the idle cost stream worker
+    # into a busy loop taking CPU from the requests; the scenarios register nothing, so it is left out
+    cost_worker.run_forever = idle
+    return app
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--packages", type=int, default=20000, help="packages to seed")
+    parser.add_argument("--users", type=int, default=200, help="users owning them")
+    parser.add_argument("--workers", type=int, default=max(available_cpus(), 2), help="gunicorn workers")
+    parser.add_argument("--requests", type=int, default=4000, help="requests per scenario and server")
+    parser.add_argument("--clients", type=int, default=4, help="client processes generating the load")
+    parser.add_argument("--concurrency", type=int, default=16, help="requests in flight per client process")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--output", default="bench_results_serving.json", help="where to write the JSON results")
+    return parser.parse_args()
+
+
+def server_commands(args) -> dict:
+    address = f"127.0.0.1:{args.port}"
+    return {
+        # The command the Dockerfile ran before gunicorn
+        "uvicorn_single": [sys.executable, "-m", "uvicorn", "benchmarks.serving:create_app", "--factory",
+                           "--host", "127.0.0.1", "--port", str(args.port), "--no-access-log"],
+        "gunicorn": [sys.executable, "-m", "gunicorn", "benchmarks.serving:create_app()", "-c", "gunicorn.conf.py",
+                     "--bind", address, "--workers", str(args.workers)],
+    }
+
+
+def wait_until_serving(url: str, process: subprocess.Popen, timeout: float = 60.0):
+    import httpx
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            if httpx.get(url + "/metrics", timeout=1.0).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("Server did not start in time")
+
+
+def run_client(base_url: str, scenario: str, requests: int, concurrency: int, max_id: int, seed: int) -> dict:
+    """ Sends one client process' share of a scenario and summarizes its latencies. """
+    import httpx
+    rng = random.Random(seed)
+    quote = {"weights": [rng.uniform(0.1, 30.0) for _ in range(QUOTE_SIZE)],
+             "values": [rng.uniform(1.0, 5000.0) for _ in range(QUOTE_SIZE)],
+             "type_ids": [rng.randint(1, 3) for _ in range(QUOTE_SIZE)]}
+
+    async def run():
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30.0) as client:
+            async def operation(index):
+                if scenario == "package":
+                    response = await client.get(f"/package/{rng.randint(1, max_id)}")
+                else:
+                    response = await client.post("/quote", json=quote)
+                assert response.status_code == 200, response.text
+            return await measure(operation, requests, concurrency)
+
+    return asyncio.run(run())
+
+
+def drive(args, base_url: str, scenario: str, max_id: int) -> dict:
+    """ Runs a scenario from all client processes at once and adds up their throughput. """
+    share = args.requests // args.clients
+    with multiprocessing.get_context("spawn").Pool(args.clients) as pool:
+        started = time.perf_counter()
+        summaries = pool.starmap(run_client, [(base_url, scenario, share, args.concurrency, max_id, seed)
+                                              for seed in range(args.clients)])
+        elapsed = time.perf_counter() - started
+    return {"requests": share * args.clients, "seconds": elapsed,
+            "throughput_per_second": share * args.clients / elapsed,
+            "p50_ms": max(summary["p50_ms"] for summary in summaries),
+            "p99_ms": max(summary["p99_ms"] for summary in summaries)}
+
+
+def main():
+    args = parse_args()
+    db_path = os.path.join(tempfile.mkdtemp(prefix="delivery-serving-"), "bench.db")
+    setup_environment(db_path)
+    seeded = seed_packages(db_path, args.packages, args.users)
+    env = {**os.environ, "BENCH_DB": db_path, "DATABASE_URL": f"sqlite+pysqlite:///{db_path}",
+           "ACCESS_LOG": "", "LOG_LEVEL": "warning"}
+    base_url = f"http://127.0.0.1:{args.port}"
+    results = {}
+    for server, command in server_commands(args).items():
+        process = subprocess.Popen(command, env=env)
+        try:
+            wait_until_serving(base_url, process)
+            # Warm up every worker's connections and caches before measuring
+            drive(argparse.Namespace(**{**vars(args), "requests": args.clients * 50}), base_url, "package",
+                  seeded["max_id"])
+            results[server] = {scenario: drive(args, base_url, scenario, seeded["max_id"])
+                               for scenario in ("package", "quote")}
+        finally:
+            process.terminate()
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                raise RuntimeError(f"{server} did not shut down within 30s")
+    report = {
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "cpus": available_cpus(), "database": "sqlite", "redis": "fakeredis per worker"},
+        "parameters": vars(args),
+        "results": results,
+    }
+    with open(args.output, "w") as output:
+        json.dump(report, output, indent=2)
+    for scenario in ("package", "quote"):
+        single = results["uvicorn_single"][scenario]["throughput_per_second"]
+        for server, scenarios in results.items():
+            summary = scenarios[scenario]
+            print(f"{scenario + ' ' + server:24} {summary['throughput_per_second']:9.1f} req/s  "
+                  f"p50 {summary['p50_ms']:7.2f} ms  p99 {summary['p99_ms']:7.2f} ms  "
+                  f"({summary['throughput_per_second'] / single:.2f}x single process)")
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
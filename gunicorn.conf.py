@@ -0,0 +1,31 @@
+# Gunicorn settings of the API: one uvicorn worker (uvloop + httptools) per CPU behind a shared socket
+#
+# Usage: gunicorn app.main:app -c gunicorn.conf.py
+import os
+from app.serving import worker_count
+
+bind = os.getenv("BIND", f"{os.getenv('HOST', '0.0.0.0')}:{os.getenv('PORT', '8000')}")
+workers = worker_count()
+worker_class = "app.serving.UvloopWorker"
+
+# Import the app once in the master and fork the workers from it: they start faster and share the
+# memory of the imported code. PRELOAD_APP=0 imports it in every worker instead, which lets a
+# HUP signal reload the code
+preload_app = os.getenv("PRELOAD_APP", "1") == "1"
+
+# Seconds a worker may stay silent before the master replaces it (its event loop is blocked)
+timeout = int(os.getenv("TIMEOUT", "60"))
+# Seconds a stopping worker gets to finish its requests and run its shutdown handlers before it is killed
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+# Seconds an idle client connection is kept open; set it above the idle timeout of a load balancer in front
+keepalive = int(os.getenv("KEEP_ALIVE", "5"))
+
+loglevel = os.getenv("LOG_LEVEL", "info")
+accesslog = os.getenv("ACCESS_LOG", "-") or None
+errorlog = os.getenv("ERROR_LOG", "-")
+
+
+def post_fork(server, worker):
+    # Every worker opens its own database and Redis connections
+    from app.serving import reset_after_fork
+    reset_after_fork()
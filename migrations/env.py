@@ -0,0 +1,35 @@
+# Alembic environment: migrates the primary database of DATABASE_URL, or the database of the
+# connection passed in config.attributes["connection"] (app.migrate does so for every shard)
+from alembic import context
+from app import models
+from app.database import engine
+
+target_metadata = models.Base.metadata
+
+
+def run_migrations_offline():
+    """ Writes the migration SQL instead of running it (alembic upgrade --sql). """
+    context.configure(url=engine.url, target_metadata=target_metadata, literal_binds=True)
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations(connection):
+    context.configure(connection=connection, target_metadata=target_metadata)
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    connection = context.config.attributes.get("connection")
+    if connection is not None:
+        run_migrations(connection)
+        return
+    with engine.connect() as connection:
+        run_migrations(connection)
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,42 @@
+"""Initial schema: package types and packages, as the service created them before it had migrations
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "package_types",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("name", sa.String(50)),
+    )
+    op.create_index("ix_package_types_id", "package_types", ["id"])
+    op.create_index("ix_package_types_name", "package_types", ["name"], unique=True)
+
+    op.create_table(
+        "packages",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("name", sa.String(100)),
+        sa.Column("weight", sa.Float()),
+        sa.Column("type_id", sa.Integer(), sa.ForeignKey("package_types.id")),
+        sa.Column("value", sa.Float()),
+        sa.Column("delivery_cost", sa.Float(), nullable=True),
+        sa.Column("user_id", sa.Integer()),
+    )
+    op.create_index("ix_packages_id", "packages", ["id"])
+    op.create_index("ix_packages_name", "packages", ["name"])
+    op.create_index("ix_packages_user_id", "packages", ["user_id"])
+
+
+def downgrade():
+    op.drop_table("packages")
+    op.drop_table("package_types")
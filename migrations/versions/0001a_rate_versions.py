@@ -0,0 +1,36 @@
+"""Exchange rate versions referenced by the packages, and the composite index of /show
+
+Revision ID: 0001a
+Revises: 0001
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0001a"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "exchange_rates",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("usd_to_rub", sa.Float(precision=53)),
+        sa.Column("created_at", sa.DateTime(), server_default=sa.func.now()),
+    )
+    op.create_index("ix_exchange_rates_id", "exchange_rates", ["id"])
+    # SQLite cannot add a foreign key to an existing table, so it rebuilds the table
+    with op.batch_alter_table("packages") as batch:
+        batch.add_column(sa.Column("rate_version", sa.Integer(), nullable=True))
+        batch.create_foreign_key("fk_packages_rate_version", "exchange_rates", ["rate_version"], ["id"])
+    op.create_index("ix_packages_user_id_type_id_id", "packages", ["user_id", "type_id", "id"])
+
+
+def downgrade():
+    op.drop_index("ix_packages_user_id_type_id_id", table_name="packages")
+    with op.batch_alter_table("packages") as batch:
+        batch.drop_constraint("fk_packages_rate_version", type_="foreignkey")
+        batch.drop_column("rate_version")
+    op.drop_table("exchange_rates")
@@ -0,0 +1,46 @@
+"""Per-user, per-type package aggregates
+
+Revision ID: 0002
+Revises: 0001a
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0002"
+down_revision = "0001a"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "package_summaries",
+        sa.Column("user_id", sa.Integer(), primary_key=True, autoincrement=False),
+        sa.Column("type_id", sa.Integer(), sa.ForeignKey("package_types.id"), primary_key=True,
+                  autoincrement=False),
+        sa.Column("packages", sa.Integer(), nullable=False),
+        sa.Column("total_weight", sa.Float(precision=53), nullable=False),
+        sa.Column("total_value", sa.Float(precision=53), nullable=False),
+        sa.Column("total_delivery_cost", sa.Float(precision=53), nullable=False),
+        sa.Column("pending_packages", sa.Integer(), nullable=False),
+        sa.Column("pending_weight", sa.Float(precision=53), nullable=False),
+        sa.Column("pending_value", sa.Float(precision=53), nullable=False),
+    )
+    # Fill the aggregates from the packages registered so far
+    op.execute("""
+        INSERT INTO package_summaries (user_id, type_id, packages, total_weight, total_value, total_delivery_cost,
+                                       pending_packages, pending_weight, pending_value)
+        SELECT user_id, type_id, COUNT(*), COALESCE(SUM(weight), 0), COALESCE(SUM(value), 0),
+               COALESCE(SUM(delivery_cost), 0),
+               SUM(CASE WHEN delivery_cost IS NULL THEN 1 ELSE 0 END),
+               COALESCE(SUM(CASE WHEN delivery_cost IS NULL THEN weight END), 0),
+               COALESCE(SUM(CASE WHEN delivery_cost IS NULL THEN value END), 0)
+        FROM packages
+        WHERE user_id IS NOT NULL AND type_id IS NOT NULL
+        GROUP BY user_id, type_id
+    """)
+
+
+def downgrade():
+    op.drop_table("package_summaries")
@@ -0,0 +1,32 @@
+"""Package ids wide enough to carry the shard index
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name == "sqlite":
+        # SQLite ids are already 64-bit; rebuild the table with AUTOINCREMENT so a shard can set its first id
+        with op.batch_alter_table("packages", recreate="always", table_kwargs={"sqlite_autoincrement": True}):
+            pass
+    else:
+        op.alter_column("packages", "id", existing_type=sa.Integer(), type_=sa.BigInteger(),
+                        existing_nullable=False, autoincrement=True)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == "sqlite":
+        with op.batch_alter_table("packages", recreate="always"):
+            pass
+    else:
+        op.alter_column("packages", "id", existing_type=sa.BigInteger(), type_=sa.Integer(),
+                        existing_nullable=False, autoincrement=True)
@@ -0,0 +1,30 @@
+"""Row versions of packages and per-user change counters, behind the ETags of the read endpoints
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("packages", sa.Column("version", sa.Integer(), nullable=False, server_default="1"))
+    # Users without a row are at version 0; the first write after the upgrade creates it
+    op.create_table(
+        "user_versions",
+        sa.Column("user_id", sa.Integer(), primary_key=True, autoincrement=False),
+        sa.Column("version", sa.BigInteger(), nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_table("user_versions")
+    # SQLite drops the column by recreating the table, which must keep its AUTOINCREMENT (see 0003)
+    with op.batch_alter_table("packages", table_kwargs={"sqlite_autoincrement": True}) as batch:
+        batch.drop_column("version")
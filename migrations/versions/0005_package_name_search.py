@@ -0,0 +1,26 @@
+"""Indexes behind the package name search: prefix per user, and FULLTEXT n-grams on MySQL
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18
+"""
+from alembic import op
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index("ix_packages_user_id_name", "packages", ["user_id", "name"])
+    # Other databases search names through the in-process trigram index (app.search)
+    if op.get_bind().dialect.name == "mysql":
+        op.create_index("ix_packages_name_fulltext", "packages", ["name"], mysql_prefix="FULLTEXT",
+                        mysql_with_parser="ngram")
+
+
+def downgrade():
+    if op.get_bind().dialect.name == "mysql":
+        op.drop_index("ix_packages_name_fulltext", table_name="packages")
+    op.drop_index("ix_packages_user_id_name", table_name="packages")
@@ -0,0 +1,24 @@
+"""Drop the FULLTEXT n-gram index of package names: name searches are scoped by user on (user_id, name)
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18
+"""
+from alembic import op
+
+revision = "0006"
+down_revision = "0005"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Only MySQL had it (see 0005)
+    if op.get_bind().dialect.name == "mysql":
+        op.drop_index("ix_packages_name_fulltext", table_name="packages")
+
+
+def downgrade():
+    if op.get_bind().dialect.name == "mysql":
+        op.create_index("ix_packages_name_fulltext", "packages", ["name"], mysql_prefix="FULLTEXT",
+                        mysql_with_parser="ngram")